@@ -0,0 +1,107 @@
+"""
+Live preview for the brightness and contrast adjustments.
+
+While the adjustment dialog is open, the filter is applied only to a
+downscaled proxy of the visible part of the canvas and the result is drawn
+scaled up over it.  On a transparent layer the proxy keeps its alpha
+channel and is drawn over the canvas.  Previews are cached by factor, so moving the slider
+back and forth costs a lookup.  The full-resolution pass runs as a normal
+filter job once the dialog is accepted.
+"""
+import math
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt, QRectF, pyqtSignal
+from PyQt5.QtGui import QImage
+from PyQt5.QtWidgets import (QDialog, QDialogButtonBox, QDoubleSpinBox, QHBoxLayout, QLabel,
+                             QSlider, QVBoxLayout)
+
+import filter_engine
+import image_bridge
+
+ADJUSTMENTS = ('brightness', 'contrast')
+MAX_PROXY_PIXELS = 640 * 480
+CACHE_SIZE = 64
+SLIDER_STEPS = 100  # slider positions per 1.0 of factor, matching the spin box' 2 decimals
+
+
+class AdjustmentPreview:
+    """One adjustment filter applied to a low-resolution proxy of `rect`, cached by factor."""
+
+    def __init__(self, store, rect, filter_name):
+        self.filter_name = filter_name
+        self.rect = rect.intersected(store.rect())
+        self.factor = 1.0
+        self.committed = False  # the full-resolution job was started
+        image = store.copy(self.rect)
+        pixels = max(image.width() * image.height(), 1)
+        scale = min(1.0, math.sqrt(MAX_PROXY_PIXELS / pixels))
+        if scale < 1.0:
+            image = image.scaled(max(int(image.width() * scale), 1), max(int(image.height() * scale), 1),
+                                 Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        self.alpha = None
+        if image.hasAlphaChannel():
+            image = image.convertToFormat(QImage.Format_ARGB32)
+            self.alpha = image_bridge.const_pixel_view(image)[..., image_bridge.ALPHA_CHANNEL].copy()
+        self.proxy = image_bridge.to_rgb_array(image)
+        self._cache = OrderedDict()
+
+    def image(self, factor=None):
+        """The proxy filtered with `factor` (default: the current one) as a QImage."""
+        key = round(self.factor if factor is None else factor, 2)
+        image = self._cache.get(key)
+        if image is None:
+            rgb = filter_engine.make_filter(self.filter_name, key).apply(self.proxy)
+            image = image_bridge.array_to_qimage(rgb)
+            if self.alpha is not None:
+                image = image.convertToFormat(QImage.Format_ARGB32)
+                image_bridge.pixel_view(image)[..., image_bridge.ALPHA_CHANNEL] = self.alpha
+            self._cache[key] = image
+            if len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return image
+
+    def draw(self, painter):
+        # Plain nearest-neighbour scaling keeps the upscale cheap enough for every frame
+        painter.drawImage(QRectF(self.rect), self.image())
+
+
+class AdjustmentDialog(QDialog):
+    """Slider and spin box for an adjustment factor (0.0-2.0), reporting every change."""
+    factor_changed = pyqtSignal(float)
+
+    def __init__(self, parent, title, label):
+        super().__init__(parent)
+        self.setWindowTitle(title)
+        self.slider = QSlider(Qt.Horizontal)
+        self.slider.setRange(0, 2 * SLIDER_STEPS)
+        self.slider.setValue(SLIDER_STEPS)
+        self.spin = QDoubleSpinBox()
+        self.spin.setRange(0.0, 2.0)
+        self.spin.setDecimals(2)
+        self.spin.setSingleStep(0.05)
+        self.spin.setValue(1.0)
+        self.slider.valueChanged.connect(lambda value: self.spin.setValue(value / SLIDER_STEPS))
+        self.spin.valueChanged.connect(self._on_spin_changed)
+
+        row = QHBoxLayout()
+        row.addWidget(self.slider)
+        row.addWidget(self.spin)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout = QVBoxLayout(self)
+        layout.addWidget(QLabel(label))
+        layout.addLayout(row)
+        layout.addWidget(buttons)
+
+    def factor(self):
+        return self.spin.value()
+
+    def _on_spin_changed(self, value):
+        self.slider.blockSignals(True)
+        self.slider.setValue(round(value * SLIDER_STEPS))
+        self.slider.blockSignals(False)
+        self.factor_changed.emit(value)
@@ -0,0 +1,158 @@
+"""
+Headless batch processing: the Effects filters over a directory of images.
+
+Usage:
+    python main.py batch INPUT_DIR OUTPUT_DIR -f blur -f brightness=1.2 [-w 8]
+
+Filters run in the order given, fused by filter_engine exactly as in the
+editor.  Files are handed to a process pool, at most a few per worker at a
+time, and each worker decodes, filters and writes one image before taking
+the next, so memory stays bounded however many files there are.  No Qt is
+needed here.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+from PIL import Image
+
+import filter_engine
+from error_logger import log_error
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp', '.ppm')
+STAGES = ('decode', 'filter', 'encode')
+IN_FLIGHT_PER_WORKER = 2
+
+
+def parse_filter(spec):
+    """'brightness=1.2' -> ('brightness', 1.2); a missing factor means 1.0."""
+    name, _, factor = spec.partition('=')
+    if name not in filter_engine.FILTERS:
+        raise argparse.ArgumentTypeError(
+            f'unknown filter {name!r} (available: {", ".join(filter_engine.FILTERS)})')
+    try:
+        return name, float(factor) if factor else 1.0
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid factor in {spec!r}')
+
+
+def find_images(input_dir, recursive=False):
+    """Yields image paths under `input_dir`, relative to it, in sorted order."""
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.relpath(os.path.join(root, name), input_dir)
+        if not recursive:
+            break
+
+
+def process_file(source, target, filters):
+    """
+    Decodes `source`, applies `filters` and writes `target`; runs in a worker process.
+
+    Returns the seconds spent in each of STAGES.  An alpha channel is kept
+    as it is, the filters only see the colour channels.
+    """
+    timings = {}
+    start = time.perf_counter()
+    with Image.open(source) as image:
+        image.load()
+        alpha = image.getchannel('A') if 'A' in image.getbands() else None
+        rgb = np.asarray(image.convert('RGB'))
+    timings['decode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = Image.fromarray(filter_engine.Pipeline(
+        [filter_engine.make_filter(name, factor) for name, factor in filters]).apply(rgb))
+    if alpha is not None:
+        result.putalpha(alpha)
+    timings['filter'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    if alpha is not None and os.path.splitext(target)[1].lower() in ('.jpg', '.jpeg'):
+        result = result.convert('RGB')
+    result.save(target)
+    timings['encode'] = time.perf_counter() - start
+    return timings
+
+
+def output_path(output_dir, relative, image_format=None):
+    if image_format:
+        relative = os.path.splitext(relative)[0] + '.' + image_format.lstrip('.')
+    return os.path.join(output_dir, relative)
+
+
+def run_batch(input_dir, output_dir, filters, workers=None, recursive=False,
+              image_format=None, report=print):
+    """
+    Filters every image under `input_dir` into `output_dir` on a process pool.
+
+    Returns (processed, failed, wall seconds, summed STAGES timings).
+    """
+    workers = max(int(workers or filter_engine.default_workers()), 1)
+    totals = dict.fromkeys(STAGES, 0.0)
+    processed = failed = 0
+    pending = {}
+    start = time.perf_counter()
+
+    def collect(done):
+        nonlocal processed, failed
+        for future in done:
+            relative = pending.pop(future)
+            try:
+                for stage, seconds in future.result().items():
+                    totals[stage] += seconds
+                processed += 1
+            except Exception as e:
+                failed += 1
+                log_error(f'Batch: error processing {relative}: {e}')
+                report(f'Failed: {relative}: {e}')
+
+    with ProcessPoolExecutor(workers) as pool:
+        for relative in find_images(input_dir, recursive):
+            # Bound the work queued ahead of the workers
+            if len(pending) >= workers * IN_FLIGHT_PER_WORKER:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = pool.submit(process_file, os.path.join(input_dir, relative),
+                                 output_path(output_dir, relative, image_format), filters)
+            pending[future] = relative
+        collect(wait(pending)[0])
+    return processed, failed, time.perf_counter() - start, totals
+
+
+def format_report(processed, failed, elapsed, totals):
+    lines = [f'Processed {processed} image(s), {failed} failed, in {elapsed:.2f} s '
+             f'({processed / elapsed if elapsed else 0:.1f} images/s)']
+    for stage in STAGES:
+        average = totals[stage] / processed * 1000 if processed else 0
+        lines.append(f'  {stage:<7} {totals[stage]:8.2f} s total  {average:8.1f} ms/image')
+    return '\n'.join(lines)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='main.py batch', description='Apply Effects filters to a directory of images.')
+    parser.add_argument('input_dir')
+    parser.add_argument('output_dir')
+    parser.add_argument('-f', '--filter', dest='filters', action='append', type=parse_filter, required=True,
+                        help='filter to apply, optionally with a factor (e.g. contrast=1.3); repeat to chain')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='worker processes (default: one per CPU core)')
+    parser.add_argument('-r', '--recursive', action='store_true', help='include subdirectories')
+    parser.add_argument('--format', dest='image_format', default=None,
+                        help='output file extension (default: same as the input)')
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.input_dir):
+        parser.error(f'not a directory: {args.input_dir}')
+    result = run_batch(args.input_dir, args.output_dir, args.filters, args.workers,
+                       args.recursive, args.image_format)
+    print(format_report(*result))
+    return 1 if result[1] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,902 @@
+"""
+Performance benchmarks for Professional Paint Editor.
+
+Usage:
+    python benchmarks.py            # run every benchmark
+    python benchmarks.py fill       # run only the named benchmarks
+
+Runs without a display (Qt offscreen platform).  Results are printed as
+plain tables so they can be pasted into an issue or PR.
+"""
+import io
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+from PyQt5.QtCore import Qt, QPoint, QRect, QSize, QBuffer
+from PyQt5.QtGui import QImage, QPainter, QPen, QColor, QFont, QPolygon
+from PyQt5.QtWidgets import QApplication
+from PIL import Image, ImageEnhance, ImageFilter, ImageOps
+
+from adjustments import AdjustmentPreview
+from history import History
+from layers import LayerStack
+import fill_engine
+import filter_engine
+import gradient_engine
+import image_bridge
+import image_io
+from project_io import ProjectFile, load as load_project
+from profiler import profiler, timed as timed_section
+from pyramid import Pyramid
+from replay import Session, replay
+from selection import Selection
+import text_engine
+from tile_store import TILE_SIZE, TiledImage
+from vector_layer import KINDS as SHAPE_KINDS, Shape, VectorLayer
+
+app = QApplication.instance() or QApplication(sys.argv[:1])
+
+
+def timed(func, *args, repeat=3, **kwargs):
+    """Returns the best wall time of `repeat` runs of func(*args, **kwargs) in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def print_table(title, header, rows):
+    print(f'\n{title}')
+    widths = [max(len(str(v)) for v in column) for column in zip(header, *rows)]
+    line = '  '.join(str(h).ljust(w) for h, w in zip(header, widths))
+    print(line)
+    print('-' * len(line))
+    for row in rows:
+        print('  '.join(str(v).ljust(w) for v, w in zip(row, widths)))
+
+
+def make_fill_scene(width, height):
+    """White canvas with a few strokes, so the fill region has holes and borders."""
+    image = QImage(width, height, QImage.Format_RGB32)
+    image.fill(Qt.white)
+    painter = QPainter(image)
+    painter.setPen(QPen(Qt.black, max(width // 200, 2)))
+    step = max(width // 8, 16)
+    for x in range(step, width, step):
+        painter.drawLine(x, height // 4, x + step // 2, height - height // 4)
+    painter.drawEllipse(QRect(width // 3, height // 3, width // 4, height // 4))
+    painter.end()
+    return image
+
+
+def legacy_flood_fill(image, pos, color):
+    """The original per-pixel Canvas.flood_fill, kept as the benchmark baseline."""
+    target_color = image.pixelColor(pos)
+    color = QColor(color)
+    if target_color == color:
+        return
+    stack = [pos]
+    while stack:
+        current = stack.pop()
+        x, y = current.x(), current.y()
+        if x < 0 or x >= image.width() or y < 0 or y >= image.height():
+            continue
+        if image.pixelColor(x, y) != target_color:
+            continue
+        image.setPixelColor(x, y, color)
+        stack.append(QPoint(x + 1, y))
+        stack.append(QPoint(x - 1, y))
+        stack.append(QPoint(x, y + 1))
+        stack.append(QPoint(x, y - 1))
+
+
+def bench_fill():
+    """Legacy per-pixel flood fill against the scanline engine."""
+    rows = []
+    for width, height in [(256, 256), (640, 480), (1920, 1080), (3840, 2160)]:
+        scene = make_fill_scene(width, height)
+        legacy = '-'
+        # The per-pixel fill needs minutes beyond VGA, only time it where it is usable
+        if width * height <= 640 * 480:
+            legacy_time = timed(lambda: legacy_flood_fill(scene.copy(), QPoint(1, 1), Qt.red), repeat=1)
+            legacy = f'{legacy_time * 1000:.1f}'
+        four = timed(lambda: fill_engine.flood_fill(scene.copy(), 1, 1, Qt.red))
+        eight = timed(lambda: fill_engine.flood_fill(scene.copy(), 1, 1, Qt.red, connectivity=8))
+        tolerant = timed(lambda: fill_engine.flood_fill(scene.copy(), 1, 1, Qt.red, tolerance=32))
+        rows.append((f'{width}x{height}', legacy, f'{four * 1000:.1f}',
+                     f'{eight * 1000:.1f}', f'{tolerant * 1000:.1f}'))
+    print_table('Flood fill (ms, best of 3)',
+                ('size', 'legacy', 'scanline 4-way', 'scanline 8-way', 'tolerance 32'), rows)
+
+
+def make_photo_scene(width, height):
+    """Smooth colour ramps with some shapes, closer to a photo than a flat canvas."""
+    image = QImage(width, height, QImage.Format_RGB32)
+    image.fill(Qt.white)
+    painter = QPainter(image)
+    for i in range(0, width, max(width // 64, 1)):
+        painter.fillRect(i, 0, max(width // 64, 1), height, QColor.fromHsv(i * 359 // width, 160, 220))
+    painter.setPen(QPen(Qt.black, 3))
+    painter.drawEllipse(QRect(width // 4, height // 4, width // 2, height // 2))
+    painter.end()
+    return image
+
+
+# The Effects menu as it was implemented with Pillow, the baseline for the filter benchmarks
+PIL_FILTERS = {
+    'blur': lambda image, factor: image.filter(ImageFilter.BLUR),
+    'sharpen': lambda image, factor: image.filter(ImageFilter.SHARPEN),
+    'grayscale': lambda image, factor: image.convert('L').convert('RGB'),
+    'invert': lambda image, factor: ImageOps.invert(image),
+    'brightness': lambda image, factor: ImageEnhance.Brightness(image).enhance(factor),
+    'contrast': lambda image, factor: ImageEnhance.Contrast(image).enhance(factor),
+}
+
+
+def pil_filter(pil_image, filter_name, factor=1.0):
+    """Applies one of the Effects menu filters to an RGB PIL image."""
+    return PIL_FILTERS[filter_name](pil_image, factor)
+
+
+def legacy_png_filter(image, filter_name, factor=1.0):
+    """The original apply_filter conversion: PNG encode, PIL decode, filter, PNG back."""
+    buffer = QBuffer()
+    buffer.open(QBuffer.ReadWrite)
+    image.save(buffer, "PNG")
+    pil_image = pil_filter(Image.open(io.BytesIO(buffer.data())), filter_name, factor)
+    data = io.BytesIO()
+    pil_image.save(data, format='PNG')
+    result = QImage()
+    result.loadFromData(data.getvalue())
+    return result
+
+
+def bridge_filter(image, filter_name, factor=1.0):
+    """The same filter with the in-memory QImage/PIL bridge."""
+    pil_image = pil_filter(image_bridge.qimage_to_pil(image), filter_name, factor)
+    return image_bridge.pil_to_qimage(pil_image, image)
+
+
+def bench_bridge():
+    """PNG round trip against the in-memory bridge, per filter and image size."""
+    rows = []
+    for width, height in [(640, 480), (1920, 1080), (3840, 2160)]:
+        scene = make_photo_scene(width, height)
+        for name in PIL_FILTERS:
+            legacy = timed(lambda: legacy_png_filter(scene, name, 1.2), repeat=2)
+            bridge = timed(lambda: bridge_filter(scene.copy(), name, 1.2), repeat=2)
+            rows.append((f'{width}x{height}', name, f'{legacy * 1000:.1f}',
+                         f'{bridge * 1000:.1f}', f'{legacy / bridge:.1f}x'))
+    print_table('Filter conversion (ms, best of 2)',
+                ('size', 'filter', 'PNG round trip', 'bridge', 'speed-up'), rows)
+
+
+def pil_chain(pil_image, chain):
+    """Runs (name, factor) filters one after the other, a full pass each."""
+    for name, factor in chain:
+        pil_image = pil_filter(pil_image, name, factor)
+    return pil_image
+
+
+def bench_filters():
+    """Pillow against the NumPy filter engine, and a fused chain against separate passes."""
+    rows = []
+    for width, height in [(1920, 1080), (3840, 2160)]:
+        rgb = image_bridge.to_rgb_array(make_photo_scene(width, height))
+        pil_image = Image.fromarray(rgb)
+        for name in PIL_FILTERS:
+            pil_time = timed(lambda: pil_filter(pil_image, name, 1.2))
+            numpy_time = timed(lambda: filter_engine.make_filter(name, 1.2).apply(rgb))
+            rows.append((f'{width}x{height}', name, f'{pil_time * 1000:.1f}', f'{numpy_time * 1000:.1f}'))
+        chain = [('brightness', 1.2), ('contrast', 1.3), ('invert', 1.0)]
+        pil_time = timed(pil_chain, pil_image, chain)
+        fused_time = timed(lambda: filter_engine.apply_filters(rgb, chain))
+        rows.append((f'{width}x{height}', 'brightness+contrast+invert',
+                     f'{pil_time * 1000:.1f}', f'{fused_time * 1000:.1f}'))
+    print_table('Effects filters (ms, best of 3)', ('size', 'filter', 'Pillow', 'NumPy engine'), rows)
+
+
+def bench_scaling():
+    """Filter throughput of the strip runner for 1, 2 and 4 worker threads."""
+    width, height = 7680, 4320
+    rgb = image_bridge.to_rgb_array(make_photo_scene(width, height))
+    megapixels = width * height / 1e6
+    # A fixed list, so the table has the same rows whatever machine runs it;
+    # more workers than cores only shows the threading overhead
+    counts = (1, 2, 4)
+    filters = [('blur', filter_engine.make_filter('blur')),
+               ('brightness+contrast+invert', filter_engine.Pipeline(
+                   [filter_engine.make_filter(name, factor)
+                    for name, factor in [('brightness', 1.2), ('contrast', 1.3), ('invert', 1.0)]]))]
+    rows = []
+    for name, image_filter in filters:
+        baseline = None
+        for workers in counts:
+            runner = filter_engine.StripRunner(workers)
+            elapsed = timed(runner.run, image_filter, rgb, repeat=2)
+            runner.shutdown()
+            baseline = baseline or elapsed
+            rows.append((name, workers, f'{elapsed * 1000:.0f}', f'{megapixels / elapsed:.1f}',
+                         f'{baseline / elapsed:.2f}x'))
+    print_table(f'Filter scaling on {width}x{height}, {filter_engine.default_workers()} cores (best of 2)',
+                ('filter', 'workers', 'ms', 'Mpx/s', 'speed-up'), rows)
+
+
+def bench_adjust():
+    """Brightness/contrast preview frames on the proxy against the full-resolution pass."""
+    rows = []
+    for width, height in [(1920, 1080), (7680, 4320)]:
+        store = TiledImage.from_qimage(make_photo_scene(width, height))
+        rgb = image_bridge.to_rgb_array(store.to_qimage())
+        for name in ('brightness', 'contrast'):
+            preview = AdjustmentPreview(store, store.rect(), name)
+            factors = iter([0.5 + i / 100 for i in range(1000)])
+            cold = timed(lambda: preview.image(next(factors)))
+            cached = timed(lambda: preview.image(0.5))
+            full = timed(lambda: filter_engine.make_filter(name, 1.2).apply(rgb), repeat=1)
+            rows.append((f'{width}x{height}', name, f'{cold * 1000:.2f}', f'{cached * 1000:.3f}',
+                         f'{full * 1000:.1f}'))
+    print_table('Adjustment preview (ms per frame)',
+                ('size', 'filter', 'proxy, new factor', 'proxy, cached', 'full resolution'), rows)
+
+
+def bench_io():
+    """Opening into tiles (memory-mapped vs decoded) and streaming saves against QImage.save."""
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        for width, height in [(1920, 1080), (7680, 4320)]:
+            scene = make_photo_scene(width, height)
+            store = TiledImage.from_qimage(scene)
+            for extension in ('ppm', 'png'):
+                path = os.path.join(directory, f'scene.{extension}')
+                qt_save = timed(lambda: store.to_qimage().save(path), repeat=1)
+                stream_save = timed(image_io.save, store, path, repeat=1)
+                target = TiledImage(width, height)
+                load = timed(image_io.read_into, target, path, repeat=1)
+                rows.append((f'{width}x{height}', extension, f'{qt_save * 1000:.0f}',
+                             f'{stream_save * 1000:.0f}', f'{load * 1000:.0f}'))
+    print_table('Image I/O (ms)', ('size', 'format', 'QImage.save', 'streamed save', 'open into tiles'), rows)
+
+
+def draw_zoomed(store, zoom, pyramid=None, size=(1200, 800), budget=None):
+    """
+    One frame of a `size` view showing the whole store at `zoom`.
+
+    With a `budget` (seconds), pyramid tiles are built that long as on the
+    canvas; returns False when some were left for a later frame.
+    """
+    frame = QImage(size[0], size[1], QImage.Format_RGB32)
+    painter = QPainter(frame)
+    painter.scale(zoom, zoom)
+    rect = QRect(0, 0, int(size[0] / zoom), int(size[1] / zoom))
+    complete = True
+    if pyramid is None:
+        store.draw(painter, rect)
+    else:
+        deadline = None if budget is None else time.perf_counter() + budget
+        complete = pyramid.draw(painter, pyramid.level_for(zoom), rect, deadline)
+    painter.end()
+    return complete
+
+
+def bench_pyramid():
+    """
+    Zoomed-out frames drawn from full resolution against the mipmap pyramid.
+
+    The full-resolution frame is nearest-neighbour sampled (aliased); the
+    pyramid levels are box-filtered.  Cold, the canvas builds pyramid tiles
+    for PYRAMID_BUILD_MS per frame and draws the rest from the finer levels,
+    so the first frame and the number of frames until the view is complete
+    are shown next to building it all at once.
+    """
+    from canvas import PYRAMID_BUILD_MS
+    budget = PYRAMID_BUILD_MS / 1000
+    width = height = 8192
+    store = TiledImage.from_qimage(make_photo_scene(width, height))
+    rows = []
+    for zoom in (0.5, 0.25, 1 / 16):
+        pyramid = Pyramid(store)
+        full = timed(draw_zoomed, store, zoom, repeat=2)
+        unbudgeted = timed(lambda: (pyramid.clear(), draw_zoomed(store, zoom, pyramid)), repeat=1)
+        pyramid.clear()
+        start = time.perf_counter()
+        complete = draw_zoomed(store, zoom, pyramid, budget=budget)
+        first = time.perf_counter() - start
+        frames = 1
+        while not complete:
+            complete = draw_zoomed(store, zoom, pyramid, budget=budget)
+            frames += 1
+        warm = timed(draw_zoomed, store, zoom, pyramid)
+        # A brush-sized edit only rebuilds the level tiles above it
+        stroke = timed(lambda: (pyramid.invalidate(QRect(4000, 4000, 40, 40)),
+                                draw_zoomed(store, zoom, pyramid, budget=budget)))
+        rows.append((f'1/{round(1 / zoom)}', pyramid.level_for(zoom), f'{full * 1000:.1f}',
+                     f'{unbudgeted * 1000:.1f}', f'{first * 1000:.1f}', frames,
+                     f'{warm * 1000:.1f}', f'{stroke * 1000:.1f}'))
+    print_table(f'Zoomed-out frame of a {width}x{height} image (ms)',
+                ('zoom', 'level', 'full resolution', 'cold, built at once', 'cold, first frame',
+                 'frames to build', 'pyramid, cached', 'after a stroke'), rows)
+
+
+def make_layer_stack(layers, width, height):
+    """A stack of `layers` layers, each partly covered with a translucent band."""
+    stack = LayerStack(width, height)
+    stack.layers[0].store.write(make_photo_scene(width, height))
+    for index in range(1, layers):
+        stack.add_layer()
+        band = QRect(0, index * height // layers, width, height // 4)
+        stack.active.store.paint(band, lambda painter: painter.fillRect(band, QColor(0, 0, 255, 40)))
+    return stack
+
+
+def layer_strokes(stack, segments, full_recomposite=False):
+    """Brush segments on the active layer, each followed by recompositing the tiles under it."""
+    pen = QPen(Qt.red, 9, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
+    for i in range(segments):
+        start, end = QPoint(100 + i * 4, 100 + i), QPoint(104 + i * 4, 110 + i)
+        rect = QRect(start, end).normalized().adjusted(-7, -7, 7, 7)
+
+        def draw(painter):
+            painter.setPen(pen)
+            painter.drawLine(start, end)
+        stack.active.store.paint(rect, draw)
+        if full_recomposite:
+            stack.invalidate(rect)
+        else:
+            stack.changed(rect)
+        for key in stack.tile_keys(rect):
+            stack.tile(key)
+
+
+def bench_layers():
+    """A stroke on the top layer, with the cached composite against flattening every layer again."""
+    width, height = 2048, 2048
+    rows = []
+    for layers in (1, 5, 20):
+        stack = make_layer_stack(layers, width, height)
+        cold = timed(stack.to_qimage, repeat=1)
+        segments = 200
+        cached = timed(layer_strokes, stack, segments)
+        full = timed(layer_strokes, stack, segments, True)
+        rows.append((layers, f'{cold * 1000:.0f}', f'{cached / segments * 1000:.3f}',
+                     f'{full / segments * 1000:.3f}'))
+    print_table(f'Brush stroke on the top layer of a {width}x{height} image',
+                ('layers', 'first composite (ms)', 'cached (ms/segment)', 'all layers (ms/segment)'), rows)
+
+
+def make_traces(width, height):
+    """Mouse sample traces: (name, [(x, y), ...]) as a recorded stroke would deliver them."""
+    cx, cy, r = width / 2, height / 2, min(width, height) / 3
+    # A fast circle: few samples per turn, far apart
+    fast = [(cx + r * math.cos(a), cy + r * math.sin(a))
+            for a in np.linspace(0, 6 * math.pi, 3 * 16 + 1)]
+    # A slow wavy line: dense samples, 2 px apart
+    slow = [(x, cy + 50 * math.sin(x / 40)) for x in np.arange(50, width - 50, 2.0)]
+    # A scribble: a random walk with momentum
+    rng = np.random.default_rng(1)
+    angle, x, y, scribble = 0.0, cx, cy, []
+    for _ in range(400):
+        angle += rng.normal(0, 0.4)
+        x = min(max(x + 12 * math.cos(angle), 0), width - 1)
+        y = min(max(y + 12 * math.sin(angle), 0), height - 1)
+        scribble.append((x, y))
+    return [('fast circle', fast), ('slow wave', slow), ('scribble', scribble)]
+
+
+def legacy_brush_line(painter, start, end, size, color):
+    """The previous brush: a new pen for every mouse move, drawn by a new painter per tile."""
+    painter.setPen(QPen(color, size, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
+    painter.drawLine(start, end)
+
+
+def curve_points(pieces, samples=16):
+    """Points along Bezier `pieces` ((n, 4, 2) control points), `samples` per piece."""
+    t = np.linspace(0.0, 1.0, samples)[:, None]
+    weights = np.hstack([(1 - t) ** 3, 3 * t * (1 - t) ** 2, 3 * t * t * (1 - t), t ** 3])
+    return (weights @ pieces).reshape(-1, 2)
+
+
+def replay_stroke(canvas, trace, per_frame, engine=True):
+    """
+    Replays `trace` as one brush stroke on `canvas`, with `per_frame` mouse moves queued per frame.
+
+    Returns the image positions the stroke was drawn through: points along
+    the engine's curves, the mouse samples for the previous line brush.
+    """
+    canvas.set_tool('brush')
+    color, size = canvas.brush_color, canvas.brush_size
+    positions = [QPoint(round(x), round(y)) for x, y in trace]
+    pieces = []
+    if engine:
+        canvas.begin_stroke(canvas.image_point(positions[0]))
+        stamp = canvas.stroke.stamp
+        canvas.stroke.stamp = lambda drawn: (pieces.append(drawn), stamp(drawn))
+    for index in range(1, len(positions)):
+        if engine:
+            canvas.queue_stroke_point(canvas.image_point(positions[index]))
+        else:
+            start, end = canvas.to_image(positions[index - 1]), canvas.to_image(positions[index])
+            canvas.apply_tool(canvas.stroke_rect(start, end, size), legacy_brush_line, start, end, size, color)
+        if index % per_frame == 0:
+            app.processEvents()  # the coalesced moves are drawn, then the frame is painted
+    if engine:
+        canvas.end_stroke()
+    app.processEvents()
+    canvas.save_to_undo_stack()
+    return curve_points(np.concatenate(pieces)) if engine else [canvas.image_point(pos) for pos in positions]
+
+
+def sharpest_turn(points):
+    """Largest change of direction (degrees) between consecutive steps of a path."""
+    steps = np.diff(np.asarray(points, float), axis=0)
+    steps = steps[np.hypot(steps[:, 0], steps[:, 1]) > 0]
+    angles = np.arctan2(steps[:, 1], steps[:, 0])
+    turns = np.abs((np.diff(angles) + math.pi) % (2 * math.pi) - math.pi)
+    return math.degrees(turns.max()) if len(turns) else 0.0
+
+
+def bench_brush():
+    """Replayed mouse traces through the previous line brush and the spline brush engine."""
+    from canvas import Canvas
+    width, height = 1600, 1200
+    canvas = Canvas()
+    canvas.resize(width, height)
+    canvas.layers.resize(QSize(width, height))
+    canvas.show()
+    canvas.brush_size = 12
+    rows = []
+    for name, trace in make_traces(width, height):
+        events = len(trace) - 1
+        row = [name, events]
+        for per_frame in (1, 4):
+            legacy = timed(replay_stroke, canvas, trace, per_frame, False)
+            engine = timed(replay_stroke, canvas, trace, per_frame)
+            row += [f'{legacy / events * 1e6:.0f}', f'{engine / events * 1e6:.0f}']
+        row += [f'{sharpest_turn(replay_stroke(canvas, trace, 4, False)):.0f}',
+                f'{sharpest_turn(replay_stroke(canvas, trace, 4)):.0f}']
+        rows.append(row)
+    print_table(f'Brush strokes from replayed traces on a {width}x{height} canvas, '
+                f'size {canvas.brush_size} (us/event incl. undo and repaint)',
+                ('trace', 'events', 'lines, 1/frame', 'engine, 1/frame', 'lines, 4/frame',
+                 'engine, 4/frame', 'sharpest turn, lines', 'sharpest turn, engine'), rows)
+
+
+def legacy_spray(canvas, pos, density):
+    """The previous spray: two random.gauss calls per particle in a Python loop, then drawPoints."""
+    radius = 3 * canvas.brush_size
+    points = []
+    for _ in range(density):
+        xo = max(-radius, min(radius, int(random.gauss(0, canvas.brush_size))))
+        yo = max(-radius, min(radius, int(random.gauss(0, canvas.brush_size))))
+        points.append(QPoint(int(pos.x() + xo), int(pos.y() + yo)))
+
+    def draw(painter):
+        painter.setPen(QPen(canvas.brush_color, 1))
+        painter.drawPoints(QPolygon(points))
+    canvas.apply_tool(canvas.stroke_rect(pos, pos, 6 * canvas.brush_size), draw)
+
+
+def replay_spray(canvas, trace, density, engine=True):
+    """Sprays one burst per mouse sample of `trace` as one stroke, painting a frame after each."""
+    canvas.set_spray_density(density)
+    for x, y in trace:
+        pos = QPoint(round(x), round(y))
+        if engine:
+            canvas.nozzle = pos
+            canvas.spray()
+        else:
+            legacy_spray(canvas, pos, density)
+        app.processEvents()
+    canvas.end_spray()
+    canvas.save_to_undo_stack()
+
+
+def bench_spray():
+    """Spray bursts along a scribble, the per-particle Python loop against batched NumPy particles."""
+    from canvas import Canvas
+    width, height = 1600, 1200
+    canvas = Canvas()
+    canvas.resize(width, height)
+    canvas.layers.resize(QSize(width, height))
+    canvas.show()
+    canvas.set_tool('spray')
+    canvas.brush_size = 12
+    trace = dict(make_traces(width, height))['scribble']
+    rows = []
+    for density in (20, 200, 1000):
+        legacy = timed(replay_spray, canvas, trace, density, False)
+        engine = timed(replay_spray, canvas, trace, density)
+        rows.append((density, f'{legacy / len(trace) * 1e6:.0f}', f'{engine / len(trace) * 1e6:.0f}'))
+    print_table(f'Spray bursts along a scribble of {len(trace)} mouse moves, size {canvas.brush_size} '
+                f'(us/event incl. undo and repaint)', ('particles/burst', 'python loop', 'numpy'), rows)
+
+
+SESSION_SIZE = (1000, 750)
+
+
+def make_session(kind):
+    """A scripted editing session of one kind, recorded on a SESSION_SIZE canvas."""
+    width, height = SESSION_SIZE
+    session = Session(SESSION_SIZE)
+    traces = dict(make_traces(width, height))
+    t = 0
+    if kind in ('brush', 'undo'):
+        session.state(t, tool='brush', brush_size=8)
+        for name in ('scribble', 'slow wave', 'fast circle', 'scribble'):
+            t = session.stroke(t, traces[name]) + 200
+        if kind == 'undo':
+            for command in ['undo'] * 4 + ['redo'] * 4 + ['undo'] * 4:
+                t += 100
+                session.command(t, command)
+    elif kind == 'spray':
+        session.state(t, tool='spray', brush_size=12, spray_density=200, spray_flow=30)
+        points = traces['scribble']
+        x, y = points[0]
+        session.mouse(t, 'press', x, y)
+        for index, (x, y) in enumerate(points[1:], 1):
+            t += 8
+            session.mouse(t, 'move', x, y, Qt.NoButton, Qt.LeftButton)
+            if index % 4 == 0:
+                session.command(t, 'spray')  # the flow timer, every 33 ms
+        session.mouse(t, 'release', x, y, Qt.LeftButton, Qt.NoButton)
+    elif kind == 'fill':
+        session.state(t, tool='rectangle', brush_size=3)
+        for i in range(4):
+            t = session.stroke(t, [(100 + 200 * i, 100), (250 + 200 * i, 600)]) + 100
+        session.state(t, tool='fill', fill_tolerance=16)
+        for i in range(20):
+            session.state(t, primary=QColor.fromHsv(18 * i, 200, 220).rgba())
+            x = 175 + 200 * (i % 4) if i % 5 else 50
+            t = session.stroke(t, [(x, 350 + i)]) + 150
+    elif kind == 'shapes':
+        for i, tool in enumerate(['line', 'rectangle', 'circle'] * 4):
+            session.state(t, tool=tool, brush_size=2 + i)
+            start = (100 + 60 * i, 80 + 40 * i)
+            drag = [(start[0] + 12 * step, start[1] + 8 * step) for step in range(30)]
+            t = session.stroke(t, [start] + drag) + 150
+    elif kind == 'filters':
+        session.state(t, tool='brush', brush_size=20)
+        t = session.stroke(t, traces['scribble']) + 200
+        for name, factor in (('invert', 1.0), ('grayscale', 1.0), ('blur', 1.0), ('brightness', 1.2)):
+            t += 500
+            session.command(t, 'filter', name, factor)
+    return session
+
+
+def bench_replay():
+    """Scripted sessions replayed through the canvas event handlers on several canvas sizes."""
+    rows = []
+    for kind in ('brush', 'spray', 'fill', 'shapes', 'undo', 'filters'):
+        session = make_session(kind)
+        # A round trip through the file format, as a recorded session would take
+        path = os.path.join(tempfile.mkdtemp(), f'{kind}.session.gz')
+        session.save(path)
+        session = Session.load(path)
+        for size in ((800, 600), (1920, 1080), (3840, 2160)):
+            stats = replay(session, size)
+            rows.append((kind, f'{size[0]}x{size[1]}', len(stats.latencies),
+                         f'{stats.percentile(50) * 1000:.2f}', f'{stats.percentile(95) * 1000:.2f}',
+                         f'{stats.percentile(99) * 1000:.2f}', f'{stats.total:.2f}',
+                         f'{stats.peak_bytes / 2 ** 20:.0f}'))
+    print_table('Replayed sessions (event latency = dispatch to end of its frame)',
+                ('session', 'canvas', 'events', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'total (s)',
+                 'peak RSS growth (MB)'), rows)
+
+
+def bench_profiler():
+    """Cost of the profiler's instrumentation, switched off and on."""
+    def bare():
+        pass
+    instrumented = timed_section('bench')(bare)
+    calls = 200000
+
+    def call(func):
+        for _ in range(calls):
+            func()
+    base = timed(call, bare)
+    rows = []
+    for state in ('off', 'on'):
+        if state == 'on':
+            profiler.enable()
+        rows.append((state, f'{(timed(call, instrumented) - base) / calls * 1e9:.0f}'))
+        profiler.disable()
+    print_table(f'@timed overhead over a bare call ({calls} calls)', ('profiling', 'ns/call'), rows)
+
+    session = make_session('brush')
+    rows = []
+    for state in ('off', 'on'):
+        if state == 'on':
+            profiler.reset()
+            profiler.enable()
+        stats = min((replay(session, (1920, 1080)) for _ in range(3)), key=lambda stats: stats.total)
+        profiler.disable()
+        rows.append((state, f'{stats.total * 1000:.0f}', f'{stats.percentile(95) * 1000:.2f}'))
+    print_table('Brush session replayed at 1920x1080 (best of 3)', ('profiling', 'total (ms)', 'p95 (ms)'), rows)
+    profiler.reset()
+
+
+def bench_project():
+    """Saving after a small edit: the whole image as PNG against appending to a project file."""
+    rows = []
+    directory = tempfile.mkdtemp()
+    for side in (1024, 4096):
+        stack = make_layer_stack(3, side, side)
+        project = ProjectFile(os.path.join(directory, f'{side}.ppe'))
+        checkpoint = project.diff(stack)
+        start = time.perf_counter()
+        project.commit(checkpoint, *project.write(checkpoint))
+        checkpoint_time = time.perf_counter() - start
+        png_path = os.path.join(directory, f'{side}.png')
+        png_time = timed(image_io.save, stack, png_path, repeat=1)
+        # One short line on the top layer, then a save
+        layer_strokes(stack, 1)
+        start = time.perf_counter()
+        save = project.diff(stack)
+        end, written = project.write(save)
+        project.commit(save, end, written)
+        append_time = time.perf_counter() - start
+        load_time = timed(load_project, project.path, repeat=1)
+        rows.append((f'{side}x{side}, 3 layers', f'{os.path.getsize(png_path) / 1024:.0f}',
+                     f'{png_time * 1000:.0f}', f'{project.checkpoint_bytes / 1024:.0f}',
+                     f'{checkpoint_time * 1000:.0f}', written, f'{append_time * 1000:.1f}',
+                     f'{load_time * 1000:.0f}'))
+    print_table('Saving after one brush segment',
+                ('image', 'PNG (KB)', 'PNG (ms)', 'checkpoint (KB)', 'checkpoint (ms)', 'append (bytes)',
+                 'append (ms)', 'open project (ms)'), rows)
+
+
+def filter_on_canvas(canvas, filter_name, selection):
+    canvas.set_selection(selection)
+    canvas.apply_filter(filter_name)
+    canvas.jobs.join()
+    app.processEvents()
+
+
+def bench_selection():
+    """A blur limited to a 200x200 selection against the whole frame, as the canvas runs it."""
+    from canvas import Canvas
+    rows = []
+    for side in (4096, 10000):
+        canvas = Canvas()
+        canvas.resize(800, 600)
+        canvas.layers.resize(QSize(side, side))
+        canvas.store.write(make_photo_scene(1024, 1024), QPoint(side // 2 - 512, side // 2 - 512))
+        bounds = canvas.store.rect()
+        center = QPoint(side // 2, side // 2)
+        selections = [
+            ('rectangle 200x200', Selection.from_rect(QRect(center, QSize(200, 200)), bounds)),
+            ('lasso in 200x200', Selection.from_polygon(
+                [center + QPoint(round(100 + 100 * math.cos(a)), round(100 + 100 * math.sin(a)))
+                 for a in np.linspace(0, 2 * math.pi, 40, endpoint=False)], bounds)),
+        ]
+        if side <= 4096:
+            selections.append(('none (whole frame)', None))  # 10000x10000 needs gigabytes unselected
+        for name, selection in selections:
+            elapsed = timed(filter_on_canvas, canvas, 'blur', selection, repeat=2)
+            pixels = bounds.width() * bounds.height() if selection is None else \
+                selection.rect.width() * selection.rect.height()
+            rows.append((f'{side}x{side}', name, pixels, f'{elapsed * 1000:.1f}'))
+        canvas.jobs.shutdown()
+        canvas.saves.shutdown()
+        canvas.deleteLater()
+    print_table('Blur with a selection (ms, best of 2, including the undo step)',
+                ('canvas', 'selection', 'pixels filtered', 'ms'), rows)
+
+
+def distinct_tile_bytes(*tile_dicts):
+    """Bytes of the distinct pixel buffers among the tiles of `tile_dicts` (shared tiles count once)."""
+    buffers = {}
+    for tiles in tile_dicts:
+        for tile in tiles.values():
+            buffers[tile.cacheKey()] = tile.byteCount()
+    return sum(buffers.values())
+
+
+def bench_snapshot():
+    """Copy-on-write tile snapshots against full copies: time to take them and memory they keep."""
+    rows = []
+    for side in (2048, 4096):
+        stack = make_layer_stack(1, side, side)
+        store = stack.active.store
+        image_bytes = distinct_tile_bytes(store.tiles)
+        copy_time = timed(store.copy)
+        snapshot_time = timed(store.snapshot)
+        # Ten edits, each a brush segment followed by a snapshot (an undo step, a save or a filter job)
+        snapshots = []
+        for _ in range(10):
+            layer_strokes(stack, 1)
+            snapshots.append(store.snapshot()[3])
+        shared = distinct_tile_bytes(store.tiles, *snapshots) - image_bytes
+        rows.append((f'{side}x{side}', f'{copy_time * 1000:.1f}', f'{snapshot_time * 1000:.2f}',
+                     f'{10 * image_bytes / 2 ** 20:.0f}', f'{shared / 2 ** 20:.2f}'))
+    print_table('Taking 10 snapshots, one per brush segment',
+                ('image', 'full copy (ms)', 'snapshot (ms)', '10 full copies (MB)', '10 snapshots (MB)'), rows)
+
+    # An undo step whose edit may touch the whole image but changes one tile
+    rows = []
+    for side in (2048, 4096):
+        stack = make_layer_stack(1, side, side)
+        store = stack.active.store
+
+        def edit(eager):
+            history = History()
+            history.touch(store, store.rect())
+            if eager:
+                # Every touched tile compressed up front, as the history used to
+                for patch in history._pending.values():
+                    patch.compress()
+            layer_strokes(stack, 1)
+            history.commit(stack)
+        rows.append((f'{side}x{side}', len(store.tiles), f'{timed(edit, True) * 1000:.0f}',
+                     f'{timed(edit, False) * 1000:.1f}'))
+    print_table('Undo step touching the whole image, one tile changed (ms, best of 3)',
+                ('image', 'tiles', 'compress on touch', 'copy-on-write'), rows)
+
+
+def draw_text_directly(image, font, pos, text):
+    """The text tool before the glyph atlas: every line laid out and drawn by Qt each time."""
+    painter = QPainter(image)
+    painter.setFont(font)
+    painter.setPen(Qt.black)
+    spacing = painter.fontMetrics().lineSpacing()
+    for index, line in enumerate(text.split('\n')):
+        painter.drawText(pos + QPoint(0, index * spacing), line)
+    painter.end()
+
+
+def draw_text_cached(image, font, pos, text):
+    painter = QPainter(image)
+    text_engine.atlas(font, Qt.black).draw(painter, pos, text)
+    painter.end()
+
+
+def bench_text():
+    """Dragging and live-editing a block of text: Qt text layout every frame against the glyph atlas."""
+    font = QFont('DejaVu Sans', 14)
+    block = '\n'.join(f'The quick brown fox jumps over the lazy dog, line {i}' for i in range(40))
+    image = QImage(1920, 1080, QImage.Format_RGB32)
+    image.fill(Qt.white)
+    rows = []
+    for name, draw in [('Qt drawText', draw_text_directly), ('glyph atlas', draw_text_cached)]:
+        text_engine._atlases.clear()
+        # A drag: the same block drawn at 60 positions
+        drag = timed(lambda: [draw(image, font, QPoint(100 + i, 200 + i), block) for i in range(60)], repeat=1)
+        # Live editing: the block typed one character at a time (a frame per keystroke)
+        typing = timed(lambda: [draw(image, font, QPoint(100, 200), block[:n]) for n in range(1, 400)], repeat=1)
+        rows.append((name, f'{drag / 60 * 1000:.2f}', f'{typing / 399 * 1000:.2f}'))
+    print_table(f'Text tool frames, {len(block)} characters in 40 lines (ms per frame)',
+                ('renderer', 'drag', 'typing'), rows)
+
+
+def longest_band(row):
+    """Length of the longest run of identical pixels in `row`."""
+    edges = np.flatnonzero(np.any(np.diff(row, axis=0) != 0, axis=1))
+    return int(np.diff(np.concatenate(([-1], edges, [len(row) - 1]))).max())
+
+
+def bench_gradient():
+    """Gradient fills: QPainter's QGradient against the vectorised engine, banding and preview cost."""
+    size = 4096
+    rect = QRect(0, 0, size, size)
+    start, end = QPoint(size // 2, size // 2), QPoint(size - 1, size // 2)
+    stops = gradient_engine.ramp_stops('rainbow', Qt.black, Qt.white)
+    ramp = gradient_engine.ramp(stops)
+    image = QImage(size, size, QImage.Format_ARGB32_Premultiplied)
+    tiles = [QRect(x, y, TILE_SIZE, TILE_SIZE) for y in range(0, size, TILE_SIZE) for x in range(0, size, TILE_SIZE)]
+    rows = []
+    for kind in gradient_engine.KINDS:
+        # Without dithering the tool commits through QPainter
+        def fill_qt():
+            painter = QPainter(image)
+            painter.fillRect(rect, gradient_engine.qgradient(kind, start, end, stops))
+            painter.end()
+        qt = timed(fill_qt, repeat=1)
+        plain = timed(gradient_engine.render, rect, kind, start, end, ramp, False, repeat=1)
+        # With dithering it commits one tile at a time, as the canvas does
+        dithered = timed(lambda: [gradient_engine.render(tile, kind, start, end, ramp, True) for tile in tiles],
+                         repeat=1)
+        rows.append((kind, f'{qt * 1000:.0f}', f'{plain * 1000:.0f}', f'{dithered * 1000:.0f}'))
+    print_table(f'Gradient fill, {size}x{size} (ms)',
+                ('kind', 'QPainter (no dither)', 'engine', 'engine + dither, per tile'), rows)
+
+    # A subtle ramp stretched over the width: 20 grey levels over 4096 pixels
+    subtle = gradient_engine.ramp([(0.0, QColor(40, 40, 40)), (1.0, QColor(60, 60, 60))])
+    line = QRect(0, 0, size, 8)
+    rows = []
+    for dither in (False, True):
+        pixels = image_bridge.to_rgb_array(gradient_engine.render(line, 'linear', QPoint(0, 0), QPoint(size - 1, 0),
+                                                                  subtle, dither))
+        rows.append(('on' if dither else 'off', longest_band(pixels[4]), f'{pixels[..., 0].mean():.2f}'))
+    print_table(f'Banding of a 40-60 grey ramp over {size} pixels', ('dither', 'longest band (px)', 'mean'), rows)
+
+    # Dragging over the whole image: a coarse frame against the full-resolution one
+    coarse_scale = math.sqrt(size * size / (160 * 120))
+    coarse = timed(gradient_engine.render, rect, 'radial', start, end, ramp, True, coarse_scale)
+    full = timed(gradient_engine.render, rect, 'radial', start, end, ramp, True, repeat=1)
+    print_table('Radial gradient preview frame (ms)', ('frame', 'ms'),
+                [('coarse (while dragging)', f'{coarse * 1000:.2f}'), ('full resolution', f'{full * 1000:.0f}')])
+
+
+def random_shapes(count, size, rng):
+    """`count` small shapes of every kind scattered over a size x size image."""
+    shapes = []
+    for _ in range(count):
+        kind = rng.choice(SHAPE_KINDS)
+        x, y = rng.randrange(size - 60), rng.randrange(size - 60)
+        corners = 3 if kind == 'polygon' else 2
+        points = [QPoint(x + rng.randrange(60), y + rng.randrange(60)) for _ in range(corners)]
+        shapes.append(Shape(kind, points, QColor(rng.randrange(256), 0, 0), rng.choice((1, 3, 5))))
+    return shapes
+
+
+def bench_vector():
+    """Vector layers: hit-testing and redrawing after an edit, grid index against scanning every shape."""
+    size = 4096
+    rng = random.Random(7)
+    rows = []
+    for count in (1000, 10000, 50000):
+        shapes = random_shapes(count, size, rng)
+        vector = VectorLayer()
+        build = timed(lambda: [vector.put(shape_id, shape) for shape_id, shape in enumerate(shapes)], repeat=1)
+        clicks = [QPoint(rng.randrange(size), rng.randrange(size)) for _ in range(50)]
+        indexed = timed(lambda: [vector.shape_at(pos, 4) for pos in clicks], repeat=1)
+
+        def scan(pos):
+            for shape_id in range(len(shapes) - 1, -1, -1):
+                shape = shapes[shape_id]
+                if shape.rect.adjusted(-4, -4, 4, 4).contains(pos) and shape.hit(pos, 4):
+                    return shape_id
+            return None
+        scanned = timed(lambda: [scan(pos) for pos in clicks], repeat=1)
+
+        # Moving one shape: the shapes under its old and new place, or every shape
+        store = TiledImage(size, size, Qt.transparent, QImage.Format_ARGB32_Premultiplied)
+        moved = shapes[count // 2]
+        dirty = moved.rect.united(moved.rect.translated(40, 40))
+        partial = timed(vector.rasterize, store, dirty)
+        full = timed(vector.rasterize, store, store.rect(), repeat=1)
+        rows.append((count, f'{build * 1000:.0f}', f'{indexed / len(clicks) * 1000:.3f}',
+                     f'{scanned / len(clicks) * 1000:.2f}', f'{partial * 1000:.2f}', f'{full * 1000:.0f}'))
+    print_table(f'Vector layer, {size}x{size} (ms)',
+                ('shapes', 'index build', 'hit-test (grid)', 'hit-test (scan)', 'redraw after a move',
+                 'redraw everything'), rows)
+
+
+BENCHMARKS = {
+    'fill': bench_fill,
+    'bridge': bench_bridge,
+    'filters': bench_filters,
+    'scaling': bench_scaling,
+    'adjust': bench_adjust,
+    'io': bench_io,
+    'pyramid': bench_pyramid,
+    'layers': bench_layers,
+    'brush': bench_brush,
+    'spray': bench_spray,
+    'replay': bench_replay,
+    'profiler': bench_profiler,
+    'project': bench_project,
+    'selection': bench_selection,
+    'snapshot': bench_snapshot,
+    'text': bench_text,
+    'gradient': bench_gradient,
+    'vector': bench_vector,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit(f'Unknown benchmark: {name} (available: {", ".join(BENCHMARKS)})')
+        BENCHMARKS[name]()
@@ -0,0 +1,200 @@
+"""
+Brush engine for the brush and eraser tools.
+
+A stroke follows a Catmull-Rom spline through the mouse samples, so fast
+strokes come out as curves instead of straight segments between sparse
+samples.  Every spline segment is exactly a cubic Bezier curve, and a hard
+round brush dragged along it covers what a round pen stroking that curve
+covers, so each batch of segments is drawn as one QPainterPath per tile:
+a few Qt calls however long the segments are.  A click without movement
+stamps one dab (an antialiased disc pre-rendered once per size, colour
+and sub-pixel offset).  Each tile the stroke crosses gets one painter,
+opened at its first piece and kept until the stroke ends.
+
+The canvas feeds samples in batches, since mouse moves are coalesced
+until the event queue is empty.  add_points() turns a batch into curve
+pieces, the canvas records their bounds() for undo, and stamp() draws
+them.
+"""
+import math
+from collections import OrderedDict
+
+import numpy as np
+from PyQt5.QtCore import Qt, QPointF, QRect, QRectF
+from PyQt5.QtGui import QColor, QImage, QPainter, QPainterPath, QPen
+
+SUBPIXEL_STEPS = 4  # dabs are pre-rendered at this many sub-pixel offsets per axis
+DAB_CACHE_SIZE = 8  # brushes (size and colour) whose dabs are kept
+
+_dab_cache = OrderedDict()
+
+
+def dabs(size, color):
+    """
+    Antialiased discs of diameter `size` in `color` on transparency, cached by size and colour.
+
+    Item [fy * SUBPIXEL_STEPS + fx] is shifted right/down by (fx, fy) /
+    SUBPIXEL_STEPS of a pixel, so dabs land at sub-pixel positions.
+    """
+    color = QColor(color)
+    key = (size, color.rgba())
+    images = _dab_cache.get(key)
+    if images is None:
+        side = int(math.ceil(size)) + 3
+        images = []
+        for fy in range(SUBPIXEL_STEPS):
+            for fx in range(SUBPIXEL_STEPS):
+                image = QImage(side, side, QImage.Format_ARGB32_Premultiplied)
+                image.fill(Qt.transparent)
+                painter = QPainter(image)
+                painter.setRenderHint(QPainter.Antialiasing)
+                painter.setPen(Qt.NoPen)
+                painter.setBrush(color)
+                painter.drawEllipse(QRectF((side - size) / 2 + fx / SUBPIXEL_STEPS,
+                                           (side - size) / 2 + fy / SUBPIXEL_STEPS, size, size))
+                painter.end()
+                images.append(image)
+        _dab_cache[key] = images
+        if len(_dab_cache) > DAB_CACHE_SIZE:
+            _dab_cache.popitem(last=False)
+    else:
+        _dab_cache.move_to_end(key)
+    return images
+
+
+def _bezier(p0, p1, p2, p3):
+    """Bezier control points of the Catmull-Rom segment from p1 to p2 (plain floats: it runs per mouse move)."""
+    return (p1, (p1[0] + (p2[0] - p0[0]) / 6, p1[1] + (p2[1] - p0[1]) / 6),
+            (p2[0] - (p3[0] - p1[0]) / 6, p2[1] - (p3[1] - p1[1]) / 6), p2)
+
+
+class BrushStroke:
+    """
+    One brush or eraser stroke on a TiledImage, from mouse press to release.
+
+    The stroke is handed out in pieces: (n, 4, 2) arrays of cubic Bezier
+    control points, where a piece with all four points equal is a single dab.
+    """
+
+    def __init__(self, store, size, color, erase=False, selection=None):
+        self.store = store
+        self.selection = selection  # selection.Selection the stroke is clipped to, or None
+        self.size = max(size, 1)
+        self.mode = QPainter.CompositionMode_SourceOver
+        if not erase:
+            ink = color
+        elif store.background.alpha() == 255:
+            ink = store.background
+        else:
+            # A transparent layer is erased by cutting the stroke out of its alpha
+            ink = Qt.black
+            self.mode = QPainter.CompositionMode_DestinationOut
+        self.dabs = dabs(self.size, ink)
+        self.pen = QPen(QColor(ink), self.size, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
+        self.points = []  # the last samples, as many as the next spline segment needs
+        self.painters = {}  # tile key -> (tile, painter), open until end()
+        self.stamped = 0
+        self._curved = None  # (pieces, path, dots) of the last _curves() call
+
+    def add_points(self, points):
+        """Takes new samples (x, y); returns the pieces they complete."""
+        pieces = []
+        for point in points:
+            point = (float(point[0]), float(point[1]))
+            if self.points and point == self.points[-1]:
+                continue
+            self.points.append(point)
+            if len(self.points) == 1:
+                pieces.append([point] * 4)  # the stroke starts with a dab
+            elif len(self.points) == 3:
+                first, second, third = self.points
+                pieces.append(_bezier(first, first, second, third))
+            elif len(self.points) == 4:
+                # A segment is drawn once the sample after its end is known
+                pieces.append(_bezier(*self.points))
+                del self.points[0]
+        return np.array(pieces, float).reshape(-1, 4, 2)
+
+    def finish(self):
+        """The pieces of the last segment, which has no sample after it."""
+        if len(self.points) == 2:
+            first, last = self.points
+            return np.array([_bezier(first, first, last, last)])
+        if len(self.points) == 3:
+            before, first, last = self.points
+            return np.array([_bezier(before, first, last, last)])
+        return np.empty((0, 4, 2))
+
+    def _curves(self, pieces):
+        """The curve pieces as one QPainterPath, and the (x, y) of the dab pieces."""
+        # bounds() and stamp() get the same pieces in turn
+        if self._curved is not None and self._curved[0] is pieces:
+            return self._curved[1:]
+        path = QPainterPath()
+        dots = []
+        for start, first, second, end in pieces.tolist():
+            if start == first == second == end:
+                dots.append(start)
+                continue
+            if path.isEmpty() or path.currentPosition() != QPointF(*start):
+                path.moveTo(*start)
+            path.cubicTo(*first, *second, *end)
+        self._curved = (pieces, path, dots)
+        return path, dots
+
+    def _outset(self, rect):
+        # Covers the pen (or dab) around the centre line, plus a pixel of antialiasing
+        half = self.dabs[0].width() / 2 + 1
+        return rect.adjusted(-half, -half, half, half).toAlignedRect()
+
+    def bounds(self, pieces):
+        """Image area covered by `pieces`."""
+        path, dots = self._curves(pieces)
+        # Exact for the curves, which can stay well inside their control points
+        area = path.boundingRect()
+        for x, y in dots:
+            area = area.united(QRectF(x, y, 1, 1))
+        return self._outset(area)
+
+    def stamp(self, pieces):
+        """Draws `pieces`."""
+        path, dots = self._curves(pieces)
+        for x, y in dots:
+            self._stamp_dab(x, y)
+        if not path.isEmpty():
+            for key in self.store.tile_keys(self._outset(path.boundingRect()).intersected(self._area())):
+                self._painter(key).drawPath(path)
+        self.stamped += len(pieces)
+
+    def _area(self):
+        # Only the tiles under the selection (or the image) get painters
+        return self.store.rect() if self.selection is None else self.selection.rect
+
+    def _stamp_dab(self, x, y):
+        image = self.dabs[0]
+        x -= image.width() / 2
+        y -= image.height() / 2
+        left, top = math.floor(x), math.floor(y)
+        image = self.dabs[int((y - top) * SUBPIXEL_STEPS) * SUBPIXEL_STEPS + int((x - left) * SUBPIXEL_STEPS)]
+        for key in self.store.tile_keys(QRect(left, top, image.width(), image.height()).intersected(self._area())):
+            self._painter(key).drawImage(left, top, image)
+
+    def _painter(self, key):
+        entry = self.painters.get(key)
+        if entry is None:
+            tile = self.store.ensure_tile(key)
+            painter = QPainter(tile)
+            painter.translate(-self.store.tile_rect(key).topLeft())
+            painter.setCompositionMode(self.mode)
+            painter.setRenderHint(QPainter.Antialiasing)
+            painter.setPen(self.pen)
+            if self.selection is not None:
+                painter.setClipRegion(self.selection.region())
+            entry = self.painters[key] = (tile, painter)
+        return entry[1]
+
+    def end(self):
+        """Closes the painters; the stroke's pixels are final after this."""
+        for _, painter in self.painters.values():
+            painter.end()
+        self.painters = {}
@@ -1,11 +1,172 @@
-from PyQt5.QtWidgets import QWidget, QInputDialog, QFontDialog, QFileDialog
-from PyQt5.QtCore import Qt, QPoint, QBuffer, QRect
-from PyQt5.QtGui import QPainter, QPen, QImage, QColor, QBrush, QFont, QLinearGradient, QPolygon
-import random
-from PIL import Image, ImageEnhance, ImageFilter, ImageOps
-from PyQt5.QtWidgets import QInputDialog
+from PyQt5.QtWidgets import QWidget, QFileDialog, QDialog
+from PyQt5.QtCore import Qt, QPoint, QPointF, QRect, QRectF, QTimer
+from PyQt5.QtGui import QPainter, QPen, QBrush, QImage, QColor, QFont, QPolygon
+import math
+import os
+import time
 import numpy as np
-import io
+from adjustments import ADJUSTMENTS, AdjustmentDialog, AdjustmentPreview
+from brush_engine import BrushStroke
+import fill_engine
+import filter_engine
+import gradient_engine
+import image_bridge
+import image_io
+from history import History
+from jobs import Job, JobScheduler
+from layers import LayerStack
+from profiler import profiler, section, timed
+import project_io
+from pyramid import Pyramid
+from selection import Selection
+import spray_engine
+import text_engine
+from text_engine import TextDialog, TextObject
+from tile_store import TiledImage
+from vector_layer import Shape
+
+SHAPE_TOOLS = ["line", "rectangle", "circle", "gradient", "selection"]
+PIXEL_TOOLS = ["brush", "eraser", "spray", "fill", "text", "gradient"]  # not available on vector layers
+MIN_ZOOM = 1 / 64
+MAX_ZOOM = 32
+ZOOM_STEP = 1.25
+VIEW_BACKGROUND = QColor(128, 128, 128)  # around the image when zoomed out or panned
+PROFILE_OVERLAY_RECT = QRect(4, 4, 420, 150)  # widget area of the profiler overlay
+MAX_TEXT_OBJECTS = 64  # placed texts that stay movable and editable
+GRADIENT_PREVIEW_PIXELS = 160 * 120  # pixels rendered for the gradient preview while the mouse moves
+GRADIENT_REFINE_MS = 150  # the preview is rendered in full detail once the mouse rests this long
+SHAPE_HIT_TOLERANCE = 4  # screen pixels a click on a vector shape may miss its stroke by
+PYRAMID_BUILD_MS = 8  # a zoomed-out frame builds pyramid tiles this long, later frames build the rest
+
+class RepaintCounter:
+    """Counts the pixels repainted by Canvas.paintEvent, per frame and in total."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.pixels = 0
+        self.last_frame_pixels = 0
+
+    def record(self, rect):
+        self.frames += 1
+        self.last_frame_pixels = rect.width() * rect.height()
+        self.pixels += self.last_frame_pixels
+
+    def average(self):
+        return self.pixels / self.frames if self.frames else 0.0
+
+    def summary(self):
+        return (f'Repaints: {self.frames} frames, last {self.last_frame_pixels} px, '
+                f'average {self.average():.0f} px/frame')
+
+
+class FilterJob(Job):
+    """Runs one Effects filter over a copy of the active layer (or of its selection) in the background."""
+
+    def __init__(self, canvas, filter_name, factor=1.0, on_done=None):
+        super().__init__()
+        self.canvas = canvas
+        self.name = filter_name
+        self.filter = filter_engine.make_filter(filter_name, factor)
+        self.on_done = on_done
+
+    @timed('filter.prepare')
+    def prepare(self):
+        self.store = self.canvas.store
+        selection = self.canvas.selection
+        # Only the selection's bounding rectangle is filtered, read with the pixels the filter needs around it
+        self.rect = self.store.rect() if selection is None else selection.rect.intersected(self.store.rect())
+        self.mask = None if selection is None or selection.bits is None else selection.mask(self.rect)
+        margin = self.filter.radius
+        self.source_rect = self.rect.adjusted(-margin, -margin, margin, margin).intersected(self.store.rect())
+        # Only tile handles are copied here; the pixels are read on the worker thread
+        self.source = TiledImage.from_snapshot(self.store.snapshot(self.source_rect), self.store.tile_size)
+        self.revision = self.canvas.history.revision
+
+    def run(self, progress):
+        with section(f'filter.{self.name}'):
+            self.image = self.source.copy(self.source_rect)
+            self.source = None
+            if self.image.hasAlphaChannel():
+                # Filters see straight colours; the alpha channel is kept as it is
+                self.image = self.image.convertToFormat(QImage.Format_ARGB32)
+            self.rgb = image_bridge.to_rgb_array(self.image)
+            return self.canvas.filter_runner.run(self.filter, self.rgb, progress)
+
+    @timed('filter.apply')
+    def finish(self, result):
+        self.canvas.finish_filter(self, result)
+
+
+class SaveJob(Job):
+    """Encodes a copy-on-write snapshot of the canvas to a file in the background."""
+
+    def __init__(self, canvas, file_path, on_done=None, message='Obraz został zapisany.',
+                 png_level=image_io.PNG_COMPRESSION):
+        super().__init__()
+        self.canvas = canvas
+        self.name = 'save'
+        self.file_path = file_path
+        self.on_done = on_done
+        self.message = message
+        self.png_level = png_level
+
+    @timed('io.snapshot')
+    def prepare(self):
+        # Only tile handles are copied; Qt duplicates a tile when the canvas paints on it.
+        # The layers are flattened on the worker thread.
+        self.store = LayerStack.from_snapshot(self.canvas.layers.snapshot())
+        self.revision = self.canvas.history.revision
+
+    @timed('io.save')
+    def run(self, progress):
+        # Write next to the target first, so an interrupted save never leaves a broken file
+        root, extension = os.path.splitext(self.file_path)
+        partial = root + '.saving' + extension
+        if not image_io.save(self.store, partial, self.png_level):
+            raise IOError(f'Cannot save {self.file_path}')
+        os.replace(partial, self.file_path)
+
+    def finish(self, result):
+        self.canvas.saved_revision = self.revision
+        if self.on_done:
+            self.on_done(self.message)
+
+
+class ProjectSaveJob(Job):
+    """Writes the tiles changed since the last save to a project file (.ppe) in the background."""
+
+    def __init__(self, canvas, file_path, on_done=None, message='Projekt został zapisany.'):
+        super().__init__()
+        self.canvas = canvas
+        self.name = 'save'
+        self.file_path = file_path
+        self.on_done = on_done
+        self.message = message
+
+    @timed('io.snapshot')
+    def prepare(self):
+        # Saving to another file starts a new project there, with a checkpoint
+        project = self.canvas.project
+        if project is None or project.path != self.file_path:
+            project = project_io.ProjectFile(self.file_path)
+        self.project = project
+        self.save = project.diff(self.canvas.layers)
+        self.revision = self.canvas.history.revision
+
+    @timed('io.save')
+    def run(self, progress):
+        return self.project.write(self.save, progress)
+
+    def finish(self, result):
+        self.project.commit(self.save, *result)
+        self.canvas.project = self.project
+        self.canvas.saved_revision = self.revision
+        if self.on_done:
+            self.on_done(self.message)
+
 
 class Canvas(QWidget):
     def __init__(self):
@@ -14,14 +175,34 @@ class Canvas(QWidget):
         self.primary_color = Qt.black
         self.secondary_color = Qt.white
         self.brush_color = self.primary_color
+        self.history = History()
+        self.filter_workers = None  # None: one filter thread per CPU core
+        self.filter_runner = filter_engine.StripRunner()
+        self.jobs = JobScheduler(self)
+        # The canvas takes no input while a filter works on a copy of its pixels
+        self.jobs.started.connect(lambda job: self.setEnabled(False))
+        for signal in (self.jobs.finished, self.jobs.cancelled, self.jobs.failed):
+            signal.connect(self.on_job_ended)
+        # Saves run on their own queue, so drawing and filters never wait for them
+        self.saves = JobScheduler(self)
+        self.saved_revision = self.history.revision
+        self.project = None  # project_io.ProjectFile of the project last opened or saved
+        self.autosave_path = None
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.timeout.connect(self.autosave)
         self.init_canvas()
-        self.undo_stack = []
-        self.redo_stack = []
-        self.save_to_undo_stack()
 
     def init_canvas(self):
-        self.image = QImage(self.size(), QImage.Format_RGB32)
-        self.image.fill(Qt.white)
+        self.layers = LayerStack(self.width(), self.height())
+        self.pyramid = Pyramid(self.layers)
+        self.pyramid_timer = QTimer(self)  # paints again while pyramid tiles are left to build
+        self.pyramid_timer.setSingleShot(True)
+        self.pyramid_timer.timeout.connect(self.update)
+        self.zoom = 1.0
+        self.offset = QPointF(0, 0)  # widget position of the image's top-left corner
+        self.space_held = False
+        self.pan_anchor = None  # widget position where the current pan started
+        self.setFocusPolicy(Qt.StrongFocus)
         self.last_point = QPoint()
         self.drawing = False
         
@@ -30,12 +211,47 @@ class Canvas(QWidget):
         self.brush_color = self.primary_color
         self.current_tool = "brush"
         self.start_pos = None
-        self.temp_image = None
+        self.preview = None  # (tool, start, end) of the shape being dragged
+        self.selection = None  # Selection the tools and filters are limited to; None: the whole image
+        self.lasso_points = []  # image points of the lasso being drawn
         self.text_font = QFont('Arial', 12)
+        self.text_objects = []  # TextObjects that can still be moved or edited, oldest first
+        self.text_preview = None  # (TextObject being replaced or None, pos, text, font, color) shown over the image
+        self.text_drag = None  # (TextObject, press position) while a placed text is dragged
+        self.fill_tolerance = 0
+        self.fill_connectivity = 4
+        self.gradient_kind = 'linear'
+        self.gradient_ramp = 'color to transparent'
+        self.gradient_dither = True
+        self.gradient_coarse = False  # the gradient preview is being dragged: render it coarsely
+        self.gradient_cache = None  # (key, QImage) of the last gradient preview rendered
+        self.gradient_timer = QTimer(self)
+        self.gradient_timer.setSingleShot(True)
+        self.gradient_timer.timeout.connect(self.refine_gradient)
+        self.polygon_shape = None  # id of the polygon being drawn on a vector layer
+        self.selected_shape = None  # id of the shape picked with the shape tool on the active vector layer
+        self.shape_drag = None  # (press position, offset) while the selected shape is dragged
+        self.preview_rect = QRect()
+        self.stroke = None  # BrushStroke of the brush or eraser while the button is held
+        self.pending_points = []  # coalesced mouse samples not drawn yet
+        self.stroke_timer = QTimer(self)
+        self.stroke_timer.setSingleShot(True)
+        self.stroke_timer.timeout.connect(self.flush_stroke)
+        self.spray_density = spray_engine.SPRAY_DENSITY
+        self.spray_flow = spray_engine.SPRAY_FLOW
+        self.nozzle = None  # image position the spray bursts land at while the button is held
+        self.spray_timer = QTimer(self)
+        self.spray_timer.timeout.connect(self.spray)
+        self.profile_overlay = False  # timings of the profiler drawn in the corner of the view
+        self.profile_timer = QTimer(self)
+        self.profile_timer.timeout.connect(lambda: self.update(PROFILE_OVERLAY_RECT))
+        self.recorder = None  # replay.SessionRecorder while a session is being recorded
+        self.adjustment = None  # AdjustmentPreview while brightness/contrast is being tuned
+        self.repaint_counter = RepaintCounter()
         self.tools = {
-            "brush": self.draw_brush_line,
-            "eraser": self.draw_eraser_line,
-            "spray": self.draw_spray_effect,
+            "brush": self.begin_stroke,
+            "eraser": self.begin_stroke,
+            "spray": self.spray,
             "line": self.draw_line_shape,
             "rectangle": self.draw_rectangle_shape,
             "circle": self.draw_circle_shape,
@@ -46,271 +262,826 @@ class Canvas(QWidget):
             "selection": self.make_selection
         }
 
-    def resizeEvent(self, event):
-        if self.width() > self.image.width() or self.height() > self.image.height():
-            new_image = QImage(self.size(), QImage.Format_RGB32)
-            new_image.fill(Qt.white)
-            painter = QPainter(new_image)
-            painter.drawImage(QPoint(0, 0), self.image)
-            self.image = new_image
+    @property
+    def store(self):
+        """The active layer's pixels, which the tools and filters draw on."""
+        return self.layers.active.store
+
+    @property
+    def vector(self):
+        """The active layer's VectorLayer, or None when it holds pixels only."""
+        return self.layers.active.vector
+
+    # Viewport
+
+    def to_image(self, pos):
+        """The image pixel under widget position `pos`."""
+        return QPoint(math.floor((pos.x() - self.offset.x()) / self.zoom),
+                      math.floor((pos.y() - self.offset.y()) / self.zoom))
+
+    def image_point(self, pos):
+        """Sub-pixel image position (x, y) under widget position `pos`, for brush strokes."""
+        return ((pos.x() - self.offset.x()) / self.zoom, (pos.y() - self.offset.y()) / self.zoom)
+
+    def to_image_rect(self, rect):
+        """Image pixels covered by the widget rectangle `rect`."""
+        return QRectF((rect.left() - self.offset.x()) / self.zoom,
+                      (rect.top() - self.offset.y()) / self.zoom,
+                      rect.width() / self.zoom, rect.height() / self.zoom).toAlignedRect()
+
+    def view_rect(self, rect):
+        """Widget area showing the image rectangle `rect`."""
+        return QRectF(rect.left() * self.zoom + self.offset.x(), rect.top() * self.zoom + self.offset.y(),
+                      rect.width() * self.zoom, rect.height() * self.zoom).toAlignedRect().adjusted(-1, -1, 1, 1)
+
+    def visible_image_rect(self):
+        return self.to_image_rect(self.rect()).intersected(self.store.rect())
+
+    def update_view(self, rect):
+        """Schedules a repaint of the widget over the image rectangle `rect`."""
+        self.update(self.view_rect(rect))
+
+    def image_changed(self, rect, store=None):
+        """
+        Called after the pixels under `rect` of a layer (default: the active one) changed.
+
+        Refreshes the cached composite, the pyramid and the screen there.
+        """
+        self.layers.changed(rect, store)
+        self.pyramid.invalidate(rect)
+        self.update_view(rect)
+
+    def layers_changed(self, rect=None):
+        """Called after any layers, their order or their blending changed under `rect` (default: everywhere)."""
+        self.layers.invalidate(rect)
+        self.redraw(rect)
+
+    def set_zoom(self, zoom, anchor=None):
+        """Zooms keeping the image point under widget position `anchor` (default: the centre) still."""
+        zoom = min(max(zoom, MIN_ZOOM), MAX_ZOOM)
+        anchor = QPointF(self.rect().center()) if anchor is None else QPointF(anchor)
+        self.offset = anchor - (anchor - self.offset) * (zoom / self.zoom)
+        self.zoom = zoom
+        self.update()
+
+    def zoom_in(self):
+        self.set_zoom(self.zoom * ZOOM_STEP)
 
+    def zoom_out(self):
+        self.set_zoom(self.zoom / ZOOM_STEP)
+
+    def reset_view(self):
+        self.zoom = 1.0
+        self.offset = QPointF(0, 0)
+        self.update()
+
+    def wheelEvent(self, event):
+        steps = event.angleDelta().y() / 120
+        if steps:
+            self.set_zoom(self.zoom * ZOOM_STEP ** steps, event.pos())
+
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key_Space and not event.isAutoRepeat():
+            self.space_held = True
+            self.setCursor(Qt.OpenHandCursor)
+        elif event.key() == Qt.Key_Delete and self.selected_shape is not None:
+            self.delete_shape()
+        else:
+            super().keyPressEvent(event)
+
+    def keyReleaseEvent(self, event):
+        if event.key() == Qt.Key_Space and not event.isAutoRepeat():
+            self.space_held = False
+            self.pan_anchor = None
+            self.unsetCursor()
+        else:
+            super().keyReleaseEvent(event)
+
+    def stroke_rect(self, start, end, width):
+        """Bounding box of a segment from start to end drawn with a pen of `width`."""
+        margin = width // 2 + 2
+        return QRect(start, end).normalized().adjusted(-margin, -margin, margin, margin)
+
+    def tool_rect(self, start, end):
+        """Area of the image the current tool touches when drawn from start to end."""
+        if self.current_tool == "gradient":
+            return gradient_engine.gradient_rect(self.gradient_kind, start, end)
+        if self.current_tool == "selection":
+            return self.stroke_rect(start, end, 1)
+        return self.stroke_rect(start, end, self.brush_size)
+
+    def mark_dirty(self, rect, store=None):
+        """Called before anything draws into `rect` of a layer (default: the active one)."""
+        self.history.touch(self.store if store is None else store, rect)
+        return rect
+
+    def apply_tool(self, rect, draw, *args):
+        """
+        Runs draw(painter, *args) on every tile under `rect`.
+
+        The tiles are recorded for undo and only the part of the widget
+        showing `rect` is scheduled for repaint.  With a selection, `rect`
+        is cut down to it and the painter clipped to it.  Returns the
+        rectangle drawn in.
+        """
+        selection = self.selection
+        if selection is not None:
+            rect = rect.intersected(selection.rect)
+            if rect.isEmpty():
+                return rect
+
+        def paint(painter):
+            if selection is not None:
+                painter.setClipRegion(selection.region())
+            draw(painter, *args)
+
+        with section(f'tool.{self.current_tool}'):
+            self.mark_dirty(rect)
+            self.store.paint(rect, paint)
+            self.image_changed(rect)
+        return rect
+
+    @timed('input.press')
     def mousePressEvent(self, event):
+        if event.button() == Qt.MiddleButton or (self.space_held and event.button() == Qt.LeftButton):
+            self.pan_anchor = event.pos()
+            return
         if event.button() == Qt.LeftButton:
             self.brush_color = self.primary_color
         elif event.button() == Qt.RightButton:
             self.brush_color = self.secondary_color
             
+        # Vector layers only take shapes
+        if self.vector is not None and self.current_tool in PIXEL_TOOLS:
+            return
+
         # Now handle the tool actions
         if self.current_tool == "polygon":
-            painter = QPainter(self.image)
-            painter.setPen(QPen(self.brush_color, self.brush_size))
-            self.draw_polygon(painter, event)
-            self.update()
+            self.add_polygon_point(event)
             return
             
+        pos = self.to_image(event.pos())
         if event.button() in [Qt.LeftButton, Qt.RightButton]:
             self.drawing = True
-            self.last_point = event.pos()
-            self.start_pos = event.pos()
+            self.last_point = pos
+            self.start_pos = pos
             
-            if self.current_tool in ["line", "rectangle", "circle", "gradient", "selection"]:
-                self.temp_image = self.image.copy()
+            if self.current_tool in SHAPE_TOOLS:
+                self.preview = None
+                self.preview_rect = QRect()
+                if self.current_tool == "selection":
+                    self.set_selection(None)
+            elif self.current_tool == "lasso":
+                self.set_selection(None)
+                self.lasso_points = [pos]
+            elif self.current_tool == "shape":
+                self.pick_shape(pos)
+            elif self.current_tool == "wand":
+                self.set_selection(Selection.from_fill(self.store, pos.x(), pos.y(), self.fill_tolerance,
+                                                       self.fill_connectivity))
+            elif self.current_tool in ("brush", "eraser"):
+                self.begin_stroke(self.image_point(event.pos()))
+            elif self.current_tool == "spray":
+                self.begin_spray(pos)
             elif self.current_tool == "fill":
-                self.flood_fill(event.pos())
+                if self.store.rect().contains(pos):
+                    self.flood_fill(pos)
             elif self.current_tool == "text":
-                text, ok = QInputDialog.getText(self, 'Text Tool', 'Enter text:')
-                if ok and text:
-                    painter = QPainter(self.image)
-                    self.draw_text(painter, event.pos(), text)
-                    self.update()
+                target = self.text_object_at(pos)
+                if target is not None:
+                    self.text_drag = (target, pos)
+                else:
+                    self.edit_text(pos)
 
+    @timed('input.move')
     def mouseMoveEvent(self, event):
+        if self.pan_anchor is not None:
+            self.offset += QPointF(event.pos() - self.pan_anchor)
+            self.pan_anchor = event.pos()
+            self.update()
+            return
         if not self.drawing or (not event.buttons() & (Qt.LeftButton | Qt.RightButton)):
             return
             
-        if self.current_tool in ["line", "rectangle", "circle", "gradient", "selection"]:
-            self.image = self.temp_image.copy()
-            
-        painter = QPainter(self.image)
-        
+
         # Set brush color based on which mouse button is pressed
         if event.buttons() & Qt.RightButton:
             self.brush_color = self.secondary_color
         elif event.buttons() & Qt.LeftButton:
             self.brush_color = self.primary_color
-        
-        if self.current_tool == "brush":
-            self.draw_brush_line(painter, self.last_point, event.pos())
-        elif self.current_tool == "eraser":
-            self.draw_eraser_line(painter, self.last_point, event.pos())
+
+        pos = self.to_image(event.pos())
+        if self.current_tool in SHAPE_TOOLS:
+            # Shapes are only previewed on top of the image until the button is released
+            rect = self.tool_rect(self.start_pos, pos)
+            self.update_view(self.preview_rect.united(rect))
+            self.preview = (self.current_tool, self.start_pos, pos)
+            self.preview_rect = rect
+            if self.current_tool == "gradient":
+                self.gradient_coarse = True
+                self.gradient_timer.start(GRADIENT_REFINE_MS)
         elif self.current_tool == "spray":
-            self.draw_spray_effect(painter, event.pos())
-        elif self.current_tool == "line":
-            self.draw_line_shape(painter, self.start_pos, event.pos())
-        elif self.current_tool == "rectangle":
-            self.draw_rectangle_shape(painter, self.start_pos, event.pos())
-        elif self.current_tool == "circle":
-            self.draw_circle_shape(painter, self.start_pos, event.pos())
-        elif self.current_tool == "gradient":
-            gradient = QLinearGradient(self.start_pos, event.pos())
-            gradient.setColorAt(0, self.brush_color)
-            gradient.setColorAt(1, Qt.transparent)
-            painter.setBrush(QBrush(gradient))
-            painter.setPen(Qt.NoPen)
-            painter.drawRect(QRect(self.start_pos, event.pos()).normalized())
-        elif self.current_tool == "selection":
-            painter.setPen(QPen(Qt.black, 1, Qt.DashLine))
-            painter.drawRect(QRect(self.start_pos, event.pos()).normalized())
-        
-        self.last_point = event.pos()
-        self.update()
+            self.nozzle = pos
+            if not self.spray_flow:
+                self.spray()
+        elif self.current_tool in ("brush", "eraser"):
+            self.queue_stroke_point(self.image_point(event.pos()))
+        elif self.text_drag is not None:
+            target, start = self.text_drag
+            self.set_text_preview((target, target.pos + pos - start, target.text, target.font, target.color))
+        elif self.current_tool == "lasso" and self.lasso_points:
+            self.update_view(self.stroke_rect(self.lasso_points[-1], pos, 1))
+            self.lasso_points.append(pos)
+        elif self.shape_drag is not None:
+            self.drag_shape(pos)
+
+        self.last_point = pos
 
+    @timed('input.release')
     def mouseReleaseEvent(self, event):
+        if self.pan_anchor is not None:
+            if event.button() in (Qt.MiddleButton, Qt.LeftButton):
+                self.pan_anchor = None
+            return
         if event.button() in [Qt.LeftButton, Qt.RightButton]:
             self.drawing = False
+            self.end_stroke()
+            self.end_spray()
+            if self.preview:
+                self.commit_preview()
+            if self.lasso_points:
+                self.commit_lasso()
+            if self.text_drag is not None:
+                self.drop_text(self.to_image(event.pos()))
+            if self.shape_drag is not None:
+                self.drop_shape()
             self.save_to_undo_stack()  # Save state after each draw
 
+    def commit_preview(self):
+        tool, start, end = self.preview
+        self.preview = None
+        self.gradient_timer.stop()
+        self.gradient_cache = None
+        if tool == "selection":
+            self.update_view(self.preview_rect)
+            self.set_selection(Selection.from_rect(QRect(start, end), self.store.rect()))
+        elif self.vector is not None:
+            self.update_view(self.preview_rect)
+            self.put_shape(None, Shape(tool, (start, end), QColor(self.brush_color), self.brush_size))
+        else:
+            self.apply_tool(self.preview_rect, self.tools[tool], start, end)
+
+    @timed('paint')
     def paintEvent(self, event):
         canvas_painter = QPainter(self)
-        canvas_painter.drawImage(self.rect(), self.image, self.image.rect())
+        self.draw_view(canvas_painter, event.rect())
+        self.repaint_counter.record(event.rect())
+        if self.profile_overlay:
+            self.draw_profile_overlay(canvas_painter)
+
+    def draw_view(self, canvas_painter, rect):
+        """Draws the widget area `rect`: the image at the current zoom, then the overlay."""
+        canvas_painter.fillRect(rect, VIEW_BACKGROUND)
+        canvas_painter.translate(self.offset)
+        canvas_painter.scale(self.zoom, self.zoom)
+        image_rect = self.to_image_rect(rect)
+        # Zoomed out, the image comes from the matching lower-resolution level
+        level = self.pyramid.level_for(self.zoom)
+        if level:
+            deadline = time.perf_counter() + PYRAMID_BUILD_MS / 1000
+            if not self.pyramid.draw(canvas_painter, level, image_rect, deadline):
+                self.pyramid_timer.start(0)
+        else:
+            self.layers.draw(canvas_painter, image_rect)
+        # Overlay: adjustment preview, the shape being dragged and the selection marquee
+        canvas_painter.setClipRect(image_rect)
+        if self.adjustment is not None:
+            self.adjustment.draw(canvas_painter)
+        if self.preview:
+            tool, start, end = self.preview
+            canvas_painter.save()
+            if tool == "gradient":
+                self.draw_gradient_preview(canvas_painter, start, end)
+            else:
+                self.tools[tool](canvas_painter, start, end)
+            canvas_painter.restore()
+        if self.text_preview is not None:
+            target, pos, text, font, color = self.text_preview
+            if target is not None:
+                canvas_painter.drawImage(target.rect.topLeft(), target.under_image())
+            text_engine.atlas(font, color).draw(canvas_painter, pos, text)
+        if self.lasso_points:
+            canvas_painter.setPen(QPen(Qt.black, 1, Qt.DashLine))
+            canvas_painter.drawPolyline(QPolygon(self.lasso_points))
+        if self.selection is not None:
+            canvas_painter.setPen(QPen(Qt.black, 1, Qt.DashLine))
+            canvas_painter.setBrush(Qt.NoBrush)
+            canvas_painter.drawPath(self.selection.outline())
+        shape = self.picked_shape()
+        if shape is not None:
+            if self.shape_drag is not None:
+                shape = shape.translated(self.shape_drag[1])
+                shape.draw(canvas_painter)
+            canvas_painter.setPen(QPen(Qt.blue, 1, Qt.DashLine))
+            canvas_painter.setBrush(Qt.NoBrush)
+            canvas_painter.drawRect(shape.rect)
+
+    def set_profiling(self, enabled):
+        """Turns the profiler and its overlay on or off."""
+        if enabled:
+            profiler.reset()
+            profiler.enable()
+            self.profile_timer.start(500)
+        else:
+            profiler.disable()
+            self.profile_timer.stop()
+        self.profile_overlay = enabled
+        self.update(PROFILE_OVERLAY_RECT)
+
+    def draw_profile_overlay(self, painter):
+        # Widget coordinates, over everything else
+        painter.resetTransform()
+        painter.setClipping(False)
+        painter.fillRect(PROFILE_OVERLAY_RECT, QColor(0, 0, 0, 170))
+        painter.setPen(Qt.white)
+        painter.setFont(QFont('Monospace', 8))
+        lines = profiler.report(limit=8) or ['Profiling: no timed sections yet']
+        painter.drawText(PROFILE_OVERLAY_RECT.adjusted(6, 4, -6, -4), Qt.AlignLeft | Qt.AlignTop,
+                         '\n'.join(lines))
 
     def set_color(self, color):
         self.brush_color = color
 
     def set_tool(self, tool):
+        if tool != "shape":
+            self.pick_shape(None)
         self.current_tool = tool
 
     def set_brush_size(self, size):
         self.brush_size = size
 
+    def set_fill_tolerance(self, tolerance):
+        self.fill_tolerance = tolerance
+
+    def set_fill_connectivity(self, connectivity):
+        self.fill_connectivity = connectivity
+
+    @timed('tool.fill')
     def flood_fill(self, pos):
-        target_color = self.image.pixelColor(pos)
-        if target_color == self.brush_color:
+        masks = fill_engine.tiled_region_masks(self.store, pos.x(), pos.y(), self.brush_color,
+                                               self.fill_tolerance, self.fill_connectivity, self.selection)
+        if masks is None:
             return
+        for key in masks:
+            self.mark_dirty(self.store.tile_rect(key))
+        fill_engine.fill_tiles(self.store, masks, self.brush_color)
+        self.image_changed(fill_engine.tile_masks_bounds(self.store, masks))
 
-        stack = [pos]
-        while stack:
-            current = stack.pop()
-            x, y = current.x(), current.y()
-            
-            if (x < 0 or x >= self.image.width() or 
-                y < 0 or y >= self.image.height()):
-                continue
-                
-            if self.image.pixelColor(x, y) != target_color:
-                continue
-
-            self.image.setPixelColor(x, y, self.brush_color)
-            
-            stack.append(QPoint(x + 1, y))
-            stack.append(QPoint(x - 1, y))
-            stack.append(QPoint(x, y + 1))
-            stack.append(QPoint(x, y - 1))
-        
-        self.update()
-
+    @timed('undo.snapshot')
     def save_to_undo_stack(self):
-        self.undo_stack.append(self.image.copy())
-        self.redo_stack.clear()
-        if len(self.undo_stack) > 20:  # Limit stack size
-            self.undo_stack.pop(0)
+        self.history.commit(self.layers)
 
-    def undo(self):
-        if len(self.undo_stack) > 1:
-            self.redo_stack.append(self.undo_stack.pop())
-            self.image = self.undo_stack[-1].copy()
-            # Ensure image matches widget size
-            if self.image.size() != self.size():
-                new_image = QImage(self.size(), QImage.Format_RGB32)
-                new_image.fill(Qt.white)
-                painter = QPainter(new_image)
-                painter.drawImage(QPoint(0, 0), self.image)
-                self.image = new_image
+    def set_history_budget(self, budget):
+        self.history.set_budget(budget)
+
+    def set_filter_workers(self, workers):
+        """Number of threads the Effects filters run on (None: one per CPU core)."""
+        self.filter_workers = workers
+        self.filter_runner.shutdown()
+        self.filter_runner = filter_engine.StripRunner(workers)
+
+    # Layers
+
+    def redraw(self, rect=None):
+        """Repaints the view after the composite changed under `rect` (default: everywhere)."""
+        if rect is None:
+            self.pyramid.clear()
             self.update()
+        else:
+            self.pyramid.invalidate(rect)
+            self.update_view(rect)
+
+    def add_layer(self, vector=False):
+        """Adds an empty layer (a vector layer when `vector`) above the active one and selects it."""
+        self.pick_shape(None)
+        return self.layers.add_layer(vector=vector)
 
+    def add_vector_layer(self):
+        return self.add_layer(vector=True)
+
+    def remove_layer(self, index=None):
+        """Removes a layer (default: the active one); the last layer cannot be removed."""
+        index = self.layers.active_index if index is None else index
+        self.pick_shape(None)
+        layer = self.layers.remove_layer(index)
+        if layer is not None:
+            self.redraw(layer.area())
+
+    def move_layer(self, offset, index=None):
+        """Moves a layer (default: the active one) up or down the stack; returns its new index."""
+        index = self.layers.active_index if index is None else index
+        target = self.layers.move_layer(index, offset)
+        if target != index:
+            self.redraw(self.layers.layers[target].area())
+        return target
+
+    def set_active_layer(self, index):
+        self.pick_shape(None)
+        self.polygon_shape = None
+        self.layers.set_active(index)
+
+    def set_layer_visible(self, index, visible):
+        self.redraw(self.layers.set_visible(index, visible))
+
+    def set_layer_opacity(self, index, opacity):
+        self.redraw(self.layers.set_opacity(index, opacity))
+
+    def set_layer_blend_mode(self, index, blend_mode):
+        self.redraw(self.layers.set_blend_mode(index, blend_mode))
+
+    @timed('undo.undo')
+    def undo(self):
+        if self.recorder is not None:
+            self.recorder.command('undo')
+        if self.history.can_undo():
+            self.pick_shape(None)
+            # The edit may belong to any layer, not only the active one
+            self.layers_changed(self.history.undo(self.layers))
+
+    @timed('undo.redo')
     def redo(self):
-        if self.redo_stack:
-            self.undo_stack.append(self.redo_stack.pop())
-            self.image = self.undo_stack[-1].copy()
-            # Ensure image matches widget size
-            if self.image.size() != self.size():
-                new_image = QImage(self.size(), QImage.Format_RGB32)
-                new_image.fill(Qt.white)
-                painter = QPainter(new_image)
-                painter.drawImage(QPoint(0, 0), self.image)
-                self.image = new_image
-            self.update()
+        if self.recorder is not None:
+            self.recorder.command('redo')
+        if self.history.can_redo():
+            self.pick_shape(None)
+            self.layers_changed(self.history.redo(self.layers))
 
     def new_canvas(self):
-        self.image.fill(Qt.white)
+        """Clears every layer as one undo step; the layers themselves are kept."""
+        self.pick_shape(None)
+        for layer in self.layers:
+            self.mark_dirty(self.layers.rect(), layer.store)
+            layer.store.fill(layer.store.background)
+            if layer.vector is not None:
+                for shape_id in list(layer.vector.shapes):
+                    self.history.touch_shape(layer.vector, shape_id, self.layers.size())
+                    layer.vector.put(shape_id, None)
         self.save_to_undo_stack()
-        self.update()
+        self.layers_changed(self.layers.rect())
+        self.project = None
+        self.text_objects = []
 
     def save_image(self, on_done=None):
-        file_path, _ = QFileDialog.getSaveFileName(self, "Save Image", "", 
-                                                 "PNG Files (*.png);;JPG Files (*.jpg);;All Files (*.*)")
+        file_path, _ = QFileDialog.getSaveFileName(self, "Save Image", self.project.path if self.project else "",
+                                                 "PNG Files (*.png);;JPG Files (*.jpg);;"
+                                                 "Paint Project (*.ppe);;All Files (*.*)")
         if file_path:
-            self.image.save(file_path)
-            if on_done:
-                on_done('Obraz został zapisany.')
+            self.save_to(file_path, on_done)
+
+    def save_to(self, file_path, on_done=None):
+        """Saves in the background: projects (.ppe) incrementally, images as the flattened layers."""
+        if project_io.is_project(file_path):
+            return self.saves.submit(ProjectSaveJob(self, file_path, on_done))
+        return self.saves.submit(SaveJob(self, file_path, on_done))
+
+    def is_dirty(self):
+        """True when the canvas changed since it was last saved or autosaved."""
+        return self.history.revision != self.saved_revision
+
+    def set_autosave(self, path, interval_s):
+        """Autosaves to `path` every `interval_s` seconds while there are changes; 0 disables."""
+        self.autosave_path = path
+        if interval_s > 0:
+            self.autosave_timer.start(int(interval_s * 1000))
+        else:
+            self.autosave_timer.stop()
+
+    def autosave(self, on_done=None):
+        # Skipped while unchanged, or while an earlier save is still being written
+        if self.autosave_path and self.is_dirty() and not self.saves.busy():
+            self.saves.submit(SaveJob(self, self.autosave_path, on_done,
+                                      'Autozapis: ' + self.autosave_path, png_level=1))
 
     def open_image(self, on_done=None):
         file_path, _ = QFileDialog.getOpenFileName(self, "Open Image", "",
-                                                 "PNG Files (*.png);;JPG Files (*.jpg);;All Files (*.*)")
-        if file_path:
-            self.image.load(file_path)
-            self.image = self.image.scaled(self.size(), Qt.KeepAspectRatio)
-            self.save_to_undo_stack()
-            self.update()
+                                                 "Images (*.png *.jpg *.jpeg *.bmp *.ppm *.pgm *.tif *.tiff);;"
+                                                 "Paint Project (*.ppe);;All Files (*.*)")
+        if not file_path:
+            return
+        if project_io.is_project(file_path):
+            self.load_project(file_path)
+            if on_done:
+                on_done('Projekt został otwarty.')
+        else:
+            self.load_image(file_path)
             if on_done:
                 on_done('Obraz został otwarty.')
 
-    def apply_filter(self, filter_name, on_done=None):
-        # Convert QImage to PIL Image
-        buffer = QBuffer()
-        buffer.open(QBuffer.ReadWrite)
-        self.image.save(buffer, "PNG")
-        pil_image = Image.open(io.BytesIO(buffer.data()))
-        changed = False
-        if filter_name == 'blur':
-            pil_image = pil_image.filter(ImageFilter.BLUR)
-            changed = True
-        elif filter_name == 'sharpen':
-            pil_image = pil_image.filter(ImageFilter.SHARPEN)
-            changed = True
-        elif filter_name == 'grayscale':
-            pil_image = pil_image.convert('L').convert('RGB')
-            changed = True
-        elif filter_name == 'invert':
-            pil_image = ImageOps.invert(pil_image)
-            changed = True
-        elif filter_name == 'brightness':
-            factor, ok = QInputDialog.getDouble(self, 'Brightness',
-                                              'Enter brightness factor (0.0-2.0):',
-                                              1.0, 0.0, 2.0, 2)
-            if ok:
-                pil_image = ImageEnhance.Brightness(pil_image).enhance(factor)
-                changed = True
-        elif filter_name == 'contrast':
-            factor, ok = QInputDialog.getDouble(self, 'Contrast',
-                                              'Enter contrast factor (0.0-2.0):',
-                                              1.0, 0.0, 2.0, 2)
-            if ok:
-                pil_image = ImageEnhance.Contrast(pil_image).enhance(factor)
-                changed = True
-        if changed:
-            buffer = io.BytesIO()
-            pil_image.save(buffer, format='PNG')
-            self.image.loadFromData(buffer.getvalue())
-            self.save_to_undo_stack()
-            self.update()
+    @timed('io.open')
+    def load_project(self, file_path):
+        """Opens a project: its layers replace the canvas layers and the undo history starts over."""
+        self.end_stroke()
+        self.layers, self.project = project_io.load(file_path, self.layers.tile_size)
+        self.set_selection(None)
+        self.text_objects = []
+        self.selected_shape = None
+        self.pyramid = Pyramid(self.layers)
+        self.history.clear()
+        self.saved_revision = self.history.revision
+        self.layers_changed()
+        self.reset_view()
+
+    @timed('io.open')
+    def load_image(self, file_path):
+        """
+        Loads the image in `file_path` at full resolution into the active layer, as one undo step.
+
+        Every layer takes the image's size.
+        """
+        size = image_io.image_size(file_path)
+        self.set_selection(None)
+        self.text_objects = []
+        self.pick_shape(None)
+        # The image replaces the shapes of a vector layer: it becomes a pixel layer until undone
+        self.history.touch_vector(self.layers.active, self.layers.size())
+        self.layers.active.vector = None
+        for layer in self.layers:
+            self.mark_dirty(self.layers.rect(), layer.store)
+        self.layers.resize(size)
+        for layer in self.layers:
+            self.mark_dirty(self.layers.rect(), layer.store)
+        self.store.fill(self.store.background)
+        image_io.read_into(self.store, file_path)
+        self.save_to_undo_stack()
+        self.layers_changed()
+        self.reset_view()
+
+    def apply_filter(self, filter_name, factor=None, on_done=None):
+        """Queues a filter job; adjustments ask for their factor unless `factor` is given."""
+        if self.vector is not None:
             if on_done:
-                on_done('Zastosowano filtr: ' + filter_name)
+                on_done('Filtry nie działają na warstwach wektorowych: ' + filter_name)
+            return
+        if filter_name in ADJUSTMENTS:
+            if factor is None:
+                factor = self.adjust(filter_name)
+            if factor is None:
+                return
+        elif filter_name not in filter_engine.FILTERS:
+            return
+        factor = 1.0 if factor is None else factor
+        if self.recorder is not None:
+            self.recorder.command('filter', filter_name, factor)
+        return self.jobs.submit(FilterJob(self, filter_name, factor, on_done))
+
+    def adjust(self, filter_name):
+        """
+        Asks for an adjustment factor while previewing it live on the canvas.
+
+        Returns the factor, or None if the dialog was cancelled.  The preview
+        stays on screen until the full-resolution job has replaced it.
+        """
+        self.adjustment = AdjustmentPreview(self.store, self.visible_image_rect(), filter_name)
+        dialog = AdjustmentDialog(self, filter_name.capitalize(),
+                                  f'Enter {filter_name} factor (0.0-2.0):')
+        dialog.factor_changed.connect(self.set_adjustment_factor)
+        self.update_view(self.adjustment.rect)
+        if dialog.exec_() != QDialog.Accepted:
+            self.end_adjustment()
+            return None
+        self.adjustment.committed = True
+        return dialog.factor()
+
+    def set_adjustment_factor(self, factor):
+        if self.adjustment is not None:
+            self.adjustment.factor = factor
+            self.update_view(self.adjustment.rect)
+
+    def end_adjustment(self):
+        if self.adjustment is not None:
+            self.update_view(self.adjustment.rect)
+            self.adjustment = None
+
+    def on_job_ended(self, *args):
+        busy = self.jobs.busy()
+        self.setEnabled(not busy)
+        if not busy and self.adjustment is not None and self.adjustment.committed:
+            self.end_adjustment()
+
+    def finish_filter(self, job, result):
+        """Writes a finished filter job's pixels back as one undoable edit."""
+        if self.history.revision != job.revision:
+            # Undo, New or Open happened while the filter ran on the old pixels
+            if job.on_done:
+                job.on_done('Pominięto filtr (obraz zmienił się w trakcie): ' + job.name)
+            return
+        if self.layers.index_of(job.store) is None:
+            # The layer was deleted while the filter ran
+            if job.on_done:
+                job.on_done('Pominięto filtr (warstwa została usunięta): ' + job.name)
+            return
+        # Only the selected pixels change; the margin around them was read, not filtered
+        inner = job.rect.translated(-job.source_rect.topLeft())
+        rows = slice(inner.top(), inner.bottom() + 1)
+        columns = slice(inner.left(), inner.right() + 1)
+        result = result[rows, columns]
+        if job.mask is not None:
+            result = np.where(job.mask[..., None], result, job.rgb[rows, columns])
+        image = job.image.copy(inner)
+        image_bridge.write_rgb(image, result, opaque=False)
+        # The layer the job started on, even if another one was selected meanwhile
+        self.mark_dirty(job.rect, job.store)
+        job.store.write(image, job.rect.topLeft())
+        self.save_to_undo_stack()
+        self.image_changed(job.rect, job.store)
+        if job.on_done:
+            job.on_done('Zastosowano filtr: ' + job.name)
+
+    def gradient_area(self, painter, start, end):
+        """The part of the gradient's area `painter` can draw on (its device and clip), in image coordinates."""
+        device = painter.device()
+        area = painter.worldTransform().inverted()[0].mapRect(QRect(0, 0, device.width(), device.height()))
+        if painter.hasClipping():
+            area = area.intersected(painter.clipBoundingRect().toAlignedRect())
+        return area.intersected(gradient_engine.gradient_rect(self.gradient_kind, start, end))
+
+    def gradient_stops(self):
+        other = self.secondary_color if self.brush_color == self.primary_color else self.primary_color
+        return gradient_engine.ramp_stops(self.gradient_ramp, self.brush_color, other)
+
+    def gradient_image(self, area, start, end, scale=1.0):
+        """The gradient tool's gradient from start to end over `area`, rendered at 1/`scale` resolution."""
+        ramp = gradient_engine.ramp(self.gradient_stops())
+        return gradient_engine.render(area, self.gradient_kind, start, end, ramp, self.gradient_dither, scale)
+
+    def draw_gradient(self, painter, start, end):
+        area = self.gradient_area(painter, start, end)
+        if area.isEmpty():
+            return
+        # Without dithering QPainter fills the same linear or radial gradient faster
+        gradient = None
+        if not self.gradient_dither and self.gradient_kind in gradient_engine.QPAINTER_KINDS:
+            gradient = gradient_engine.qgradient(self.gradient_kind, start, end, self.gradient_stops())
+        if gradient is not None:
+            painter.fillRect(area, QBrush(gradient))
+        else:
+            painter.drawImage(area.topLeft(), self.gradient_image(area, start, end))
+
+    def draw_gradient_preview(self, painter, start, end):
+        """Draws the gradient being dragged: coarse while the mouse moves, at screen resolution once it rests."""
+        area = self.gradient_area(painter, start, end)
+        if area.isEmpty():
+            return
+        scale = max(1.0, 1.0 / self.zoom)  # never finer than the screen shows
+        if self.gradient_coarse:
+            scale = max(scale, math.sqrt(area.width() * area.height() / GRADIENT_PREVIEW_PIXELS))
+        key = (area, start, end, scale, self.gradient_kind, self.gradient_ramp, self.gradient_dither,
+               QColor(self.brush_color).rgba(), QColor(self.primary_color).rgba(),
+               QColor(self.secondary_color).rgba())
+        if self.gradient_cache is None or self.gradient_cache[0] != key:
+            self.gradient_cache = (key, self.gradient_image(area, start, end, scale))
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.drawImage(QRectF(area), self.gradient_cache[1])
+
+    def refine_gradient(self):
+        self.gradient_coarse = False
+        if self.preview is not None and self.preview[0] == "gradient":
+            self.update_view(self.preview_rect)
+
+    def set_gradient_kind(self, kind):
+        self.gradient_kind = kind
 
-    def draw_gradient(self, painter, event):
-        gradient = QLinearGradient(self.start_pos, event.pos())
-        gradient.setColorAt(0, self.brush_color)
-        gradient.setColorAt(1, Qt.transparent)
-        painter.setBrush(gradient)
-        painter.drawRect(QRect(self.start_pos, event.pos()).normalized())
+    def set_gradient_ramp(self, ramp):
+        self.gradient_ramp = ramp
 
-    def draw_polygon(self, painter, event):
+    def set_gradient_dither(self, dither):
+        self.gradient_dither = bool(dither)
+
+    def add_polygon_point(self, event):
         if not hasattr(self, 'polygon_points'):
             self.polygon_points = []
-            
+
         if event.button() == Qt.LeftButton:
-            self.polygon_points.append(event.pos())
+            self.polygon_points.append(self.to_image(event.pos()))
             if len(self.polygon_points) > 2:
-                points = [QPoint(p.x(), p.y()) for p in self.polygon_points]
-                painter.drawPolygon(QPolygon(points))
+                self.commit_polygon()
         elif event.button() == Qt.RightButton:
             # Complete polygon on right click
             if len(self.polygon_points) > 2:
-                points = [QPoint(p.x(), p.y()) for p in self.polygon_points]
-                painter.drawPolygon(QPolygon(points))
+                self.commit_polygon()
             self.polygon_points = []  # Reset points for next polygon
+            self.polygon_shape = None
 
-    def make_selection(self, painter, event):
-        if not self.temp_image:
-            self.temp_image = self.image.copy()
-        painter.drawRect(QRect(self.start_pos, event.pos()).normalized())
+    def commit_polygon(self):
+        if self.vector is not None:
+            # Every point added replaces the polygon drawn so far
+            shape = Shape("polygon", self.polygon_points, QColor(self.brush_color), self.brush_size)
+            self.polygon_shape = self.put_shape(self.polygon_shape, shape)
+            return
+        polygon = QPolygon([QPoint(p.x(), p.y()) for p in self.polygon_points])
+        bounds = polygon.boundingRect()
+        self.apply_tool(self.stroke_rect(bounds.topLeft(), bounds.bottomRight(), self.brush_size),
+                        self.draw_polygon, polygon)
 
-    def draw_brush_line(self, painter, start, end):
-        painter.setPen(QPen(self.brush_color, self.brush_size, 
-                          Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
-        painter.drawLine(start, end)
+    def draw_polygon(self, painter, polygon):
+        painter.setPen(QPen(self.brush_color, self.brush_size))
+        painter.drawPolygon(polygon)
 
-    def draw_eraser_line(self, painter, start, end):
-        painter.setPen(QPen(Qt.white, self.brush_size, 
-                          Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
-        painter.drawLine(start, end)
+    def make_selection(self, painter, start, end):
+        painter.setPen(QPen(Qt.black, 1, Qt.DashLine))
+        painter.drawRect(QRect(start, end).normalized())
+
+    def set_selection(self, selection):
+        """Limits the tools and filters to `selection` (a Selection; None: the whole image)."""
+        for shown in (self.selection, selection):
+            if shown is not None:
+                self.update_view(shown.rect.adjusted(-2, -2, 2, 2))
+        self.selection = selection
+
+    def select_all(self):
+        self.set_selection(Selection.from_rect(self.store.rect(), self.store.rect()))
+
+    def deselect(self):
+        self.set_selection(None)
+
+    def commit_lasso(self):
+        points, self.lasso_points = self.lasso_points, []
+        self.update_view(QPolygon(points).boundingRect().adjusted(-2, -2, 2, 2))
+        self.set_selection(Selection.from_polygon(points, self.store.rect()))
+
+    def begin_stroke(self, point):
+        """Starts a brush or eraser stroke at image position `point` (x, y)."""
+        self.end_stroke()
+        self.stroke = BrushStroke(self.store, self.brush_size, self.brush_color,
+                                  erase=self.current_tool == "eraser", selection=self.selection)
+        self.pending_points = [point]
+        self.flush_stroke()
+
+    def queue_stroke_point(self, point):
+        # Mouse moves are coalesced: whatever queued up is drawn in one go once the events are handled
+        if not self.pending_points:
+            self.stroke_timer.start(0)
+        self.pending_points.append(point)
+
+    def flush_stroke(self, finish=False):
+        """Draws the stroke through the queued samples (and to its end when `finish`)."""
+        if self.stroke is None:
+            return
+        points, self.pending_points = self.pending_points, []
+        pieces = self.stroke.add_points(points)
+        if finish:
+            pieces = np.concatenate([pieces, self.stroke.finish()])
+        if len(pieces):
+            with section(f'tool.{self.current_tool}'):
+                rect = self.stroke.bounds(pieces)
+                if self.stroke.selection is not None:
+                    rect = rect.intersected(self.stroke.selection.rect)
+                self.mark_dirty(rect)
+                self.stroke.stamp(pieces)
+                self.image_changed(rect)
+
+    def end_stroke(self):
+        if self.stroke is not None:
+            self.flush_stroke(finish=True)
+            self.stroke.end()
+            self.stroke = None
+
+    def begin_spray(self, pos):
+        """Starts spraying at image position `pos`: one burst now, then `spray_flow` bursts a second."""
+        self.nozzle = pos
+        self.spray()
+        if self.spray_flow:
+            self.spray_timer.start(1000 // self.spray_flow)
+
+    @timed('tool.spray')
+    def spray(self):
+        """Sprays one burst of `spray_density` particles at the nozzle."""
+        if self.nozzle is None:
+            return
+        x, y = self.nozzle.x(), self.nozzle.y()
+        area = self.store.rect() if self.selection is None else self.selection.rect
+        rect = spray_engine.touched_rect(x, y, self.brush_size).intersected(area)
+        if rect.isEmpty():
+            return
+        self.mark_dirty(rect)
+        rect = spray_engine.spray_burst(self.store, x, y, self.spray_density, self.brush_size, self.brush_color,
+                                        selection=self.selection)
+        self.image_changed(rect)
+
+    def end_spray(self):
+        self.spray_timer.stop()
+        self.nozzle = None
 
-    def draw_spray_effect(self, painter, pos):
-        painter.setPen(QPen(self.brush_color, 1))
-        for _ in range(20):
-            xo = int(random.gauss(0, self.brush_size))
-            yo = int(random.gauss(0, self.brush_size))
-            painter.drawPoint(int(pos.x() + xo), int(pos.y() + yo))
+    def set_spray_density(self, density):
+        self.spray_density = max(1, min(int(density), spray_engine.MAX_SPRAY_DENSITY))
+
+    def set_spray_flow(self, flow):
+        self.spray_flow = max(0, min(int(flow), spray_engine.MAX_SPRAY_FLOW))
+        if self.spray_timer.isActive():
+            if self.spray_flow:
+                self.spray_timer.start(1000 // self.spray_flow)
+            else:
+                self.spray_timer.stop()
 
     def draw_line_shape(self, painter, start, end):
         painter.setPen(QPen(self.brush_color, self.brush_size))
@@ -324,10 +1095,147 @@ class Canvas(QWidget):
         painter.setPen(QPen(self.brush_color, self.brush_size))
         painter.drawEllipse(QRect(start, end).normalized())
 
-    def draw_text(self, painter, pos, text):
-        painter.setPen(QPen(self.brush_color))
-        painter.setFont(self.text_font)
-        painter.drawText(pos, text)
+    def draw_text(self, painter, pos, text, atlas=None):
+        """Draws `text` with its first baseline starting at `pos`, from the glyph atlas of its font and colour."""
+        (atlas or text_engine.atlas(self.text_font, self.brush_color)).draw(painter, pos, text)
+
+    def set_text_font(self, font):
+        self.text_font = QFont(font)
+
+    def text_object_at(self, pos):
+        """The newest placed text on the active layer under image position `pos` that can still be edited."""
+        self.text_objects = [text for text in self.text_objects if text.is_editable()]
+        for text in reversed(self.text_objects):
+            if text.store is self.store and text.rect.contains(pos):
+                return text
+        return None
+
+    def set_text_preview(self, preview):
+        """Shows `preview` (see text_preview) over the image instead of the current one."""
+        for shown in (self.text_preview, preview):
+            if shown is not None:
+                target, pos, text, font, color = shown
+                rect = text_engine.atlas(font, color).bounds(pos, text)
+                self.update_view(rect if target is None else rect.united(target.rect))
+        self.text_preview = preview
+
+    def edit_text(self, pos, target=None):
+        """Asks for text at `pos` (or for a new version of the placed text `target`), previewing it live."""
+        color = self.brush_color if target is None else target.color
+        dialog = TextDialog(self, '' if target is None else target.text,
+                            self.text_font if target is None else target.font)
+        dialog.changed.connect(lambda: self.set_text_preview((target, pos, dialog.text(), dialog.font, color)))
+        accepted = dialog.exec_() == QDialog.Accepted
+        self.set_text_preview(None)
+        if accepted:
+            self.text_font = QFont(dialog.font)
+            if dialog.text() or target is not None:
+                self.place_text(target, pos, dialog.text(), dialog.font, color)
+
+    def drop_text(self, pos):
+        """Ends dragging a placed text: a click edits it, a drag moves it to where it was dropped."""
+        (target, start), self.text_drag = self.text_drag, None
+        self.set_text_preview(None)
+        if pos == start:
+            self.edit_text(target.pos, target)
+        else:
+            self.place_text(target, target.pos + pos - start, target.text, target.font, target.color)
+
+    def place_text(self, target, pos, text, font, color):
+        """
+        Draws `text` at `pos` on the active layer as one undo step and keeps it editable.
+
+        The placed text `target`, if given, is replaced: the pixels it was
+        drawn over come back first.
+        """
+        if target is not None:
+            self.text_objects.remove(target)
+            self.mark_dirty(target.rect, target.store)
+            target.store.write(target.under_image(), target.rect.topLeft())
+            self.image_changed(target.rect, target.store)
+        if text:
+            atlas = text_engine.atlas(font, color)
+            rect = atlas.bounds(pos, text).intersected(self.store.rect())
+            under = self.store.snapshot(rect)
+            rect = self.apply_tool(rect, self.draw_text, pos, text, atlas)
+            if not rect.isEmpty():
+                self.text_objects.append(TextObject(self.store, text, font, color, pos, rect, under))
+                del self.text_objects[:-MAX_TEXT_OBJECTS]
+        self.save_to_undo_stack()
+
+    # Vector shapes
+
+    def put_shape(self, shape_id, shape, layer=None):
+        """
+        Stores `shape` under `shape_id` in a vector layer (default: the active one); returns the id.
+
+        A `shape_id` of None adds the shape on top, a `shape` of None
+        removes it.  Only the shapes in the area the old and the new shape
+        cover are drawn again.
+        """
+        layer = self.layers.active if layer is None else layer
+        vector, store = layer.vector, layer.store
+        if shape_id is None:
+            shape_id = vector.next_id
+        old = vector.get(shape_id)
+        rect = QRect()
+        for changed in (old, shape):
+            if changed is not None:
+                rect = rect.united(changed.rect)
+        rect = rect.intersected(store.rect())
+        with section('tool.shape'):
+            self.history.touch_shape(vector, shape_id, self.layers.size())
+            vector.put(shape_id, shape)
+            if not rect.isEmpty():
+                self.mark_dirty(rect, store)
+                vector.rasterize(store, rect)
+                self.image_changed(rect, store)
+        return shape_id
+
+    def picked_shape(self):
+        """The Shape picked with the shape tool, or None."""
+        if self.selected_shape is None or self.vector is None:
+            return None
+        return self.vector.get(self.selected_shape)
+
+    def pick_shape(self, pos):
+        """Picks the topmost shape of the active vector layer at image position `pos` (None: none)."""
+        shown = self.picked_shape()
+        if shown is not None:
+            self.update_view(shown.rect.adjusted(-1, -1, 1, 1))
+        self.selected_shape = None
+        self.shape_drag = None
+        if pos is not None and self.vector is not None:
+            self.selected_shape = self.vector.shape_at(pos, math.ceil(SHAPE_HIT_TOLERANCE / self.zoom))
+            if self.selected_shape is not None:
+                self.shape_drag = (pos, QPoint())
+                self.update_view(self.picked_shape().rect.adjusted(-1, -1, 1, 1))
+
+    def drag_shape(self, pos):
+        start, offset = self.shape_drag
+        shape = self.picked_shape()
+        if shape is None:
+            return
+        for moved in (offset, pos - start):
+            self.update_view(shape.rect.translated(moved).adjusted(-1, -1, 1, 1))
+        self.shape_drag = (start, pos - start)
+
+    def drop_shape(self):
+        """Ends dragging the picked shape: moves it by the drag's offset as one undo step."""
+        (_, offset), self.shape_drag = self.shape_drag, None
+        shape = self.picked_shape()
+        if shape is not None and not offset.isNull():
+            self.update_view(shape.rect.translated(offset).adjusted(-1, -1, 1, 1))
+            self.put_shape(self.selected_shape, shape.translated(offset))
+
+    def delete_shape(self):
+        """Removes the picked shape as one undo step."""
+        shape = self.picked_shape()
+        if shape is not None:
+            shape_id = self.selected_shape
+            self.pick_shape(None)
+            self.put_shape(shape_id, None)
+            self.save_to_undo_stack()
 
     def set_primary_color(self, color):
         self.primary_color = color
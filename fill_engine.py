@@ -0,0 +1,271 @@
+"""
+Scanline flood fill working directly on the pixel buffer of a QImage.
+
+The fill region is grown row by row: every stack entry is a horizontal span
+of the parent row, so the stack holds a few entries per row instead of one
+QPoint per pixel.  Colour matching is done once for the whole buffer with
+NumPy, the scanline pass itself only looks at boolean rows.
+"""
+import numpy as np
+from PyQt5.QtCore import QRect
+from PyQt5.QtGui import QColor, QImage
+
+from image_bridge import const_pixel_view, pixel_view
+
+
+def color_value(color, image_format=QImage.Format_RGB32):
+    """Packs a QColor (or Qt.GlobalColor) into the 32-bit value stored by the image."""
+    color = QColor(color)
+    if image_format == QImage.Format_RGB32:
+        return np.uint32(color.rgb())
+    return np.uint32(color.rgba())
+
+
+def match_mask(pixels, target, tolerance=0):
+    """Boolean mask of pixels whose channels all lie within `tolerance` of `target`."""
+    if tolerance <= 0:
+        return pixels.view(np.uint32)[..., 0] == target.view(np.uint32)[0]
+    diff = np.abs(pixels.astype(np.int16) - target.astype(np.int16))
+    return diff.max(axis=2) <= tolerance
+
+
+def _run_bounds(row, x):
+    """Extends the run of True values in `row` that contains column `x`."""
+    left = row[:x + 1][::-1]
+    stop = np.argmin(left)
+    x0 = x - stop + 1 if not left[stop] else 0
+    right = row[x:]
+    stop = np.argmin(right)
+    x1 = x + stop - 1 if not right[stop] else row.size - 1
+    return x0, x1
+
+
+def scanline_mask(matches, spans, connectivity=4):
+    """
+    Grows the region connected to the seed `spans` inside `matches` and returns it as a mask.
+
+    Every span is a (y, x0, x1) row segment; `connectivity` is 4 or 8, with 8
+    a run also reaches the rows above and below diagonally.
+    """
+    height, width = matches.shape
+    filled = np.zeros_like(matches)
+    reach = 1 if connectivity == 8 else 0
+    stack = [(y, max(x0, 0), min(x1, width - 1)) for y, x0, x1 in spans
+             if 0 <= y < height and x0 < width and x1 >= 0]
+
+    while stack:
+        y, lo, hi = stack.pop()
+        available = matches[y] & ~filled[y]
+        segment = available[lo:hi + 1]
+        if not segment.any():
+            continue
+        # Visit every separate run that touches the parent span
+        starts = np.flatnonzero(segment & ~np.concatenate(([False], segment[:-1]))) + lo
+        for start in starts:
+            if filled[y, start]:
+                continue
+            x0, x1 = _run_bounds(available, start)
+            filled[y, x0:x1 + 1] = True
+            lo_child, hi_child = max(x0 - reach, 0), min(x1 + reach, width - 1)
+            if y > 0:
+                stack.append((y - 1, lo_child, hi_child))
+            if y < height - 1:
+                stack.append((y + 1, lo_child, hi_child))
+    return filled
+
+
+def mask_bounds(mask):
+    """Bounding QRect of the True pixels in `mask` (an empty QRect when none)."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return QRect()
+    cols = np.flatnonzero(mask.any(axis=0))
+    return QRect(int(cols[0]), int(rows[0]),
+                 int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1))
+
+
+def region_mask(image, x, y, color=None, tolerance=0, connectivity=4):
+    """
+    Boolean mask of the region a fill started at (x, y) of a 32-bit `image` covers.
+
+    Returns None when there is nothing to fill: the seed lies outside the
+    image, or the region already has exactly `color`.
+    """
+    if not (0 <= x < image.width() and 0 <= y < image.height()):
+        return None
+    pixels = const_pixel_view(image)
+    target = pixels[y, x].copy()
+    if (color is not None and tolerance <= 0
+            and target.view(np.uint32)[0] == color_value(color, image.format())):
+        return None
+    return scanline_mask(match_mask(pixels, target, tolerance), [(y, x, x)], connectivity)
+
+
+def fill_mask(image, mask, color):
+    """Sets every pixel of `image` selected by `mask` to `color`."""
+    pixel_view(image).view(np.uint32)[..., 0][mask] = color_value(color, image.format())
+
+
+def flood_fill(image, x, y, color, tolerance=0, connectivity=4, mask=None):
+    """
+    Fills the region around (x, y) of a 32-bit `image` in place with `color`.
+
+    When `mask` is a boolean array of the image size the filled pixels are
+    also OR-ed into it.  Returns the bounding QRect of the filled pixels.
+    """
+    filled = region_mask(image, x, y, color, tolerance, connectivity)
+    if filled is None:
+        return QRect()
+    fill_mask(image, filled, color)
+    if mask is not None:
+        mask |= filled
+    return mask_bounds(filled)
+
+
+_NEIGHBOURS = {
+    4: [(-1, 0), (1, 0), (0, -1), (0, 1)],
+    8: [(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (1, -1), (-1, 1), (1, 1)],
+}
+
+
+def tiled_region_masks(store, x, y, color=None, tolerance=0, connectivity=4, selection=None):
+    """
+    Fill region of a TiledImage as a {tile key: boolean mask} dictionary.
+
+    The scanline fill runs inside one tile at a time; pixels it reaches on a
+    tile border seed the neighbouring tile.  Tiles that were never allocated
+    are uniform background and are matched without touching any pixels.
+    With a `selection` (selection.Selection) the region never leaves it and
+    only the tiles under its bounding rectangle are visited.
+    Returns None when there is nothing to fill.
+    """
+    image_rect = store.rect()
+    bounds = image_rect if selection is None else image_rect.intersected(selection.rect)
+    if not bounds.contains(x, y):
+        return None
+    if selection is not None and not selection.contains(np.array([[x, y]]))[0]:
+        return None
+    size = store.tile_size
+    target = np.array([store.pixel(x, y)], np.uint32).view(np.uint8)
+    if (color is not None and tolerance <= 0
+            and target.view(np.uint32)[0] == color_value(color, store.format)):
+        return None
+    background = np.array([color_value(store.background, store.format)], np.uint32).view(np.uint8)
+    background_matches = bool(match_mask(background.reshape(1, 1, 4), target, tolerance)[0, 0])
+
+    masks = {}
+    matches_cache = {}
+    full_masks = {}
+    full_spans = {}
+    queue = {(x // size, y // size): [(y % size, x % size, x % size)]}
+    while queue:
+        key, spans = queue.popitem()
+        if key not in matches_cache:
+            tile_rect = store.tile_rect(key)
+            valid = tile_rect.intersected(image_rect)
+            tile = store.tile(key)
+            if tile is None:
+                matches = np.full((size, size), background_matches)
+            else:
+                # Read-only: a shared tile must not be detached (and copied) just to be read
+                matches = match_mask(const_pixel_view(tile), target, tolerance)
+            # Tile pixels beyond the image edge are never part of the fill
+            matches[valid.height():, :] = False
+            matches[:, valid.width():] = False
+            if selection is not None:
+                matches &= selection.mask(tile_rect)
+            uniform = bool(matches[:valid.height(), :valid.width()].all())
+            if uniform:
+                shape = (valid.width(), valid.height())
+                if shape not in full_masks:
+                    matches.flags.writeable = False
+                    full_masks[shape] = matches
+                matches = full_masks[shape]
+            matches_cache[key] = (matches, uniform)
+        matches, uniform = matches_cache[key]
+        filled = masks.get(key)
+        if filled is None and uniform:
+            # Every pixel matches, so any seed reaches the whole tile; uniform
+            # tiles of the same shape share one read-only mask
+            grown = matches
+        else:
+            if filled is not None:
+                matches = matches & ~filled
+            grown = scanline_mask(matches, spans, connectivity)
+        if not grown.any():
+            continue
+        masks[key] = grown if filled is None else filled | grown
+
+        # Seed the neighbouring tiles from the pixels on this tile's border
+        if grown is matches and uniform:
+            # A fully covered tile always seeds the same spans; work them out once
+            shape = grown.shape[::-1] + (id(grown),)
+            if shape not in full_spans:
+                full_spans[shape] = list(_border_spans(*_edge_pixels(grown), (0, 0), size,
+                                                       QRect(-size, -size, 3 * size, 3 * size),
+                                                       connectivity))
+            neighbours = [((key[0] + dx, key[1] + dy), spans) for (dx, dy), spans in full_spans[shape]]
+        else:
+            xs, ys = _edge_pixels(grown)
+            neighbours = _border_spans(xs + key[0] * size, ys + key[1] * size,
+                                       key, size, bounds, connectivity)
+        for neighbour, seed_spans in neighbours:
+            if not store.tile_rect(neighbour).intersects(bounds):
+                continue
+            done = masks.get(neighbour)
+            if done is not None:
+                if matches_cache[neighbour][1]:
+                    continue
+                seed_spans = [s for s in seed_spans if not done[s[0], s[1]:s[2] + 1].all()]
+            if seed_spans:
+                queue.setdefault(neighbour, []).extend(seed_spans)
+    return masks or None
+
+
+def _edge_pixels(mask):
+    """Columns and rows of the True pixels on the outer border of `mask`."""
+    edge = np.zeros_like(mask)
+    edge[[0, -1], :] = mask[[0, -1], :]
+    edge[:, [0, -1]] = mask[:, [0, -1]]
+    ys, xs = np.nonzero(edge)
+    return xs, ys
+
+
+def _border_spans(xs, ys, key, size, bounds, connectivity):
+    """Groups the outside neighbours of border pixels (xs, ys) into per-tile seed spans."""
+    offsets = np.array(_NEIGHBOURS[connectivity])
+    nx = (xs[:, None] + offsets[:, 0]).ravel()
+    ny = (ys[:, None] + offsets[:, 1]).ravel()
+    keep = (nx >= bounds.left()) & (ny >= bounds.top()) & \
+        (nx <= bounds.right()) & (ny <= bounds.bottom())
+    keep &= (nx // size != key[0]) | (ny // size != key[1])
+    nx, ny = nx[keep], ny[keep]
+    if nx.size == 0:
+        return []
+    points = np.unique(np.stack([ny, nx], axis=1), axis=0)
+    ny, nx = points[:, 0], points[:, 1]
+    keys_x, keys_y = nx // size, ny // size
+    # Consecutive columns of the same row and tile collapse into one span
+    breaks = np.flatnonzero((np.diff(ny) != 0) | (np.diff(nx) != 1) | (np.diff(keys_x) != 0)) + 1
+    firsts = np.concatenate(([0], breaks))
+    lasts = np.concatenate((breaks - 1, [nx.size - 1]))
+    groups = {}
+    for kx, ky, y, x0, x1 in zip(keys_x[firsts].tolist(), keys_y[firsts].tolist(),
+                                 (ny[firsts] % size).tolist(), (nx[firsts] % size).tolist(),
+                                 (nx[lasts] % size).tolist()):
+        groups.setdefault((kx, ky), []).append((y, x0, x1))
+    return groups.items()
+
+
+def fill_tiles(store, masks, color):
+    """Writes `color` into the pixels of every tile selected by `masks`."""
+    for key, mask in masks.items():
+        fill_mask(store.ensure_tile(key), mask, color)
+
+
+def tile_masks_bounds(store, masks):
+    """Bounding QRect, in image coordinates, of a {tile key: mask} fill region."""
+    rect = QRect()
+    for key, mask in masks.items():
+        rect = rect.united(mask_bounds(mask).translated(store.tile_rect(key).topLeft()))
+    return rect
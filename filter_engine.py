@@ -0,0 +1,415 @@
+"""
+Vectorized NumPy filters for the Effects menu.
+
+Filters work on (height, width, 3) uint8 RGB arrays, such as the views
+returned by image_bridge.  Two kinds exist:
+
+* point filters (invert, brightness, contrast, grayscale) are expressed as
+  256-entry lookup tables, so any run of them is fused into a single table
+  lookup per pixel, done by Pillow's Image.point (and the luma of grayscale
+  by its convert('L')), about twice as fast as NumPy fancy indexing; a run
+  that only inverts is a single np.invert pass instead;
+* convolutions (blur, sharpen) are sums of separable box kernels, so every
+  kernel costs a horizontal and a vertical 1D pass instead of a 2D one.
+
+A Pipeline strings filters together and executes each run of point filters
+as one traversal of the pixels.  The kernels reproduce Pillow's results for
+the same filters.
+
+A StripRunner executes a filter on a thread pool, one horizontal strip of
+the image per task.  NumPy, and Pillow inside point() and convert(),
+release the GIL while they work, so the strips are processed in parallel.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+IDENTITY_LUT = np.arange(256, dtype=np.uint8)
+INVERT_LUT = 255 - IDENTITY_LUT
+BLOCK_ROWS = 256  # rows handed to Pillow at a time; its tobytes() slows down on larger images
+
+
+def _pil_rgb(rgb):
+    """PIL image of an (h, w, 3) uint8 array, read straight from its buffer."""
+    height, width = rgb.shape[:2]
+    return Image.frombuffer('RGB', (width, height), np.ascontiguousarray(rgb), 'raw', 'RGB', 0, 1)
+
+
+def _through(image, lut):
+    """`image` with every channel mapped through `lut` (skipped for the identity)."""
+    if lut is IDENTITY_LUT:
+        return image
+    return image.point(lut.tolist() * len(image.getbands()))
+
+
+def _luma_image(rgb, lut=IDENTITY_LUT):
+    # ITU-R 601-2 luma, rounded as Pillow does
+    return _through(_pil_rgb(rgb), lut).convert('L')
+
+
+def _map_blocks(rgb, convert, out):
+    """Runs convert(block) -> PIL image over blocks of BLOCK_ROWS rows of `rgb`, into `out`."""
+    for top in range(0, rgb.shape[0], BLOCK_ROWS):
+        block = out[top:top + BLOCK_ROWS]
+        image = convert(rgb[top:top + BLOCK_ROWS])
+        data = np.frombuffer(image.tobytes(), np.uint8)
+        if image.mode == 'L':
+            # Gray: the same value in every channel, copied channel by channel
+            # (faster than a broadcast or Pillow's convert('RGB'))
+            data = data.reshape(block.shape[:2])
+            for channel in range(3):
+                block[..., channel] = data
+        else:
+            block.reshape(-1)[:] = data
+    return out
+
+
+def apply_lut(rgb, lut, out=None):
+    """Maps every channel value of `rgb` through `lut`, into `out` when given."""
+    if out is None:
+        out = np.empty(rgb.shape, np.uint8)
+    if lut is IDENTITY_LUT:
+        np.copyto(out, rgb)
+    elif np.array_equal(lut, INVERT_LUT):
+        # A single ufunc pass, much faster than any table lookup
+        np.invert(rgb, out=out)
+    else:
+        _map_blocks(rgb, lambda block: _through(_pil_rgb(block), lut), out)
+    return out
+
+
+def blend_lut(degenerate, factor):
+    """Lookup table of Pillow's Image.blend(degenerate, image, factor) for one channel."""
+    values = np.float32(degenerate) + np.float32(factor) * (np.arange(256, dtype=np.float32)
+                                                            - np.float32(degenerate))
+    return np.clip(values, 0, 255).astype(np.uint8)
+
+
+class Filter:
+    """Base class; `radius` is how far a filter reads around each output pixel."""
+    radius = 0
+
+    def apply(self, rgb):
+        raise NotImplementedError
+
+
+class PointFilter(Filter):
+    """A filter that maps every channel value through the same lookup table."""
+
+    def lut(self, mean):
+        """
+        The 256-entry uint8 table of the filter.
+
+        `mean` is a callable returning the mean luma of the filter's input,
+        for filters (like contrast) that depend on it.
+        """
+        raise NotImplementedError
+
+    def apply(self, rgb):
+        return Pipeline([self]).apply(rgb)
+
+
+class Invert(PointFilter):
+    def lut(self, mean):
+        return INVERT_LUT
+
+
+class Brightness(PointFilter):
+    def __init__(self, factor):
+        self.factor = factor
+
+    def lut(self, mean):
+        return blend_lut(0, self.factor)
+
+
+class Contrast(PointFilter):
+    def __init__(self, factor):
+        self.factor = factor
+
+    def lut(self, mean):
+        return blend_lut(int(mean() + 0.5), self.factor)
+
+
+class Grayscale(Filter):
+    """Replaces every channel with the pixel's luma."""
+
+    def apply(self, rgb):
+        return Pipeline([self]).apply(rgb)
+
+
+class Convolution(Filter):
+    """
+    Sum of separable box kernels: sum(weight * box(width)) / divisor.
+
+    `terms` is a list of (weight, width, skip) tuples; a term adds the box of
+    `width` pixels around each pixel minus the inner box of `skip` pixels.
+    Like Pillow, the outermost `radius` pixels of the image are copied unchanged.
+    """
+
+    def __init__(self, terms, divisor):
+        self.terms = terms
+        self.divisor = divisor
+        self.radius = max(width for _, width, _ in terms) // 2
+
+    def apply(self, rgb):
+        height, width = rgb.shape[:2]
+        r = self.radius
+        if height <= 2 * r or width <= 2 * r:
+            return rgb.copy()
+        # int16 holds every intermediate sum of the built-in kernels
+        bound = 255 * sum(abs(weight) * size * size for weight, size, _ in self.terms)
+        dtype = np.int16 if bound < 2 ** 15 else np.int32
+        source = rgb.astype(dtype)
+        total = np.zeros((height - 2 * r, width - 2 * r, 3), dtype)
+        for weight, size, skip in self.terms:
+            total += self._box(source, size, dtype) * dtype(weight)
+            if skip:
+                total -= self._box(source, skip, dtype) * dtype(weight)
+        # Pillow rounds half away from zero; negative sums clip to 0 either way,
+        # so rounding half up is enough
+        total += self.divisor // 2
+        total //= self.divisor
+        out = rgb.copy()
+        out[r:-r, r:-r] = np.clip(total, 0, 255)
+        return out
+
+    def _box(self, source, size, dtype):
+        """Box sums of `size` x `size` pixels, cropped to the filter's interior."""
+        r = self.radius
+        k = size // 2
+        height, width = source.shape[:2]
+        # Horizontal pass over the rows that the vertical pass needs
+        rows = source[r - k:height - r + k]
+        horizontal = rows[:, r - k:width - r - k].copy()
+        for dx in range(-k + 1, k + 1):
+            horizontal += rows[:, r + dx:width - r + dx]
+        vertical = horizontal[:height - 2 * r].copy()
+        for dy in range(1, 2 * k + 1):
+            vertical += horizontal[dy:dy + height - 2 * r]
+        return vertical
+
+
+class Blur(Convolution):
+    """Pillow's ImageFilter.BLUR: the 16 pixels on the border of a 5x5 box."""
+
+    def __init__(self):
+        super().__init__([(1, 5, 3)], 16)
+
+
+class Sharpen(Convolution):
+    """Pillow's ImageFilter.SHARPEN: 32 * centre - 2 * 3x3 neighbours, over 16."""
+
+    def __init__(self):
+        super().__init__([(34, 1, 0), (-2, 3, 0)], 16)
+
+
+class PointRun:
+    """
+    A run of point filters and grayscale steps compiled into lookup tables.
+
+    The run computes post[luma(pre[rgb])] when it turns the image gray and
+    post[rgb] otherwise, so it is one traversal of the pixels either way and
+    can be applied to any part of the image independently.  `histogram(lut)`
+    returns the luma histogram of the whole input mapped through `lut`; it is
+    only called by filters that depend on the mean (contrast).
+    """
+
+    def __init__(self, stages, histogram, count):
+        self.pre = None  # table applied before the luma sum, once the run turned gray
+        lut = IDENTITY_LUT
+        gray_hist = None
+
+        def mean():
+            # Mean luma of the image as it is at this point of the run
+            nonlocal gray_hist
+            if self.pre is None:
+                return float((histogram(lut) * IDENTITY_LUT).sum() / count)
+            if gray_hist is None:
+                gray_hist = histogram(self.pre)
+            return float((gray_hist * lut).sum() / count)
+
+        for stage in stages:
+            if isinstance(stage, Grayscale):
+                if self.pre is None:
+                    self.pre, lut = lut, IDENTITY_LUT
+                continue
+            lut = stage.lut(mean)[lut]
+        self.post = lut
+
+    def apply(self, rgb, out=None):
+        """The run applied to `rgb`, written into `out` when given."""
+        if self.pre is None:
+            return apply_lut(rgb, self.post, out)
+        if out is None:
+            out = np.empty(rgb.shape, np.uint8)
+        return _map_blocks(rgb, lambda block: _through(_luma_image(block, self.pre), self.post), out)
+
+
+def luma_histogram(rgb, lut=IDENTITY_LUT):
+    """256-bin histogram of the luma of `rgb` mapped through `lut`."""
+    return np.array(_luma_image(rgb, lut).histogram(), np.int64)
+
+
+class Pipeline(Filter):
+    """Runs filters in order, fusing every run of point filters into one pass."""
+
+    def __init__(self, filters):
+        self.filters = list(filters)
+        self.radius = sum(f.radius for f in self.filters)
+
+    def steps(self):
+        """Yields the convolutions, and lists of consecutive point filters, in order."""
+        run = []
+        for stage in self.filters:
+            if isinstance(stage, (PointFilter, Grayscale)):
+                run.append(stage)
+                continue
+            if run:
+                yield run
+                run = []
+            yield stage
+        if run:
+            yield run
+
+    def apply(self, rgb):
+        for step in self.steps():
+            if isinstance(step, list):
+                count = max(rgb.shape[0] * rgb.shape[1], 1)
+                step = PointRun(step, lambda lut, rgb=rgb: luma_histogram(rgb, lut), count)
+            rgb = step.apply(rgb)
+        return rgb
+
+
+FILTERS = {
+    'blur': lambda factor: Blur(),
+    'sharpen': lambda factor: Sharpen(),
+    'grayscale': lambda factor: Grayscale(),
+    'invert': lambda factor: Invert(),
+    'brightness': lambda factor: Brightness(factor),
+    'contrast': lambda factor: Contrast(factor),
+}
+
+
+def make_filter(filter_name, factor=1.0):
+    """The Filter behind an Effects menu entry."""
+    return FILTERS[filter_name](factor)
+
+
+def apply_filters(rgb, names_and_factors):
+    """Runs several Effects filters over `rgb` as one fused Pipeline."""
+    return Pipeline([make_filter(name, factor) for name, factor in names_and_factors]).apply(rgb)
+
+
+MIN_STRIP_ROWS = 64
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+class StripRunner:
+    """
+    Runs filters over horizontal strips of an image on a thread pool.
+
+    A convolution reads each strip with `radius` extra rows above and below
+    (the halo) and keeps only the strip's own rows of the result, so the
+    stitched image is identical to filtering it in one piece.  Strips span
+    the full width, which keeps them contiguous in memory: Pillow reads a
+    strip straight from its buffer and its result lands in one block of the
+    output, with no copy in between.  A run of point filters first sums the
+    luma histograms of the strips if it needs the image mean, then maps every
+    strip through its tables.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = max(int(workers or default_workers()), 1)
+        self._pool = ThreadPoolExecutor(self.workers) if self.workers > 1 else None
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def strips(self, height):
+        """(top, bottom) row ranges covering `height` rows, a few per worker."""
+        count = max(min(self.workers * 4, height // MIN_STRIP_ROWS), 1)
+        bounds = np.linspace(0, height, count + 1).astype(int)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def map(self, func, items):
+        if self._pool is None:
+            return [func(item) for item in items]
+        return list(self._pool.map(func, items))
+
+    def run(self, image_filter, rgb, progress=None):
+        """
+        Applies `image_filter` (any Filter, including a Pipeline) to an (h, w, 3) array.
+
+        `progress(done, total)` is called, from the worker threads, before and
+        after every strip; an exception it raises aborts the run.
+        """
+        pipeline = image_filter if isinstance(image_filter, Pipeline) else Pipeline([image_filter])
+        steps = list(pipeline.steps())
+        counter = _StripCounter(progress, len(steps) * len(self.strips(rgb.shape[0])))
+        for step in steps:
+            if isinstance(step, list):
+                rgb = self._point_run(step, rgb, counter)
+            else:
+                rgb = self._convolve(step, rgb, counter)
+        return rgb
+
+    def _point_run(self, stages, rgb, counter):
+        strips = self.strips(rgb.shape[0])
+
+        def histogram(lut):
+            return sum(self.map(lambda rows: luma_histogram(rgb[rows[0]:rows[1]], lut), strips))
+
+        run = PointRun(stages, histogram, max(rgb.shape[0] * rgb.shape[1], 1))
+        out = np.empty(rgb.shape, np.uint8)
+
+        def work(rows):
+            counter.check()
+            top, bottom = rows
+            run.apply(rgb[top:bottom], out[top:bottom])
+            counter.advance()
+
+        self.map(work, strips)
+        return out
+
+    def _convolve(self, stage, rgb, counter):
+        height = rgb.shape[0]
+        out = np.empty(rgb.shape, np.uint8)
+
+        def work(rows):
+            counter.check()
+            top, bottom = rows
+            halo_top = max(top - stage.radius, 0)
+            halo_bottom = min(bottom + stage.radius, height)
+            result = stage.apply(rgb[halo_top:halo_bottom])
+            out[top:bottom] = result[top - halo_top:bottom - halo_top]
+            counter.advance()
+
+        self.map(work, self.strips(height))
+        return out
+
+
+class _StripCounter:
+    """Thread-safe count of finished strips, forwarded to a progress callback."""
+
+    def __init__(self, progress, total):
+        self.progress = progress
+        self.total = total
+        self.done = 0
+        self._lock = threading.Lock()
+
+    def check(self):
+        if self.progress is not None:
+            self.progress(self.done, self.total)
+
+    def advance(self):
+        with self._lock:
+            self.done += 1
+        self.check()
@@ -0,0 +1,213 @@
+"""
+Gradient tool: linear, radial and conical gradients over multi-stop colour ramps.
+
+A ramp is turned once into a lookup table of LUT_SIZE premultiplied
+colours, stored as the 32-bit words of finished pixels.  Rendering a block
+then computes every pixel's table index in a few in-place float32 NumPy
+passes, a few rows at a time, and gathers the words straight into the
+QImage; nothing is evaluated per pixel in Python.  With dithering on, the
+table is kept in 64 variants rounded against the thresholds of an 8x8
+ordered (Bayer) matrix, so breaking up the 8-bit bands of a long, subtle
+ramp only offsets the index.  The matrix
+is anchored to image coordinates, so blocks rendered separately (one per
+tile) line up seamlessly.
+
+Undithered linear and radial gradients are faster to fill with QPainter;
+qgradient() builds the matching QGradient from the same stops.
+"""
+import functools
+import math
+
+import numpy as np
+from PyQt5.QtCore import QPointF, QRect
+from PyQt5.QtGui import QColor, QConicalGradient, QImage, QLinearGradient, QRadialGradient
+
+from image_bridge import ALPHA_CHANNEL, RGB_CHANNELS, pixel_view
+
+KINDS = ('linear', 'radial', 'conical')
+QPAINTER_KINDS = ('linear', 'radial')  # QPainter fills these faster than render(); conical it fills slower
+LUT_SIZE = 4096
+BLOCK_PIXELS = 64 * 1024  # pixels rendered at a time
+RAMPS = ('color to transparent', 'primary to secondary', 'rainbow')
+RAINBOW = ['#ff0000', '#ffff00', '#00ff00', '#00ffff', '#0000ff', '#ff00ff', '#ff0000']
+
+
+def _bayer(size):
+    matrix = np.zeros((1, 1), np.intp)
+    while matrix.shape[0] < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return matrix
+
+
+BAYER = _bayer(8)  # threshold level (0-63) of every pixel, repeating every 8 pixels
+
+
+def ramp_stops(ramp, primary, secondary):
+    """The (position, QColor) stops of the preset `ramp` (one of RAMPS)."""
+    if ramp == 'color to transparent':
+        clear = QColor(primary)
+        clear.setAlpha(0)
+        return [(0.0, QColor(primary)), (1.0, clear)]
+    if ramp == 'primary to secondary':
+        return [(0.0, QColor(primary)), (1.0, QColor(secondary))]
+    if ramp == 'rainbow':
+        return [(index / (len(RAINBOW) - 1), QColor(name)) for index, name in enumerate(RAINBOW)]
+    raise ValueError(f'Unknown gradient ramp: {ramp}')
+
+
+class Ramp:
+    """
+    Lookup tables of a multi-stop colour ramp, as premultiplied ARGB32 pixel words.
+
+    `plain[i]` is entry i rounded to nearest; `levels[k * size + i]` is it
+    rounded against Bayer threshold k.
+    """
+
+    def __init__(self, stops, size=LUT_SIZE):
+        stops = sorted(((float(position), QColor(color)) for position, color in stops), key=lambda s: s[0])
+        positions = [position for position, _ in stops]
+        # Stops are interpolated premultiplied, so fading to transparent does not darken
+        values = np.zeros((len(stops), 4))
+        for row, (_, color) in enumerate(stops):
+            alpha = color.alpha()
+            values[row, RGB_CHANNELS] = [channel * alpha / 255
+                                         for channel in (color.red(), color.green(), color.blue())]
+            values[row, ALPHA_CHANNEL] = alpha
+        t = np.linspace(0.0, 1.0, size)
+        self.size = size
+        self.lut = np.stack([np.interp(t, positions, values[:, channel]) for channel in range(4)], axis=1)
+        thresholds = (np.arange(BAYER.size) + 0.5) / BAYER.size
+        self.levels = self._words(self.lut[None] + thresholds[:, None, None]).reshape(-1)
+        self.plain = self._words(self.lut + 0.5)
+
+    @staticmethod
+    def _words(values):
+        pixels = np.clip(np.floor(values), 0, 255).astype(np.uint8)
+        # A premultiplied colour channel never exceeds the alpha
+        alpha = pixels[..., ALPHA_CHANNEL:ALPHA_CHANNEL + 1]
+        pixels[..., RGB_CHANNELS] = np.minimum(pixels[..., RGB_CHANNELS], alpha)
+        return np.ascontiguousarray(pixels).view(np.uint32)[..., 0]
+
+
+@functools.lru_cache(maxsize=16)
+def _cached_ramp(stops):
+    return Ramp([(position, QColor.fromRgba(rgba)) for position, rgba in stops])
+
+
+def ramp(stops):
+    """The Ramp of `stops` [(position 0-1, QColor), ...], shared while the stops stay the same."""
+    return _cached_ramp(tuple((float(position), QColor(color).rgba()) for position, color in stops))
+
+
+def gradient_rect(kind, start, end):
+    """Image area the gradient tool fills: the box from start to end, or the circle around start."""
+    if kind == 'linear':
+        return QRect(start, end).normalized()
+    radius = math.ceil(math.hypot(end.x() - start.x(), end.y() - start.y()))
+    return QRect(start.x() - radius, start.y() - radius, 2 * radius + 1, 2 * radius + 1)
+
+
+def qgradient(kind, start, end, stops):
+    """
+    The QGradient of the same fill as render() without dithering, for QPainter to draw.
+
+    Its geometry is moved by half a pixel, since render() samples pixel
+    (x, y) at image point (x, y) and QPainter at the pixel's centre.
+    Returns None when start and end coincide, which QPainter fills differently.
+    """
+    if start == end and kind != 'conical':
+        return None
+    centre = QPointF(start) + QPointF(0.5, 0.5)
+    dx, dy = end.x() - start.x(), end.y() - start.y()
+    if kind == 'linear':
+        gradient = QLinearGradient(centre, QPointF(end) + QPointF(0.5, 0.5))
+    elif kind == 'radial':
+        gradient = QRadialGradient(centre, math.hypot(dx, dy))
+    elif kind == 'conical':
+        gradient = QConicalGradient(centre, -math.degrees(math.atan2(dy, dx)))
+    else:
+        raise ValueError(f'Unknown gradient kind: {kind}')
+    for position, color in stops:
+        gradient.setColorAt(position, QColor(color))
+    return gradient
+
+
+def positions(kind, start, end, xs, ys, out=None):
+    """
+    Position (0-1, float32) along the gradient of the points (xs, ys), relative to `start`.
+
+    `xs` is a row and `ys` a column of float32 coordinates; the result has
+    one row per y and one column per x, and is written into `out` when given.
+    """
+    dx, dy = end.x() - start.x(), end.y() - start.y()
+    shape = (ys.shape[0], xs.shape[1])
+    if out is None:
+        out = np.empty(shape, np.float32)
+    if kind == 'linear':
+        length = dx * dx + dy * dy
+        if not length:
+            out.fill(0.0)
+            return out
+        # The projection is separable: one term per column plus one per row
+        np.add(xs * np.float32(dx / length), ys * np.float32(dy / length), out=out)
+    elif kind == 'radial':
+        radius = math.hypot(dx, dy)
+        if not radius:
+            out.fill(1.0)
+            return out
+        # sqrt(x^2 + y^2) rather than np.hypot, which is far slower on float32
+        np.add(xs * xs, ys * ys, out=out)
+        np.sqrt(out, out=out)
+        out *= np.float32(1 / radius)
+    elif kind == 'conical':
+        # Once around start, counter-clockwise on screen, from the direction of end
+        np.arctan2(ys, xs, out=out)
+        out *= np.float32(-1 / (2 * math.pi))
+        out += np.float32(math.atan2(dy, dx) / (2 * math.pi))
+        # Wrapped into (0, 1], so the pixels on the seam end the turn as in
+        # QPainter; x - ceil(x) + 1 is much faster than x % 1
+        out -= np.ceil(out)
+        out += np.float32(1.0)
+    else:
+        raise ValueError(f'Unknown gradient kind: {kind}')
+    return np.clip(out, 0.0, 1.0, out=out)
+
+
+def render(rect, kind, start, end, gradient_ramp, dither=True, scale=1.0):
+    """
+    QImage (premultiplied ARGB) of the gradient over the image rectangle `rect`.
+
+    With `scale` above 1 every pixel of the result stands for scale x scale
+    image pixels, for quick previews; draw it stretched over `rect`.
+    """
+    width = max(1, math.ceil(rect.width() / scale))
+    height = max(1, math.ceil(rect.height() / scale))
+    # Image coordinates of the sampled pixel centres
+    columns = rect.left() + (np.arange(width, dtype=np.float32) + 0.5) * np.float32(scale) - 0.5
+    rows = rect.top() + (np.arange(height, dtype=np.float32) + 0.5) * np.float32(scale) - 0.5
+    xs = (columns - start.x())[None, :]
+    ys = (rows - start.y())[:, None]
+    image = QImage(width, height, QImage.Format_ARGB32_Premultiplied)
+    words = pixel_view(image).view(np.uint32)[..., 0]
+    if dither:
+        # Row phase p of the matrix offsets every index of the rows with y % 8 == p into its table
+        offsets = BAYER[:, np.floor(columns).astype(np.intp) % 8] * gradient_ramp.size
+        phases = np.floor(rows).astype(np.intp) % 8
+    table = gradient_ramp.levels if dither else gradient_ramp.plain
+    # A few rows at a time, through two buffers that stay in the CPU cache
+    block = max(1, BLOCK_PIXELS // width)
+    t = np.empty((min(block, height), width), np.float32)
+    index = np.empty(t.shape, np.intp)
+    for top in range(0, height, block):
+        count = min(block, height - top)
+        part, part_index = t[:count], index[:count]
+        positions(kind, start, end, xs, ys[top:top + count], part)
+        part *= gradient_ramp.size - 1
+        part += 0.5
+        np.copyto(part_index, part, casting='unsafe')
+        if dither:
+            for first in range(min(8, count)):
+                part_index[first::8] += offsets[phases[top + first]]
+        # Every index is in range; 'clip' skips the bounds check that raises
+        np.take(table, part_index, out=words[top:top + count], mode='clip')
+    return image
@@ -0,0 +1,237 @@
+"""
+Undo/redo history that stores only the tiles an edit changed.
+
+Before an edit draws into a region of one of the canvas' layers (each a
+TiledImage), the canvas calls `touch()` so the untouched ("before") state
+of the affected tiles can be captured.  Capturing only takes copy-on-write
+handles of the tiles: Qt duplicates a tile's pixels when the edit paints on
+it, so touching a large area costs nothing for the tiles left alone.  When
+the edit is finished, `commit()` skips the tiles whose pixels are still the
+captured ones, captures the others again ("after"), drops the ones that did
+not change and keeps both halves zlib-compressed.  Undo and redo then put
+the matching half back instead of copying whole frames.  Tiles that were
+still unallocated background are recorded as such and cost nothing.  Every
+patch remembers the layer it was taken from, so undo restores the right
+layer whichever one is active.
+
+Edits of vector layers also `touch_shape()` the shapes they change; the
+entry keeps the shape objects from before and after, so undo puts back the
+shapes together with the pixels they were rendered to.  An edit that turns
+a vector layer into a pixel layer `touch_vector()`s it first, so undo makes
+it a vector layer again.
+"""
+import zlib
+from collections import deque
+
+from PyQt5.QtCore import QRect
+from PyQt5.QtGui import QImage
+
+DEFAULT_BUDGET = 256 * 1024 * 1024  # bytes of compressed history
+
+
+class Patch:
+    """
+    Pixels of one store tile: a shared QImage handle until compress(), then
+    compressed pixels (data is None for an unallocated tile).
+    """
+    __slots__ = ('store', 'key', 'tile', 'size', 'bytes_per_line', 'format', 'data')
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        tile = store.tile(key)
+        self.tile = None if tile is None else QImage(tile)
+        self.data = None
+
+    def is_current(self):
+        """True while the store still holds exactly these pixels (the tile was not painted on)."""
+        tile = self.store.tile(self.key)
+        if tile is None or self.tile is None:
+            return tile is None and self.tile is None
+        # Painting on a shared tile detaches it, which gives it a new cache key
+        return tile.cacheKey() == self.tile.cacheKey()
+
+    def compress(self):
+        """Replaces the handle by compressed pixels, releasing the shared tile; returns self."""
+        tile, self.tile = self.tile, None
+        if tile is not None:
+            self.size = tile.size()
+            self.bytes_per_line = tile.bytesPerLine()
+            self.format = tile.format()
+            self.data = zlib.compress(tile.constBits().asstring(tile.byteCount()), 1)
+        return self
+
+    def __len__(self):
+        return len(self.data) if self.data is not None else 0
+
+    def __eq__(self, other):
+        return self.key == other.key and self.data == other.data
+
+    def paste(self):
+        """Puts the tile back into the store it was taken from."""
+        store = self.store
+        if self.data is None:
+            store.drop_tile(self.key)
+            return
+        raw = zlib.decompress(self.data)
+        tile = QImage(raw, self.size.width(), self.size.height(), self.bytes_per_line, self.format)
+        store.set_tile(self.key, tile.copy())
+
+
+class HistoryEntry:
+    """One undoable edit: the before/after patches of every tile and the before/after shapes it changed."""
+    __slots__ = ('size_before', 'size_after', 'patches', 'shapes', 'vectors', 'nbytes')
+
+    def __init__(self, size_before, size_after, patches, shapes=(), vectors=()):
+        self.size_before = size_before
+        self.size_after = size_after
+        self.patches = patches
+        self.shapes = shapes  # (VectorLayer, shape id, Shape or None before, after)
+        self.vectors = vectors  # (Layer, VectorLayer or None before, after)
+        self.nbytes = sum(len(before) + len(after) for before, after in patches)
+
+
+class History:
+    """Tile-delta undo/redo stacks limited by a compressed byte budget."""
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.undo_stack = deque()
+        self.redo_stack = deque()
+        self.used_bytes = 0
+        self.revision = 0  # changes whenever the image moves to another history state
+        self._pending = {}
+        self._pending_shapes = {}  # (VectorLayer, shape id) -> Shape or None before the edit
+        self._pending_vectors = {}  # Layer -> its VectorLayer or None before the edit
+        self._pending_size = None
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self._evict()
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.used_bytes = 0
+        self.revision += 1
+        self._pending = {}
+        self._pending_shapes = {}
+        self._pending_vectors = {}
+        self._pending_size = None
+
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def touch(self, store, rect):
+        """Captures the current state of the tiles under `rect` before they get drawn on."""
+        if self._pending_size is None:
+            self._pending_size = store.size()
+        for key in store.tile_keys(rect):
+            if (store, key) not in self._pending:
+                self._pending[store, key] = Patch(store, key)
+
+    def touch_shape(self, vector, shape_id, size):
+        """Captures shape `shape_id` of `vector` (a VectorLayer) before it is changed; `size` is the image size."""
+        if self._pending_size is None:
+            self._pending_size = size
+        if (vector, shape_id) not in self._pending_shapes:
+            self._pending_shapes[vector, shape_id] = vector.get(shape_id)
+
+    def touch_vector(self, layer, size):
+        """Captures whether `layer` is a vector layer (its VectorLayer) before that changes."""
+        if self._pending_size is None:
+            self._pending_size = size
+        if layer not in self._pending_vectors:
+            self._pending_vectors[layer] = layer.vector
+
+    def commit(self, store):
+        """
+        Closes the current edit and pushes its changed tiles; returns False if nothing changed.
+
+        `store` is anything with the image size (a layer or the layer stack).
+        """
+        if self._pending_size is None:
+            return False
+        size_before = self._pending_size
+        patches = []
+        for (layer, key), before in self._pending.items():
+            if before.is_current():
+                continue
+            before.compress()
+            after = Patch(layer, key).compress()
+            if before != after:
+                patches.append((before, after))
+        shapes = [(vector, shape_id, before, vector.get(shape_id))
+                  for (vector, shape_id), before in self._pending_shapes.items()
+                  if vector.get(shape_id) is not before]
+        vectors = [(layer, before, layer.vector) for layer, before in self._pending_vectors.items()
+                   if layer.vector is not before]
+        self._pending = {}
+        self._pending_shapes = {}
+        self._pending_vectors = {}
+        self._pending_size = None
+        if not patches and not shapes and not vectors and size_before == store.size():
+            return False
+
+        entry = HistoryEntry(size_before, store.size(), patches, shapes, vectors)
+        self.revision += 1
+        self.undo_stack.append(entry)
+        self.used_bytes += entry.nbytes
+        for dropped in self.redo_stack:
+            self.used_bytes -= dropped.nbytes
+        self.redo_stack.clear()
+        self._evict()
+        return True
+
+    def undo(self, store):
+        """
+        Reverts the newest edit; returns the rectangle that changed.
+
+        Patches go back into their own layers; `store` (the layer stack) is
+        resized when the edit changed the image size.
+        """
+        if not self.undo_stack:
+            return QRect()
+        entry = self.undo_stack.pop()
+        self.redo_stack.append(entry)
+        return self._apply(store, entry.size_before, entry.size_after,
+                           [before for before, _ in entry.patches],
+                           [(vector, shape_id, before) for vector, shape_id, before, _ in entry.shapes],
+                           [(layer, before) for layer, before, _ in entry.vectors])
+
+    def redo(self, store):
+        """Re-applies the newest undone edit (see undo()); returns the rectangle that changed."""
+        if not self.redo_stack:
+            return QRect()
+        entry = self.redo_stack.pop()
+        self.undo_stack.append(entry)
+        return self._apply(store, entry.size_after, entry.size_before,
+                           [after for _, after in entry.patches],
+                           [(vector, shape_id, after) for vector, shape_id, _, after in entry.shapes],
+                           [(layer, after) for layer, _, after in entry.vectors])
+
+    def _apply(self, store, size, other_size, patches, shapes, vectors):
+        self.revision += 1
+        changed = QRect()
+        # Only edits that changed the image size (such as opening a file) resize it back
+        if size != other_size:
+            store.resize(size)
+            changed = QRect(0, 0, max(size.width(), other_size.width()),
+                            max(size.height(), other_size.height()))
+        for patch in patches:
+            patch.paste()
+            changed = changed.united(store.tile_rect(patch.key))
+        # The pixels the shapes were rendered to came back with the patches
+        for vector, shape_id, shape in shapes:
+            vector.put(shape_id, shape)
+        for layer, vector in vectors:
+            layer.vector = vector
+        return changed
+
+    def _evict(self):
+        # The newest entry always survives, even when it alone exceeds the budget
+        while self.used_bytes > self.budget and len(self.undo_stack) > 1:
+            self.used_bytes -= self.undo_stack.popleft().nbytes
@@ -0,0 +1,115 @@
+"""
+In-memory conversions between QImage, NumPy arrays and PIL images.
+
+Nothing here encodes to PNG or any other file format: arrays are views on
+the QImage pixel buffer, and PIL images are unpacked straight from it.
+Canvas images are Format_RGB32, whose 32-bit pixels are stored as B, G, R, A
+bytes on little-endian machines and A, R, G, B on big-endian ones.
+"""
+import sys
+
+import numpy as np
+from PIL import Image
+from PyQt5.QtGui import QImage
+
+# Byte order of the channels of a Format_RGB32/ARGB32 pixel in memory
+if sys.byteorder == 'little':
+    RGB_CHANNELS = [2, 1, 0]
+    ALPHA_CHANNEL = 3
+    RAW_MODE = 'BGRX'
+else:
+    RGB_CHANNELS = [1, 2, 3]
+    ALPHA_CHANNEL = 0
+    RAW_MODE = 'XRGB'
+
+_32BIT_FORMATS = (QImage.Format_RGB32, QImage.Format_ARGB32, QImage.Format_ARGB32_Premultiplied)
+
+
+def ensure_32bit(image):
+    """Returns `image` itself when it is 32-bit, otherwise a Format_RGB32 conversion."""
+    if image.format() in _32BIT_FORMATS:
+        return image
+    return image.convertToFormat(QImage.Format_RGB32)
+
+
+def pixel_view(image):
+    """Returns a writable (height, width, 4) uint8 view of a 32-bit QImage."""
+    ptr = image.bits()
+    ptr.setsize(image.byteCount())
+    rows = np.frombuffer(ptr, np.uint8).reshape(image.height(), image.bytesPerLine())
+    return rows[:, :image.width() * 4].reshape(image.height(), image.width(), 4)
+
+
+def const_pixel_view(image):
+    """Read-only (height, width, 4) view of a 32-bit QImage; never detaches shared data."""
+    ptr = image.constBits()
+    ptr.setsize(image.byteCount())
+    rows = np.frombuffer(ptr, np.uint8).reshape(image.height(), image.bytesPerLine())
+    return rows[:, :image.width() * 4].reshape(image.height(), image.width(), 4)
+
+
+def _rgb_channels(pixels):
+    # A strided slice rather than fancy indexing, so the result stays a view
+    if RGB_CHANNELS[0] == 2:
+        return pixels[..., 2::-1]
+    return pixels[..., 1:4]
+
+
+def rgb_view(image):
+    """Writable (height, width, 3) view of the R, G, B channels of a 32-bit QImage."""
+    return _rgb_channels(pixel_view(image))
+
+
+def to_rgb_array(image):
+    """Contiguous (height, width, 3) uint8 RGB copy of any QImage."""
+    return np.ascontiguousarray(_rgb_channels(const_pixel_view(ensure_32bit(image))))
+
+
+def write_rgb(image, rgb, pos=(0, 0), opaque=True):
+    """
+    Writes an (h, w, 3) RGB array into a 32-bit QImage at `pos`.
+
+    The written pixels are made opaque, unless `opaque` is False, which
+    keeps the alpha channel as it is (for Format_ARGB32 images).
+    """
+    x, y = pos
+    h, w = rgb.shape[:2]
+    pixels = pixel_view(image)[y:y + h, x:x + w]
+    _rgb_channels(pixels)[...] = rgb
+    if opaque:
+        pixels[..., ALPHA_CHANNEL] = 255
+
+
+def array_to_qimage(rgb):
+    """New Format_RGB32 QImage holding the (height, width, 3) uint8 RGB array."""
+    h, w = rgb.shape[:2]
+    image = QImage(w, h, QImage.Format_RGB32)
+    write_rgb(image, rgb)
+    return image
+
+
+def qimage_to_pil(image):
+    """
+    PIL RGB image unpacked directly from the QImage buffer.
+
+    Pillow copies while unpacking the 32-bit pixels to RGB, but there is no
+    file encoding or decoding involved.
+    """
+    image = ensure_32bit(image)
+    ptr = image.constBits()
+    ptr.setsize(image.byteCount())
+    return Image.frombuffer('RGB', (image.width(), image.height()), ptr,
+                            'raw', RAW_MODE, image.bytesPerLine(), 1)
+
+
+def pil_to_qimage(pil_image, target=None):
+    """
+    Writes a PIL image into `target` (a 32-bit QImage of the same size) or a new QImage.
+
+    Returns the QImage that was written.
+    """
+    rgb = np.asarray(pil_image.convert('RGB'))
+    if target is None:
+        return array_to_qimage(rgb)
+    write_rgb(target, rgb)
+    return target
@@ -0,0 +1,152 @@
+"""
+Full-resolution reading and streaming writing of canvas images.
+
+Reading: uncompressed formats (PPM/PGM, 24-bit BMP, uncompressed TIFF
+strips or tiles, ...) are memory-mapped using the raw data layout Pillow
+reports for the file, and copied into the TiledImage one tile at a time,
+so the file is never decoded into a second full-size buffer.  Compressed
+formats are decoded once with QImageReader and copied into tiles.
+
+Writing: PNG and PPM are streamed out one row of tiles at a time, so
+the only full-size copy of the image is the TiledImage itself.  Other
+formats are composed into one QImage and saved by Qt.
+"""
+import os
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+from PyQt5.QtCore import QRect, QSize
+from PyQt5.QtGui import QImageReader
+
+import image_bridge
+
+# Raw layouts of pixel data that can be mapped: rawmode -> bytes per pixel
+MAPPABLE_RAWMODES = {'RGB': 3, 'BGR': 3, 'L': 1}
+PNG_COMPRESSION = 6
+
+
+class ImageReadError(Exception):
+    """The file could not be decoded as an image."""
+
+
+def _raw_regions(path):
+    """
+    Memory-mapped (box, pixels) regions covering the whole image, or None.
+
+    None means the file is compressed or in a layout that cannot be mapped,
+    and has to be decoded instead.
+    """
+    with Image.open(path) as image:
+        size, tiles = image.size, list(image.tile)
+    regions = []
+    for tile in tiles:
+        codec, box, offset, args = tile[0], tile[1], tile[2], tile[3]
+        rawmode, stride, orientation = (args, 0, 1) if isinstance(args, str) else (tuple(args) + (0, 1))[:3]
+        if codec != 'raw' or rawmode not in MAPPABLE_RAWMODES:
+            return None
+        channels = MAPPABLE_RAWMODES[rawmode]
+        width, height = box[2] - box[0], box[3] - box[1]
+        stride = stride or width * channels
+        rows = np.memmap(path, np.uint8, 'r', offset, (height, stride))
+        if orientation < 0:
+            rows = rows[::-1]
+        pixels = rows[:, :width * channels].reshape(height, width, channels)
+        if rawmode == 'BGR':
+            pixels = pixels[..., ::-1]
+        # Still views on the file; grayscale (h, w, 1) broadcasts to RGB when written
+        regions.append((box, pixels))
+    covered = sum((box[2] - box[0]) * (box[3] - box[1]) for box, _ in regions)
+    return regions if covered == size[0] * size[1] else None
+
+
+def image_size(path):
+    """Size of the image in `path` without decoding it; raises ImageReadError."""
+    reader = QImageReader(path)
+    size = reader.size()
+    if size.isValid():
+        return size
+    try:
+        with Image.open(path) as image:
+            return QSize(*image.size)
+    except Exception as e:
+        raise ImageReadError(str(e))
+
+
+def read_into(store, path):
+    """
+    Loads the image in `path` into `store` at full resolution, at (0, 0).
+
+    The store should already have the image's size and a plain background;
+    blocks that are pure background leave their tiles unallocated.
+    """
+    try:
+        regions = _raw_regions(path)
+    except Exception:
+        regions = None
+    if regions is None:
+        reader = QImageReader(path)
+        image = reader.read()
+        if image.isNull():
+            raise ImageReadError(reader.errorString())
+        store.write(image)
+        return
+    for box, pixels in regions:
+        # The memmap slice of each tile is read from disk only when copied
+        store.write_array(pixels, (box[0], box[1]))
+
+
+def _bands(store):
+    """Yields RGB arrays of the rows of tiles of `store`, top to bottom."""
+    width = store.width()
+    for y in range(0, store.height(), store.tile_size):
+        band = QRect(0, y, width, min(store.tile_size, store.height() - y))
+        yield image_bridge.to_rgb_array(store.copy(band))
+
+
+def _png_chunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+
+def write_png(store, path, level=PNG_COMPRESSION):
+    """Streams `store` into an 8-bit RGB PNG, one row of tiles at a time."""
+    width, height = store.width(), store.height()
+    compressor = zlib.compressobj(level)
+    previous = np.zeros((1, width * 3), np.uint8)
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        for rgb in _bands(store):
+            rows = rgb.reshape(rgb.shape[0], width * 3)
+            # PNG "Up" filter: every row minus the row above it, which is cheap to vectorize
+            filtered = np.empty((rows.shape[0], width * 3 + 1), np.uint8)
+            filtered[:, 0] = 2
+            filtered[:, 1:] = rows - np.concatenate([previous, rows[:-1]])
+            previous = rows[-1:]
+            data = compressor.compress(filtered.tobytes())
+            if data:
+                f.write(_png_chunk(b'IDAT', data))
+        f.write(_png_chunk(b'IDAT', compressor.flush()))
+        f.write(_png_chunk(b'IEND', b''))
+
+
+def write_ppm(store, path):
+    """Streams `store` into a binary PPM, one row of tiles at a time."""
+    with open(path, 'wb') as f:
+        f.write(b'P6\n%d %d\n255\n' % (store.width(), store.height()))
+        for rgb in _bands(store):
+            f.write(rgb.tobytes())
+
+
+def save(store, path, png_level=PNG_COMPRESSION):
+    """Saves `store` to `path`, streaming PNG and PPM; returns False if Qt could not save it."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.png':
+        write_png(store, path, png_level)
+    elif extension in ('.ppm', '.pnm'):
+        write_ppm(store, path)
+    else:
+        return store.to_qimage().save(path)
+    return True
@@ -0,0 +1,135 @@
+"""
+Background jobs for long-running canvas work such as filters.
+
+A JobScheduler runs one job at a time on a worker thread and queues the
+others behind it.  A job is split into three parts:
+
+* prepare() runs on the GUI thread right before the job starts and captures
+  its input, so a queued job sees the result of the job before it;
+* run(progress) runs on the worker thread and returns the result;
+* finish(result) runs on the GUI thread and applies the result.
+
+`progress(done, total)` reports how far the job got and raises JobCancelled
+once the job has been cancelled, which is how cancellation reaches the work.
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtCore import QCoreApplication, QEventLoop, QObject, pyqtSignal
+
+
+class JobCancelled(Exception):
+    """Raised inside a job's work once the job has been cancelled."""
+
+
+class Job:
+    """Base class of background jobs; see the module docstring."""
+    name = 'job'
+
+    def __init__(self):
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def prepare(self):
+        pass
+
+    def run(self, progress):
+        raise NotImplementedError
+
+    def finish(self, result):
+        pass
+
+
+class JobScheduler(QObject):
+    """Runs submitted jobs one after the other off the GUI thread."""
+    started = pyqtSignal(object)
+    progressed = pyqtSignal(object, int)  # job, percent
+    finished = pyqtSignal(object)
+    cancelled = pyqtSignal(object)
+    failed = pyqtSignal(object, str)
+    _done = pyqtSignal(object, object, object)  # job, result, exception; crosses back to the GUI thread
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._queue = deque()
+        self.current = None
+        self._done.connect(self._on_done)
+
+    def submit(self, job):
+        """Queues `job` behind the running one; returns it."""
+        self._queue.append(job)
+        self._start_next()
+        return job
+
+    def busy(self):
+        return self.current is not None or bool(self._queue)
+
+    def cancel_all(self):
+        """Cancels the running job and drops the queued ones."""
+        while self._queue:
+            job = self._queue.popleft()
+            job.cancel()
+            self.cancelled.emit(job)
+        if self.current is not None:
+            self.current.cancel()
+
+    def join(self):
+        """Waits, still processing events, until every submitted job has ended."""
+        while self.busy():
+            QCoreApplication.processEvents(QEventLoop.AllEvents, 50)
+            time.sleep(0.005)
+
+    def shutdown(self):
+        self.cancel_all()
+        self._executor.shutdown(wait=True)
+
+    def _start_next(self):
+        while self.current is None and self._queue:
+            job = self._queue.popleft()
+            try:
+                job.prepare()
+            except Exception as e:
+                self.failed.emit(job, str(e))
+                continue
+            self.current = job
+            self.started.emit(job)
+            self._executor.submit(self._run, job)
+
+    def _run(self, job):
+        # Worker thread: only signals may touch the GUI from here
+        reported = [-1]
+
+        def progress(done, total):
+            if job.is_cancelled():
+                raise JobCancelled()
+            percent = 100 * done // max(total, 1)
+            if percent != reported[0]:
+                reported[0] = percent
+                self.progressed.emit(job, percent)
+
+        try:
+            self._done.emit(job, job.run(progress), None)
+        except Exception as e:
+            self._done.emit(job, None, e)
+
+    def _on_done(self, job, result, error):
+        self.current = None
+        if isinstance(error, JobCancelled) or job.is_cancelled():
+            self.cancelled.emit(job)
+        elif error is not None:
+            self.failed.emit(job, str(error))
+        else:
+            try:
+                job.finish(result)
+                self.finished.emit(job)
+            except Exception as e:
+                self.failed.emit(job, str(e))
+        self._start_next()
@@ -0,0 +1,110 @@
+from PyQt5.QtWidgets import (QWidget, QListWidget, QListWidgetItem, QVBoxLayout, QHBoxLayout, QLabel,
+                             QPushButton, QSpinBox, QComboBox)
+from PyQt5.QtCore import Qt
+
+from layers import BLEND_MODES
+
+class LayerPanel(QWidget):
+    """Layer list (top layer first) with visibility, opacity and blend mode of the selected layer."""
+
+    def __init__(self, canvas):
+        super().__init__()
+        self.canvas = canvas
+        self.init_ui()
+        self.refresh()
+
+    def init_ui(self):
+        layout = QVBoxLayout()
+        layout.setSpacing(3)
+        layout.setContentsMargins(2, 5, 2, 5)
+
+        title = QLabel("Layers:")
+        title.setStyleSheet("color: white;")
+        layout.addWidget(title)
+
+        # Checkbox of an item: layer visibility
+        self.layer_list = QListWidget()
+        self.layer_list.setStyleSheet("background-color: #404040; color: white;")
+        self.layer_list.currentRowChanged.connect(self.on_row_changed)
+        self.layer_list.itemChanged.connect(self.on_item_changed)
+        layout.addWidget(self.layer_list)
+
+        buttons = QHBoxLayout()
+        buttons.setSpacing(1)
+        for text, tip, handler in (("+", "Add layer", self.add_layer),
+                                   ("V", "Add vector layer", self.add_vector_layer),
+                                   ("-", "Delete layer", self.remove_layer),
+                                   ("▲", "Move layer up", lambda: self.move_layer(1)),
+                                   ("▼", "Move layer down", lambda: self.move_layer(-1))):
+            button = QPushButton(text)
+            button.setToolTip(tip)
+            button.setStyleSheet("background-color: #404040; color: white; border: 1px solid #555555; padding: 3px;")
+            button.clicked.connect(handler)
+            buttons.addWidget(button)
+        layout.addLayout(buttons)
+
+        opacity_label = QLabel("Opacity (%):")
+        opacity_label.setStyleSheet("color: white; padding-top: 5px;")
+        layout.addWidget(opacity_label)
+        self.opacity = QSpinBox()
+        self.opacity.setRange(0, 100)
+        self.opacity.valueChanged.connect(
+            lambda value: self.canvas.set_layer_opacity(self.canvas.layers.active_index, value / 100))
+        layout.addWidget(self.opacity)
+
+        blend_label = QLabel("Blend Mode:")
+        blend_label.setStyleSheet("color: white; padding-top: 5px;")
+        layout.addWidget(blend_label)
+        self.blend_mode = QComboBox()
+        self.blend_mode.addItems(list(BLEND_MODES))
+        self.blend_mode.currentTextChanged.connect(
+            lambda mode: self.canvas.set_layer_blend_mode(self.canvas.layers.active_index, mode))
+        layout.addWidget(self.blend_mode)
+
+        self.setLayout(layout)
+
+    def row_to_index(self, row):
+        # The list shows the top layer first
+        return len(self.canvas.layers) - 1 - row
+
+    def refresh(self):
+        """Rebuilds the list and the controls from the canvas layers."""
+        layers = self.canvas.layers
+        for widget in (self.layer_list, self.opacity, self.blend_mode):
+            widget.blockSignals(True)
+        self.layer_list.clear()
+        for layer in reversed(layers.layers):
+            item = QListWidgetItem(layer.name)
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Checked if layer.visible else Qt.Unchecked)
+            self.layer_list.addItem(item)
+        self.layer_list.setCurrentRow(self.row_to_index(layers.active_index))
+        self.opacity.setValue(round(layers.active.opacity * 100))
+        self.blend_mode.setCurrentText(layers.active.blend_mode)
+        for widget in (self.layer_list, self.opacity, self.blend_mode):
+            widget.blockSignals(False)
+
+    def on_row_changed(self, row):
+        if row >= 0:
+            self.canvas.set_active_layer(self.row_to_index(row))
+            self.refresh()
+
+    def on_item_changed(self, item):
+        self.canvas.set_layer_visible(self.row_to_index(self.layer_list.row(item)),
+                                      item.checkState() == Qt.Checked)
+
+    def add_layer(self):
+        self.canvas.add_layer()
+        self.refresh()
+
+    def add_vector_layer(self):
+        self.canvas.add_vector_layer()
+        self.refresh()
+
+    def remove_layer(self):
+        self.canvas.remove_layer()
+        self.refresh()
+
+    def move_layer(self, offset):
+        self.canvas.move_layer(offset)
+        self.refresh()
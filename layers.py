@@ -0,0 +1,363 @@
+"""
+Layer stack of the canvas and its cached composite.
+
+Every layer is a TiledImage of its own (the bottom one opaque white, the
+others transparent) with an opacity, a blend mode and a visibility flag.
+The flattened image is cached per tile, in three parts:
+
+* below: the layers under the active one, flattened onto the paper;
+* above: the layers over the active one, flattened onto transparency
+  (only while they all blend normally, which is associative);
+* composite: below + active layer + above.
+
+Drawing on the active layer drops only the composite tiles under the
+stroke, and rebuilding one of them costs at most two draws however many
+layers there are.  Selecting another layer drops below/above; changing any
+other layer drops all three, under the changed area only.
+
+A vector layer also keeps its shapes as objects (vector_layer.VectorLayer);
+its pixels are their rendering, so it composites like any other layer.
+
+The stack reads like a TiledImage of the composite (tile(), copy(),
+draw(), ...), so the pyramid and the savers work on it unchanged.
+"""
+from PyQt5.QtCore import Qt, QRect
+from PyQt5.QtGui import QColor, QImage, QPainter
+
+from tile_store import TILE_SIZE, TiledImage
+from vector_layer import VectorLayer
+
+BLEND_MODES = {
+    'normal': QPainter.CompositionMode_SourceOver,
+    'multiply': QPainter.CompositionMode_Multiply,
+    'screen': QPainter.CompositionMode_Screen,
+    'overlay': QPainter.CompositionMode_Overlay,
+    'darken': QPainter.CompositionMode_Darken,
+    'lighten': QPainter.CompositionMode_Lighten,
+    'difference': QPainter.CompositionMode_Difference,
+    'add': QPainter.CompositionMode_Plus,
+}
+PAPER = QColor(Qt.white)  # under the bottom layer
+LAYER_FORMAT = QImage.Format_ARGB32_Premultiplied
+
+
+class Layer:
+    """Pixels of one layer and how they are blended onto the layers under it."""
+
+    def __init__(self, name, store, opacity=1.0, blend_mode='normal', visible=True, vector=None):
+        self.name = name
+        self.store = store
+        self.opacity = opacity
+        self.blend_mode = blend_mode
+        self.visible = visible
+        self.vector = vector  # VectorLayer of a vector layer, None for pixels only
+
+    def source(self, key):
+        """(tile or plain colour, opacity, composition mode) this layer adds at tile `key`, or None."""
+        if not self.visible or self.opacity <= 0:
+            return None
+        pixels = self.store.tile(key)
+        if pixels is None:
+            if self.store.background.alpha() == 0:
+                return None
+            pixels = self.store.background
+        return pixels, self.opacity, BLEND_MODES[self.blend_mode]
+
+    def area(self):
+        """The part of the image this layer adds anything to: its tiles, or everything when its background shows."""
+        if self.store.background.alpha() != 0:
+            return self.store.rect()
+        area = QRect()
+        for key in self.store.tiles:
+            area = area.united(self.store.tile_rect(key))
+        return area.intersected(self.store.rect())
+
+
+class LayerStack:
+    """Ordered layers, bottom first, with one of them active and a per-tile cached composite."""
+
+    def __init__(self, width, height, tile_size=TILE_SIZE):
+        self.tile_size = tile_size
+        self.format = QImage.Format_RGB32
+        self.background = QColor(PAPER)
+        self.layers = [Layer('Background', TiledImage(width, height, PAPER, tile_size=tile_size))]
+        self.active_index = 0
+        # key -> QImage, or None where the result is plain paper (plain transparency for _above)
+        self._below = {}
+        self._above = {}
+        self._composite = {}
+
+    @classmethod
+    def from_snapshot(cls, snapshot, tile_size=TILE_SIZE):
+        """A separate stack sharing the pixels of a snapshot() until either side is painted on."""
+        active_index, layers = snapshot
+        stack = cls(0, 0, tile_size)
+        stack.layers = [Layer(name, TiledImage.from_snapshot(pixels, tile_size), opacity, blend_mode, visible)
+                        for name, opacity, blend_mode, visible, pixels in layers]
+        stack.active_index = active_index
+        return stack
+
+    def snapshot(self):
+        """Cheap copy of the layers: settings plus copy-on-write tile snapshots."""
+        return self.active_index, [(layer.name, layer.opacity, layer.blend_mode, layer.visible,
+                                    layer.store.snapshot()) for layer in self.layers]
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def __len__(self):
+        return len(self.layers)
+
+    @property
+    def active(self):
+        return self.layers[self.active_index]
+
+    def index_of(self, store):
+        """Index of the layer owning `store`, or None."""
+        for index, layer in enumerate(self.layers):
+            if layer.store is store:
+                return index
+        return None
+
+    # Geometry, shared by every layer
+
+    def width(self):
+        return self.layers[0].store.width()
+
+    def height(self):
+        return self.layers[0].store.height()
+
+    def size(self):
+        return self.layers[0].store.size()
+
+    def rect(self):
+        return self.layers[0].store.rect()
+
+    def tile_rect(self, key):
+        return self.layers[0].store.tile_rect(key)
+
+    def tile_keys(self, rect):
+        return self.layers[0].store.tile_keys(rect)
+
+    def resize(self, size):
+        old = self.rect()
+        # Right of and below the old image, the parts that growing adds
+        grown = [QRect(old.width(), 0, size.width() - old.width(), size.height()),
+                 QRect(0, old.height(), old.width(), size.height() - old.height())]
+        for layer in self.layers:
+            layer.store.resize(size)
+            if layer.vector is not None:
+                # Shapes reaching past the old edges were cut there; draw the rest
+                for area in grown:
+                    if not area.isEmpty():
+                        layer.vector.uncover(layer.store, area)
+        self.invalidate()
+
+    # Structure
+
+    def add_layer(self, name=None, vector=False):
+        """Adds an empty (vector) layer above the active one and makes it active; returns it."""
+        store = TiledImage(self.width(), self.height(), Qt.transparent, LAYER_FORMAT, self.tile_size)
+        default_name = f'Vector {len(self.layers)}' if vector else f'Layer {len(self.layers)}'
+        layer = Layer(name or default_name, store, vector=VectorLayer() if vector else None)
+        self.layers.insert(self.active_index + 1, layer)
+        # An empty layer changes no composite tile, only what lies below/above the active one
+        self.set_active(self.active_index + 1)
+        return layer
+
+    def remove_layer(self, index):
+        """Removes the layer at `index`; the last remaining layer is kept.  Returns it or None."""
+        if len(self.layers) == 1:
+            return None
+        layer = self.layers.pop(index)
+        if self.active_index >= index and self.active_index > 0:
+            self.active_index -= 1
+        self._restacked(layer.area())
+        return layer
+
+    def move_layer(self, index, offset):
+        """Moves the layer at `index` up (offset > 0) or down the stack; returns its new index."""
+        target = min(max(index + offset, 0), len(self.layers) - 1)
+        if target == index:
+            return index
+        active = self.active
+        self.layers.insert(target, self.layers.pop(index))
+        self.active_index = self.layers.index(active)
+        self._restacked(self.layers[target].area())
+        return target
+
+    def _restacked(self, area):
+        # Only the area of the layer taken out or moved looks different, but
+        # what lies below/above the active layer may have changed anywhere
+        self._below.clear()
+        self._above.clear()
+        self._drop(area, [self._composite])
+
+    def set_active(self, index):
+        if index != self.active_index:
+            self.active_index = index
+            # The composite stays valid: only the split around the active layer moved
+            self._below.clear()
+            self._above.clear()
+
+    # The setters return the area of the image that changed
+
+    def set_opacity(self, index, opacity):
+        self.layers[index].opacity = min(max(opacity, 0.0), 1.0)
+        return self._restyled(index)
+
+    def set_blend_mode(self, index, blend_mode):
+        if blend_mode not in BLEND_MODES:
+            raise ValueError(f'Unknown blend mode: {blend_mode}')
+        self.layers[index].blend_mode = blend_mode
+        return self._restyled(index)
+
+    def set_visible(self, index, visible):
+        self.layers[index].visible = visible
+        return self._restyled(index)
+
+    def _restyled(self, index):
+        layer = self.layers[index]
+        area = layer.area()
+        self.changed(area, layer.store)
+        return area
+
+    # Invalidation
+
+    def changed(self, rect=None, store=None):
+        """
+        Called after the layer owning `store` (default: the active one) changed under `rect`.
+
+        Only the caches that include that layer are dropped; None means the
+        whole image.
+        """
+        index = self.active_index if store is None else self.index_of(store)
+        if index is None:
+            return  # a removed layer: nothing on screen depends on it
+        caches = [self._composite]
+        if index < self.active_index:
+            caches.append(self._below)
+        elif index > self.active_index:
+            caches.append(self._above)
+        self._drop(rect, caches)
+
+    def invalidate(self, rect=None):
+        """Drops every cached tile under `rect` (default: all of them)."""
+        self._drop(rect, (self._below, self._above, self._composite))
+
+    def _drop(self, rect, caches):
+        if rect is None:
+            for cache in caches:
+                cache.clear()
+            return
+        for key in self.tile_keys(rect):
+            for cache in caches:
+                cache.pop(key, None)
+
+    # Compositing
+
+    def _flatten(self, tile, sources, transparent=False):
+        """
+        Blends `sources` (see Layer.source) in order over `tile`, returning the result.
+
+        `tile` None stands for plain paper, or plain transparency when
+        `transparent`.  Cached tiles are never painted on in place: Qt
+        detaches a shared QImage as soon as a painter opens it.
+        """
+        painter = None
+        size = self.tile_size
+        for pixels, opacity, mode in sources:
+            is_color = isinstance(pixels, QColor)
+            covers = (opacity >= 1.0 and mode == QPainter.CompositionMode_SourceOver and
+                      (pixels.alpha() == 255 if is_color else not pixels.hasAlphaChannel()))
+            if covers:
+                # Hides everything under it: share its tile instead of blending
+                if painter is not None:
+                    painter.end()
+                    painter = None
+                if not is_color:
+                    tile = pixels
+                elif pixels == PAPER and not transparent:
+                    tile = None
+                else:
+                    tile = QImage(size, size, self.format)
+                    tile.fill(pixels)
+                continue
+            if painter is None:
+                if tile is None:
+                    tile = QImage(size, size, LAYER_FORMAT if transparent else self.format)
+                    tile.fill(Qt.transparent if transparent else PAPER)
+                else:
+                    tile = QImage(tile)
+                painter = QPainter(tile)
+            painter.setOpacity(opacity)
+            painter.setCompositionMode(mode)
+            if is_color:
+                painter.fillRect(0, 0, size, size, pixels)
+            else:
+                painter.drawImage(0, 0, pixels)
+        if painter is not None:
+            painter.end()
+        return tile
+
+    def _sources(self, key, layers):
+        return [source for source in (layer.source(key) for layer in layers) if source is not None]
+
+    def _above_blends_normally(self):
+        return all(layer.blend_mode == 'normal' for layer in self.layers[self.active_index + 1:])
+
+    def _below_tile(self, key):
+        if key not in self._below:
+            self._below[key] = self._flatten(None, self._sources(key, self.layers[:self.active_index]))
+        return self._below[key]
+
+    def _above_tile(self, key):
+        if key not in self._above:
+            self._above[key] = self._flatten(
+                None, self._sources(key, self.layers[self.active_index + 1:]), transparent=True)
+        return self._above[key]
+
+    def tile(self, key):
+        """The flattened tile `key`, or None while it is plain paper."""
+        if key in self._composite:
+            return self._composite[key]
+        sources = self._sources(key, [self.active])
+        above = self.layers[self.active_index + 1:]
+        if above and self._above_blends_normally():
+            above_tile = self._above_tile(key)
+            if above_tile is not None:
+                sources.append((above_tile, 1.0, QPainter.CompositionMode_SourceOver))
+        else:
+            # Other blend modes are not associative, so each layer above is blended in turn
+            sources += self._sources(key, above)
+        tile = self._composite[key] = self._flatten(self._below_tile(key), sources)
+        return tile
+
+    def copy(self, rect=None):
+        """Composes the flattened pixels under `rect` (default: the whole image) into one QImage."""
+        rect = self.rect() if rect is None else rect
+        image = QImage(rect.size(), self.format)
+        image.fill(self.background)
+        painter = QPainter(image)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        for key in self.tile_keys(rect):
+            tile = self.tile(key)
+            if tile is not None:
+                painter.drawImage(self.tile_rect(key).topLeft() - rect.topLeft(), tile)
+        painter.end()
+        return image
+
+    def to_qimage(self):
+        return self.copy(self.rect())
+
+    def draw(self, painter, rect):
+        """Draws the flattened image under `rect` at the same position on `painter`."""
+        rect = rect.intersected(self.rect())
+        for key in self.tile_keys(rect):
+            tile_rect = self.tile_rect(key)
+            part = tile_rect.intersected(rect)
+            tile = self.tile(key)
+            if tile is None:
+                painter.fillRect(part, self.background)
+            else:
+                painter.drawImage(part.topLeft(), tile, part.translated(-tile_rect.topLeft()))
@@ -1,12 +1,15 @@
 import sys
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QHBoxLayout, 
-                            QVBoxLayout, QAction, QMessageBox, QLabel)
+                            QVBoxLayout, QAction, QMessageBox, QLabel, QFileDialog)
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from tools import ToolBar
 from canvas import Canvas
 from color_picker import ColorPicker
+from layer_panel import LayerPanel
 from error_logger import log_error
+from profiler import profiler
+from replay import SessionRecorder
 import json
 import os
 
@@ -68,6 +71,8 @@ class PaintApp(QMainWindow):
         # Create toolbars and color picker
         self.tool_bar = ToolBar(self.canvas)
         self.color_picker = ColorPicker(self.canvas)
+        self.layer_panel = LayerPanel(self.canvas)
+        self.layer_panel.setMaximumWidth(180)
 
         # Replace info label with image
         image_label = QLabel()
@@ -110,6 +115,7 @@ class PaintApp(QMainWindow):
 
         content_layout.addWidget(tools_widget)
         content_layout.addWidget(self.canvas, stretch=1)
+        content_layout.addWidget(self.layer_panel)
         layout.addLayout(content_layout)
 
         self.create_menu_bar()
@@ -153,7 +159,10 @@ class PaintApp(QMainWindow):
         """)
 
         self.settings_file = os.path.join(os.path.dirname(__file__), 'settings.json')
+        self.autosave_file = os.path.join(os.path.dirname(__file__), 'autosave.png')
+        self.autosave_interval_s = 120
         self.load_settings()
+        self.canvas.set_autosave(self.autosave_file, self.autosave_interval_s)
 
     def create_menu_bar(self):
         """Tworzy pasek menu z opcjami File, Edit, Effects i Help."""
@@ -193,8 +202,41 @@ class PaintApp(QMainWindow):
         redo_action.setShortcut('Ctrl+Y')
         redo_action.triggered.connect(self.canvas.redo)
         
+        select_all_action = QAction('Select All', self)
+        select_all_action.setIcon(QIcon.fromTheme('edit-select-all'))
+        select_all_action.setShortcut('Ctrl+A')
+        select_all_action.triggered.connect(self.canvas.select_all)
+
+        deselect_action = QAction('Deselect', self)
+        deselect_action.setShortcut('Ctrl+D')
+        deselect_action.triggered.connect(self.canvas.deselect)
+
         edit_menu.addAction(undo_action)
         edit_menu.addAction(redo_action)
+        edit_menu.addSeparator()
+        edit_menu.addAction(select_all_action)
+        edit_menu.addAction(deselect_action)
+
+        # View menu
+        view_menu = menubar.addMenu('View')
+        zoom_in_action = QAction('Zoom In', self)
+        zoom_in_action.setIcon(QIcon.fromTheme('zoom-in'))
+        zoom_in_action.setShortcut('Ctrl++')
+        zoom_in_action.triggered.connect(self.canvas.zoom_in)
+
+        zoom_out_action = QAction('Zoom Out', self)
+        zoom_out_action.setIcon(QIcon.fromTheme('zoom-out'))
+        zoom_out_action.setShortcut('Ctrl+-')
+        zoom_out_action.triggered.connect(self.canvas.zoom_out)
+
+        actual_size_action = QAction('Actual Size', self)
+        actual_size_action.setIcon(QIcon.fromTheme('zoom-original'))
+        actual_size_action.setShortcut('Ctrl+0')
+        actual_size_action.triggered.connect(self.canvas.reset_view)
+
+        view_menu.addAction(zoom_in_action)
+        view_menu.addAction(zoom_out_action)
+        view_menu.addAction(actual_size_action)
 
         # Effects menu
         effects_menu = menubar.addMenu('Effects')
@@ -230,6 +272,20 @@ class PaintApp(QMainWindow):
         effects_menu.addAction(brightness_action)
         effects_menu.addAction(contrast_action)
 
+        cancel_filter_action = QAction('Cancel Filter', self)
+        cancel_filter_action.setIcon(QIcon.fromTheme('process-stop'))
+        cancel_filter_action.setShortcut('Esc')
+        cancel_filter_action.triggered.connect(self.canvas.jobs.cancel_all)
+        effects_menu.addSeparator()
+        effects_menu.addAction(cancel_filter_action)
+
+        # Background filter jobs report to the log bar
+        jobs = self.canvas.jobs
+        jobs.progressed.connect(lambda job, percent: self.log_action(f'Applying {job.name}... {percent}%'))
+        jobs.cancelled.connect(lambda job: self.log_action(f'Filter {job.name} cancelled.'))
+        jobs.failed.connect(self.on_job_failed)
+        self.canvas.saves.failed.connect(self.on_save_failed)
+
         # Help menu
         help_menu = menubar.addMenu('Help')
         about_action = QAction('About', self)
@@ -242,6 +298,39 @@ class PaintApp(QMainWindow):
         shortcuts_action.triggered.connect(self.show_shortcuts)
         help_menu.addAction(shortcuts_action)
 
+        repaint_stats_action = QAction('Repaint Statistics', self)
+        repaint_stats_action.triggered.connect(self.show_repaint_stats)
+        help_menu.addAction(repaint_stats_action)
+
+        profiling_action = QAction('Profiling', self)
+        profiling_action.setCheckable(True)
+        profiling_action.setStatusTip('Time repaints, tools, undo, filters and file operations (overlay on the canvas)')
+        profiling_action.toggled.connect(self.canvas.set_profiling)
+        help_menu.addAction(profiling_action)
+
+        profile_summary_action = QAction('Profiling Summary', self)
+        profile_summary_action.triggered.connect(self.show_profile_summary)
+        help_menu.addAction(profile_summary_action)
+
+        save_profile_action = QAction('Save Profile...', self)
+        save_profile_action.triggered.connect(self.save_profile)
+        help_menu.addAction(save_profile_action)
+
+        self.record_action = QAction('Record Session', self)
+        self.record_action.setCheckable(True)
+        self.record_action.setStatusTip('Record mouse input and tool settings for replay benchmarks')
+        self.record_action.toggled.connect(self.toggle_recording)
+        help_menu.addAction(self.record_action)
+        self.recorder = None
+
+    def on_job_failed(self, job, error):
+        log_error(f'Error applying filter {job.name}: {error}')
+        self.log_action(f'An error occurred while applying filter {job.name}.')
+
+    def on_save_failed(self, job, error):
+        log_error(f'Error saving image to {job.file_path}: {error}')
+        self.log_action('An error occurred while saving the image.')
+
     def log_action(self, message):
         """Display a message in the log bar at the bottom."""
         self.log_bar.setText(message)
@@ -289,20 +378,82 @@ class PaintApp(QMainWindow):
                 'Ctrl+S: Save Image\n'
                 'Ctrl+Z: Undo\n'
                 'Ctrl+Y: Redo\n'
-                'Space: Pan canvas\n'
-                'Mouse wheel: Zoom canvas')
+                'Ctrl+A / Ctrl+D: Select all / Deselect\n'
+                'Delete: Delete the shape picked with the Shape tool\n'
+                'Esc: Cancel running filter\n'
+                'Space + drag / middle button drag: Pan canvas\n'
+                'Mouse wheel: Zoom canvas\n'
+                'Ctrl++ / Ctrl+-: Zoom in / out\n'
+                'Ctrl+0: Actual size')
             self.log_action('Keyboard shortcuts displayed.')
         except Exception as e:
             log_error(f'Error in shortcuts dialog: {e}')
             QMessageBox.critical(self, 'Error', 'An error occurred in the shortcuts dialog.')
             self.log_action('An error occurred in the shortcuts dialog.')
 
+    def toggle_recording(self, recording):
+        """Starts recording the canvas session, or stops and saves it for `python replay.py`."""
+        if recording:
+            self.recorder = SessionRecorder(self.canvas)
+            self.log_action('Recording session...')
+            return
+        session = self.recorder.stop()
+        self.recorder = None
+        file_path, _ = QFileDialog.getSaveFileName(self, 'Save Session', '', 'Paint sessions (*.session.gz)')
+        if not file_path:
+            self.log_action('Recording discarded.')
+            return
+        try:
+            session.save(file_path)
+            self.log_action(f'Session saved: {len(session)} events.')
+        except Exception as e:
+            log_error(f'Error saving session to {file_path}: {e}')
+            self.log_action('An error occurred while saving the session.')
+
+    def show_profile_summary(self):
+        """Shows the three most time-consuming profiled sections in the log bar."""
+        lines = profiler.report(limit=3)
+        self.log_action(' | '.join(lines) if lines else 'No profiling data (Help > Profiling).')
+
+    def save_profile(self):
+        """Saves the profiled timings as a Chrome trace or as JSON summaries."""
+        file_path, _ = QFileDialog.getSaveFileName(
+            self, 'Save Profile', 'profile.trace.json',
+            'Chrome trace (*.trace.json);;Timing summary (*.json)')
+        if not file_path:
+            return
+        try:
+            profiler.dump(file_path)
+            self.log_action(f'Profile saved to {os.path.basename(file_path)}.')
+        except Exception as e:
+            log_error(f'Error saving profile to {file_path}: {e}')
+            self.log_action('An error occurred while saving the profile.')
+
+    def show_repaint_stats(self):
+        """Shows how many canvas pixels were repainted per frame in the log bar."""
+        self.log_action(self.canvas.repaint_counter.summary())
+
     def load_settings(self):
         """Ładuje ustawienia z pliku JSON, takie jak ostatni kolor i narzędzie."""
         try:
             if os.path.exists(self.settings_file):
                 with open(self.settings_file, 'r', encoding='utf-8') as f:
                     settings = json.load(f)
+                    # Canvas limits first, so a failing entry below cannot skip them
+                    if 'history_budget_mb' in settings:
+                        self.canvas.set_history_budget(settings['history_budget_mb'] * 1024 * 1024)
+                    if settings.get('filter_workers'):
+                        self.canvas.set_filter_workers(settings['filter_workers'])
+                    if 'spray_density' in settings:
+                        self.tool_bar.spray_density.setValue(settings['spray_density'])
+                    if 'spray_flow' in settings:
+                        self.tool_bar.spray_flow.setValue(settings['spray_flow'])
+                    if settings.get('text_font'):
+                        font = QFont()
+                        if font.fromString(settings['text_font']):
+                            self.canvas.set_text_font(font)
+                    if 'autosave_interval_s' in settings:
+                        self.autosave_interval_s = settings['autosave_interval_s']
                     # Przykład: ustaw ostatni kolor i narzędzie
                     if 'last_color' in settings:
                         self.canvas.set_color(settings['last_color'])
@@ -316,7 +467,13 @@ class PaintApp(QMainWindow):
         try:
             settings = {
                 'last_color': getattr(self.canvas, 'current_color', None),
-                'last_tool': getattr(self.tool_bar, 'current_tool', None)
+                'last_tool': getattr(self.tool_bar, 'current_tool', None),
+                'history_budget_mb': self.canvas.history.budget // (1024 * 1024),
+                'filter_workers': self.canvas.filter_workers,
+                'autosave_interval_s': self.autosave_interval_s,
+                'spray_density': self.canvas.spray_density,
+                'spray_flow': self.canvas.spray_flow,
+                'text_font': self.canvas.text_font.toString()
             }
             with open(self.settings_file, 'w', encoding='utf-8') as f:
                 json.dump(settings, f)
@@ -326,6 +483,9 @@ class PaintApp(QMainWindow):
     def closeEvent(self, event):
         """Obsługuje zdarzenie zamknięcia okna aplikacji, zapisując ustawienia przed zamknięciem."""
         self.save_settings()
+        self.canvas.jobs.shutdown()
+        # Let saves that are still being written finish
+        self.canvas.saves.join()
         event.accept()
 
     def try_save_image(self):
@@ -338,18 +498,23 @@ class PaintApp(QMainWindow):
     def try_open_image(self):
         try:
             self.canvas.open_image(self.log_action)
+            self.layer_panel.refresh()
         except Exception as e:
             log_error(f'Error opening image: {e}')
             self.log_action('An error occurred while opening the image.')
 
     def try_apply_filter(self, filter_name):
         try:
-            self.canvas.apply_filter(filter_name, self.log_action)
+            self.canvas.apply_filter(filter_name, on_done=self.log_action)
         except Exception as e:
             log_error(f'Error applying filter {filter_name}: {e}')
             self.log_action(f'An error occurred while applying filter {filter_name}.')
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['batch']:
+        # Headless mode: python main.py batch INPUT_DIR OUTPUT_DIR -f FILTER ...
+        import batch
+        sys.exit(batch.main(sys.argv[2:]))
     try:
         app = QApplication(sys.argv)
         window = PaintApp()
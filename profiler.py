@@ -0,0 +1,166 @@
+"""
+Opt-in timing of the canvas hot paths.
+
+Sections (a repaint, a tool handler, an undo snapshot, a filter, a save,
+...) are timed only while profiling is enabled.  While it is off, a @timed
+function costs one attribute check per call and section() hands out a
+shared no-op context, so the instrumentation can stay in the hot paths.
+
+Every section keeps a rolling window of its latest durations, summarised
+as percentiles for the canvas overlay and the log bar.  While tracing,
+every timed call is also kept as an event for a Chrome trace
+(chrome://tracing or ui.perfetto.dev); dump() writes either format.
+"""
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+WINDOW = 512  # latest durations kept per section
+MAX_TRACE_EVENTS = 200000
+
+
+class Histogram:
+    """Rolling window of the latest durations (seconds) of one section, plus its call count and total time."""
+
+    def __init__(self, window=WINDOW):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, p):
+        """The `p`th percentile (0-100) of the durations in the window."""
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)]
+
+    def summary(self):
+        return {'count': self.count, 'total_ms': self.total * 1000,
+                'p50_ms': self.percentile(50) * 1000, 'p95_ms': self.percentile(95) * 1000,
+                'max_ms': self.percentile(100) * 1000}
+
+
+class _Section:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start, time.perf_counter())
+
+
+class _NoSection:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_SECTION = _NoSection()
+
+
+class Profiler:
+    """Histograms of the timed sections and, while tracing, the trace events."""
+
+    def __init__(self):
+        self.enabled = False
+        self.tracing = False
+        self.histograms = {}
+        self.trace = deque(maxlen=MAX_TRACE_EVENTS)  # (name, start, end, thread id)
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()  # filters and saves are timed on worker threads
+
+    def enable(self, tracing=True):
+        self.enabled = True
+        self.tracing = tracing
+
+    def disable(self):
+        self.enabled = False
+        self.tracing = False
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.trace.clear()
+            self.origin = time.perf_counter()
+
+    def section(self, name):
+        """Context manager timing its block as `name` (a no-op while disabled)."""
+        return _Section(self, name) if self.enabled else _NO_SECTION
+
+    def record(self, name, start, end):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(end - start)
+            if self.tracing:
+                self.trace.append((name, start, end, threading.get_ident()))
+
+    def report(self, limit=None):
+        """One line per section, the most time-consuming first."""
+        with self._lock:
+            items = sorted(self.histograms.items(), key=lambda item: -item[1].total)
+            lines = [f'{name}: {h.count}x p50 {h.percentile(50) * 1000:.2f} ms, '
+                     f'p95 {h.percentile(95) * 1000:.2f} ms, max {h.percentile(100) * 1000:.2f} ms'
+                     for name, h in items[:limit]]
+        return lines
+
+    def to_json(self):
+        with self._lock:
+            return {name: h.summary() for name, h in self.histograms.items()}
+
+    def to_chrome_trace(self):
+        """The trace events in the Chrome trace event format (complete events, microseconds)."""
+        pid = os.getpid()
+        with self._lock:
+            events = [{'name': name, 'cat': name.split('.')[0], 'ph': 'X',
+                       'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6,
+                       'pid': pid, 'tid': tid}
+                      for name, start, end, tid in self.trace]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, path):
+        """Writes a Chrome trace when `path` ends with .trace.json, otherwise the histogram summaries."""
+        data = self.to_chrome_trace() if path.endswith('.trace.json') else self.to_json()
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+
+
+profiler = Profiler()
+
+
+def section(name):
+    return profiler.section(name)
+
+
+def timed(name):
+    """Decorator timing every call of the function as section `name` while profiling is enabled."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.record(name, start, time.perf_counter())
+        return wrapper
+    return decorate
@@ -0,0 +1,249 @@
+"""
+Native project format (.ppe): a checkpoint of every layer followed by an
+append-only log of the tiles that changed.
+
+The file is MAGIC followed by records, each [kind: 1 byte][length: uint32]
+[payload]:
+
+    b'C'  checkpoint: the records up to the next save mark hold the whole image
+    b'L'  layers: JSON with the image size, the active layer and every layer's
+          id, name, opacity, blend mode, visibility, background and format
+    b'T'  tile: layer id, tx, ty (TILE_HEADER) + zlib-compressed raw pixels;
+          no pixels means the tile went back to the layer background
+    b'S'  save mark: everything before it is a consistent image
+
+A checkpoint save writes C, L, T... S to a new file.  An incremental save
+appends only the tiles whose pixels changed since the last save (QImage
+cache keys tell, without comparing pixels), an L record when the layers
+changed, and S.  Opening a project skips from record header to record
+header to the last checkpoint and applies the records after it up to the
+last save mark, so a save torn by a crash is ignored; the next append
+overwrites it.  Once the log outgrows the checkpoint, the next save writes
+a fresh checkpoint instead.
+
+The log holds tiles rather than tool operations: brush strokes, spray,
+fills and filters depend on mouse timing, random numbers and worker
+results that a replay could not reproduce exactly, while a tile always can.
+"""
+import json
+import os
+import struct
+import zlib
+
+from PyQt5.QtCore import QSize
+from PyQt5.QtGui import QColor, QImage
+
+from layers import Layer, LayerStack
+from tile_store import TILE_SIZE, TiledImage
+
+MAGIC = b'PPEPROJ1'
+RECORD_HEADER = struct.Struct('<cI')
+TILE_HEADER = struct.Struct('<Iii')
+EXTENSION = '.ppe'
+TILE_COMPRESSION = 1
+
+
+class ProjectError(Exception):
+    """The file is not a readable project."""
+
+
+def is_project(path):
+    return path.lower().endswith(EXTENSION)
+
+
+def _layers_record(stack, ids):
+    return json.dumps({
+        'size': [stack.width(), stack.height()],
+        'tile_size': stack.tile_size,
+        'active': stack.active_index,
+        'layers': [{'id': ids[layer.store], 'name': layer.name, 'opacity': layer.opacity,
+                    'blend_mode': layer.blend_mode, 'visible': layer.visible,
+                    'background': layer.store.background.rgba(), 'format': int(layer.store.format)}
+                   for layer in stack.layers],
+    }, separators=(',', ':')).encode('utf-8')
+
+
+def _tile_record(layer_id, key, tile):
+    header = TILE_HEADER.pack(layer_id, *key)
+    if tile is None:
+        return header
+    return header + zlib.compress(tile.constBits().asstring(tile.byteCount()), TILE_COMPRESSION)
+
+
+def _record(kind, payload=b''):
+    return RECORD_HEADER.pack(kind, len(payload)) + payload
+
+
+class ProjectFile:
+    """
+    What the last save to `path` wrote: layer ids and the cache key of every saved tile.
+
+    diff() lists what a save has to write; the save job encodes it off the
+    GUI thread and commit() adopts the new state once the file is written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.ids = {}  # store -> layer id in the file
+        self.next_id = 0
+        self.tile_keys = {}  # store -> {tile key: QImage cache key}
+        self.layers_payload = None  # last L record written
+        self.end = 0  # offset just past the last save mark
+        self.checkpoint_bytes = 0
+        self.log_bytes = 0  # bytes appended since the checkpoint
+
+    def _id(self, store):
+        if store not in self.ids:
+            self.ids[store] = self.next_id
+            self.next_id += 1
+        return self.ids[store]
+
+    def diff(self, stack):
+        """
+        The save `stack` needs, as a dict for write() and commit().
+
+        Called on the GUI thread: the tiles are copy-on-write handles, so
+        the stack can be drawn on while they are written.
+        """
+        checkpoint = self.end == 0 or self.log_bytes > self.checkpoint_bytes
+        for layer in stack.layers:
+            self._id(layer.store)
+        tile_keys = {}
+        tiles = []
+        for layer in stack.layers:
+            store = layer.store
+            saved = {} if checkpoint else self.tile_keys.get(store, {})
+            current = tile_keys[store] = {key: tile.cacheKey() for key, tile in store.tiles.items()}
+            layer_id = self.ids[store]
+            for key, tile in store.tiles.items():
+                if saved.get(key) != current[key]:
+                    tiles.append((layer_id, key, QImage(tile)))
+            tiles += [(layer_id, key, None) for key in saved if key not in current]
+        payload = _layers_record(stack, self.ids)
+        return {'checkpoint': checkpoint, 'tiles': tiles, 'tile_keys': tile_keys, 'layers': payload,
+                'write_layers': checkpoint or payload != self.layers_payload}
+
+    def write(self, save, progress=None):
+        """Writes the records of `save` (from diff()); returns the new end offset and bytes written."""
+        if not (save['checkpoint'] or save['write_layers'] or save['tiles']):
+            return self.end, 0
+        records = []
+        if save['checkpoint']:
+            records.append(_record(b'C'))
+        if save['write_layers']:
+            records.append(_record(b'L', save['layers']))
+        total = len(save['tiles'])
+        for done, (layer_id, key, tile) in enumerate(save['tiles']):
+            records.append(_record(b'T', _tile_record(layer_id, key, tile)))
+            if progress:
+                progress(done, total)
+        records.append(_record(b'S'))
+        data = b''.join(records)
+        if save['checkpoint']:
+            # A new file next to the target first, so an interrupted save never breaks the project
+            partial = self.path + '.saving'
+            with open(partial, 'wb') as f:
+                f.write(MAGIC + data)
+            os.replace(partial, self.path)
+            return len(MAGIC) + len(data), len(data)
+        with open(self.path, 'r+b') as f:
+            f.seek(self.end)
+            f.write(data)
+            f.truncate()  # drops what a torn save left behind
+        return self.end + len(data), len(data)
+
+    def commit(self, save, end, written):
+        self.tile_keys = save['tile_keys']
+        self.layers_payload = save['layers']
+        self.end = end
+        if save['checkpoint']:
+            self.checkpoint_bytes, self.log_bytes = written, 0
+        else:
+            self.log_bytes += written
+        # Layers removed since the last save need no id any more
+        self.ids = {store: layer_id for store, layer_id in self.ids.items() if store in self.tile_keys}
+
+
+def _records(f):
+    """(kind, offset of the payload, length) of every complete record, payloads skipped."""
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(len(MAGIC))
+    while True:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        kind, length = RECORD_HEADER.unpack(header)
+        offset = f.tell()
+        if offset + length > size:
+            return  # torn by a crash
+        yield kind, offset, length
+        f.seek(offset + length)
+
+
+def _tile_from_record(payload, image_format, tile_size):
+    raw = zlib.decompress(payload)
+    return QImage(raw, tile_size, tile_size, tile_size * 4, image_format).copy()
+
+
+def load(path, tile_size=TILE_SIZE):
+    """Reads the project in `path`; returns (LayerStack, ProjectFile ready for incremental saves)."""
+    project = ProjectFile(path)
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ProjectError(f'Not a project file: {path}')
+        # Only headers are read here: the last checkpoint and the last save mark
+        records = list(_records(f))
+        checkpoints = [i for i, (kind, _, _) in enumerate(records) if kind == b'C']
+        marks = [i for i, (kind, _, _) in enumerate(records) if kind == b'S']
+        if not checkpoints or not marks or marks[-1] < checkpoints[-1]:
+            raise ProjectError(f'No complete save in {path}')
+        first, last = checkpoints[-1], marks[-1]
+        stores = {}  # layer id -> TiledImage
+        stack = None
+        for kind, offset, length in records[first:last + 1]:
+            f.seek(offset)
+            payload = f.read(length)
+            if kind == b'L':
+                stack = _apply_layers(json.loads(payload), stores, tile_size)
+                project.layers_payload = payload
+            elif kind == b'T':
+                layer_id, tx, ty = TILE_HEADER.unpack_from(payload)
+                store = stores[layer_id]
+                if len(payload) == TILE_HEADER.size:
+                    store.drop_tile((tx, ty))
+                else:
+                    store.set_tile((tx, ty), _tile_from_record(payload[TILE_HEADER.size:], store.format,
+                                                               tile_size))
+    project.ids = {store: layer_id for layer_id, store in stores.items()
+                   if any(layer.store is store for layer in stack.layers)}
+    project.next_id = max(stores, default=-1) + 1
+    project.tile_keys = {store: {key: tile.cacheKey() for key, tile in store.tiles.items()}
+                         for store in project.ids}
+    # The checkpoint runs from its C record to the first save mark after it
+    checkpoint_end = next(records[i][1] for i in marks if i > first)
+    project.checkpoint_bytes = checkpoint_end - (records[first][1] - RECORD_HEADER.size)
+    project.end = records[last][1]
+    project.log_bytes = project.end - checkpoint_end
+    return stack, project
+
+
+def _apply_layers(data, stores, tile_size):
+    """A LayerStack of the layers in an L record, keeping the tiles of the layers already read."""
+    if data['tile_size'] != tile_size:
+        raise ProjectError(f'Project tiles are {data["tile_size"]} pixels, expected {tile_size}')
+    size = QSize(*data['size'])
+    stack = LayerStack(size.width(), size.height(), tile_size)
+    layers = []
+    for entry in data['layers']:
+        store = stores.get(entry['id'])
+        if store is None:
+            store = stores[entry['id']] = TiledImage(
+                size.width(), size.height(), QColor.fromRgba(entry['background']),
+                QImage.Format(entry['format']), tile_size)
+        store.background = QColor.fromRgba(entry['background'])
+        store.resize(size)
+        layers.append(Layer(entry['name'], store, entry['opacity'], entry['blend_mode'], entry['visible']))
+    stack.layers = layers
+    stack.active_index = data['active']
+    return stack
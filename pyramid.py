@@ -0,0 +1,137 @@
+"""
+Mipmap pyramid of a TiledImage for zoomed-out views.
+
+Level 0 is the store itself; every level above halves the resolution, so a
+tile of level L covers (tile_size * 2**L) pixels of the image per side.
+Level tiles are built on demand from the four tiles below them (a 2x2 box
+average: each child drawn at half size with bilinear filtering) and
+cached.  When the image changes, only the level tiles above the changed
+rectangle are dropped and rebuilt on the next paint.
+
+Building is what a cold view costs, so draw() takes a deadline: the tiles
+it has no time left to build are drawn from the finer level instead
+(scaled down, down to the image itself) and the caller paints again to
+build the rest.
+"""
+import math
+import time
+
+from PyQt5.QtCore import QRect, QRectF
+from PyQt5.QtGui import QImage, QPainter
+
+MAX_LEVEL = 8  # 1/256 scale
+NOT_BUILT = object()  # what tile() returns for a tile it had no time to build
+
+
+class Pyramid:
+    """Lazily built, incrementally invalidated lower-resolution levels of a store."""
+
+    def __init__(self, store, max_level=MAX_LEVEL):
+        self.store = store
+        self.max_level = max_level
+        # level -> {key: QImage, or None for a tile that is plain background}
+        self.levels = [None] + [{} for _ in range(max_level)]
+
+    def level_for(self, zoom):
+        """The coarsest level that still has at least one texel per screen pixel at `zoom`."""
+        if zoom >= 1.0:
+            return 0
+        return min(int(math.floor(math.log2(1.0 / zoom))), self.max_level)
+
+    def level_tile_size(self, level):
+        """Pixels of the image covered by one side of a tile of `level`."""
+        return self.store.tile_size << level
+
+    def clear(self):
+        for cache in self.levels[1:]:
+            cache.clear()
+
+    def invalidate(self, rect):
+        """Drops every cached level tile above `rect` of the image."""
+        if rect.isEmpty():
+            return
+        for level in range(1, self.max_level + 1):
+            size = self.level_tile_size(level)
+            cache = self.levels[level]
+            for ty in range(rect.top() // size, rect.bottom() // size + 1):
+                for tx in range(rect.left() // size, rect.right() // size + 1):
+                    cache.pop((tx, ty), None)
+
+    def tile(self, level, key, deadline=None):
+        """
+        The tile `key` of `level`, or None where it is plain background.
+
+        Once time.perf_counter() passes `deadline`, tiles not cached yet
+        are NOT_BUILT; the ones built until then stay cached.
+        """
+        if level == 0:
+            return self.store.tile(key)
+        cache = self.levels[level]
+        if key in cache:
+            return cache[key]
+        children = []
+        for dy in (0, 1):
+            for dx in (0, 1):
+                child = self.tile(level - 1, (2 * key[0] + dx, 2 * key[1] + dy), deadline)
+                if child is NOT_BUILT:
+                    return NOT_BUILT
+                children.append(child)
+        if deadline is not None and time.perf_counter() > deadline:
+            return NOT_BUILT
+        tile = None
+        if any(child is not None for child in children):
+            size = self.store.tile_size
+            half = size / 2
+            tile = QImage(size, size, self.store.format)
+            tile.fill(self.store.background)
+            painter = QPainter(tile)
+            painter.setCompositionMode(QPainter.CompositionMode_Source)
+            # Halving with bilinear filtering averages each 2x2 block
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
+            for index, child in enumerate(children):
+                if child is not None:
+                    dy, dx = divmod(index, 2)
+                    painter.drawImage(QRectF(dx * half, dy * half, half, half), child)
+            painter.end()
+        cache[key] = tile
+        return tile
+
+    def draw(self, painter, level, rect, deadline=None):
+        """
+        Draws the part of the image under `rect` from `level`.
+
+        `painter` works in image coordinates (scaled down by the view), so
+        every level tile is drawn into the image area it covers.  Tiles not
+        built by `deadline` (see tile()) come from the finer levels; returns
+        False when that happened, so the caller draws again later.
+        """
+        rect = rect.intersected(self.store.rect())
+        if rect.isEmpty():
+            return True
+        size = self.level_tile_size(level)
+        complete = True
+        painter.save()
+        painter.setClipRect(rect)
+        for ty in range(rect.top() // size, rect.bottom() // size + 1):
+            for tx in range(rect.left() // size, rect.right() // size + 1):
+                complete &= self._draw_tile(painter, level, (tx, ty), rect, deadline)
+        painter.restore()
+        return complete
+
+    def _draw_tile(self, painter, level, key, rect, deadline):
+        size = self.level_tile_size(level)
+        area = QRect(key[0] * size, key[1] * size, size, size)
+        if not area.intersects(rect):
+            return True
+        tile = self.tile(level, key, deadline)
+        if tile is NOT_BUILT:
+            # The four tiles it would be built from, scaled down
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    self._draw_tile(painter, level - 1, (2 * key[0] + dx, 2 * key[1] + dy), rect, deadline)
+            return False
+        if tile is None:
+            painter.fillRect(area.intersected(rect), self.store.background)
+        else:
+            painter.drawImage(QRectF(area), tile)
+        return True
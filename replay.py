@@ -0,0 +1,321 @@
+"""
+Recording of editing sessions and their deterministic, headless replay.
+
+A Session holds what the user did on the canvas: mouse presses, moves,
+releases and wheel turns in widget coordinates, the tool settings in force
+at every press (tool, colours, brush size, ...), and commands that do not
+come from the mouse (undo, redo, filters, spray bursts fired by the flow
+timer).  Events are stored as compact lists and saved as gzipped JSON:
+
+    [time_ms, 'press' | 'move' | 'release', x, y, button, buttons]
+    [time_ms, 'wheel', x, y, angle_delta]
+    [time_ms, 'state', {setting: value, ...}]      only the settings that changed
+    [time_ms, 'command', name, arg, ...]
+
+replay() feeds a session back through Canvas.mousePressEvent() and the
+other handlers on a fresh canvas, one frame of recorded time at a time, and
+measures how long every event took to reach the screen.  The spray is
+reseeded and its timer replaced by the recorded bursts, so a replay does
+the same work every time.
+
+Usage:
+    python replay.py SESSION [WIDTHxHEIGHT ...]
+"""
+import gzip
+import json
+import os
+import sys
+import time
+
+from PyQt5.QtCore import Qt, QEvent, QObject, QPoint, QPointF, QSize
+from PyQt5.QtGui import QColor, QMouseEvent, QWheelEvent
+
+import spray_engine
+
+SESSION_VERSION = 1
+FRAME_MS = 16  # recorded events within one frame are handled before the frame is painted
+MOUSE_EVENTS = {
+    QEvent.MouseButtonPress: 'press',
+    QEvent.MouseMove: 'move',
+    QEvent.MouseButtonRelease: 'release',
+}
+
+
+def canvas_state(canvas):
+    """The canvas settings a replay needs to reproduce a press."""
+    return {
+        'tool': canvas.current_tool,
+        'primary': QColor(canvas.primary_color).rgba(),
+        'secondary': QColor(canvas.secondary_color).rgba(),
+        'brush_size': canvas.brush_size,
+        'spray_density': canvas.spray_density,
+        'spray_flow': canvas.spray_flow,
+        'fill_tolerance': canvas.fill_tolerance,
+        'fill_connectivity': canvas.fill_connectivity,
+        'gradient_kind': canvas.gradient_kind,
+        'gradient_ramp': canvas.gradient_ramp,
+        'gradient_dither': canvas.gradient_dither,
+    }
+
+
+def apply_state(canvas, state):
+    setters = {
+        'tool': canvas.set_tool,
+        'primary': lambda rgba: canvas.set_primary_color(QColor.fromRgba(rgba)),
+        'secondary': lambda rgba: canvas.set_secondary_color(QColor.fromRgba(rgba)),
+        'brush_size': canvas.set_brush_size,
+        'spray_density': canvas.set_spray_density,
+        'spray_flow': canvas.set_spray_flow,
+        'fill_tolerance': canvas.set_fill_tolerance,
+        'fill_connectivity': canvas.set_fill_connectivity,
+        'gradient_kind': canvas.set_gradient_kind,
+        'gradient_ramp': canvas.set_gradient_ramp,
+        'gradient_dither': canvas.set_gradient_dither,
+    }
+    for name, value in state.items():
+        setters[name](value)
+
+
+class Session:
+    """Recorded events of one editing session on a canvas of `size` (width, height)."""
+
+    def __init__(self, size, events=None):
+        self.size = tuple(size)
+        self.events = events if events is not None else []
+        self._state = {}
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != SESSION_VERSION:
+            raise ValueError(f'Unsupported session version: {data.get("version")}')
+        return cls(data['size'], data['events'])
+
+    def save(self, path):
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            json.dump({'version': SESSION_VERSION, 'size': self.size, 'events': self.events},
+                      f, separators=(',', ':'))
+
+    def __len__(self):
+        return len(self.events)
+
+    # Building a session, live or by a script
+
+    def state(self, t, **settings):
+        """Records the settings among `settings` that differ from the last recorded ones."""
+        changed = {name: value for name, value in settings.items() if self._state.get(name) != value}
+        if changed:
+            self._state.update(changed)
+            self.events.append([t, 'state', changed])
+
+    def mouse(self, t, kind, x, y, button=Qt.LeftButton, buttons=Qt.LeftButton):
+        self.events.append([t, kind, int(x), int(y), int(button), int(buttons)])
+
+    def wheel(self, t, x, y, angle_delta):
+        self.events.append([t, 'wheel', int(x), int(y), int(angle_delta)])
+
+    def command(self, t, name, *args):
+        self.events.append([t, 'command', name, *args])
+
+    def stroke(self, t, points, interval_ms=8, button=Qt.LeftButton):
+        """Records a press at the first point, moves through the rest and a release; returns the end time."""
+        (x, y), rest = points[0], points[1:]
+        self.mouse(t, 'press', x, y, button, button)
+        for x, y in rest:
+            t += interval_ms
+            self.mouse(t, 'move', x, y, Qt.NoButton, button)
+        self.mouse(t, 'release', x, y, button, Qt.NoButton)
+        return t
+
+
+class SessionRecorder(QObject):
+    """Records what happens on a live canvas into a Session until stop()."""
+
+    def __init__(self, canvas):
+        super().__init__(canvas)
+        self.canvas = canvas
+        self.session = Session((canvas.width(), canvas.height()))
+        self.started = time.perf_counter()
+        canvas.installEventFilter(self)
+        canvas.spray_timer.timeout.connect(self.on_spray_timer)
+        canvas.recorder = self
+
+    def now(self):
+        return round((time.perf_counter() - self.started) * 1000)
+
+    def stop(self):
+        """Stops recording; returns the session."""
+        self.canvas.removeEventFilter(self)
+        self.canvas.spray_timer.timeout.disconnect(self.on_spray_timer)
+        self.canvas.recorder = None
+        return self.session
+
+    def command(self, name, *args):
+        """Called by the canvas for edits that do not come from the mouse."""
+        self.session.command(self.now(), name, *args)
+
+    def on_spray_timer(self):
+        self.command('spray')
+
+    def eventFilter(self, obj, event):
+        kind = MOUSE_EVENTS.get(event.type())
+        if kind == 'press':
+            self.session.state(self.now(), **canvas_state(self.canvas))
+        if kind is not None:
+            self.session.mouse(self.now(), kind, event.x(), event.y(), event.button(), event.buttons())
+        elif event.type() == QEvent.Wheel:
+            self.session.wheel(self.now(), event.pos().x(), event.pos().y(), event.angleDelta().y())
+        return False
+
+
+class ReplayStats:
+    """Latencies (seconds) of the replayed events, total wall time and peak memory growth (bytes)."""
+
+    def __init__(self, latencies, total, peak_bytes):
+        self.latencies = sorted(latencies)
+        self.total = total
+        self.peak_bytes = peak_bytes
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0.0
+        index = min(int(round(p / 100 * (len(self.latencies) - 1))), len(self.latencies) - 1)
+        return self.latencies[index]
+
+    def summary(self):
+        return (f'{len(self.latencies)} events: p50 {self.percentile(50) * 1000:.2f} ms, '
+                f'p95 {self.percentile(95) * 1000:.2f} ms, p99 {self.percentile(99) * 1000:.2f} ms, '
+                f'max {self.percentile(100) * 1000:.2f} ms, total {self.total:.2f} s, '
+                f'peak memory +{self.peak_bytes / 2 ** 20:.0f} MB')
+
+
+def reset_peak_memory():
+    """Restarts the peak resident memory count where the OS allows it (Linux); returns True then."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def memory_usage():
+    """
+    (current, peak) resident memory of the process in bytes.
+
+    The peak counts from the last reset_peak_memory() where supported;
+    elsewhere it is the peak of the whole process and `current` is 0.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            fields = dict(line.split(':', 1) for line in f)
+        return int(fields['VmRSS'].split()[0]) * 1024, int(fields['VmHWM'].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0, 0  # Windows: not measured
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return 0, peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _dispatch(canvas, event, scale):
+    kind = event[1]
+    if kind in ('press', 'move', 'release'):
+        x, y, button, buttons = event[2:]
+        if kind == 'press' and canvas.current_tool == 'text':
+            return  # the text dialog cannot be replayed
+        qt_type = {'press': QEvent.MouseButtonPress, 'move': QEvent.MouseMove,
+                   'release': QEvent.MouseButtonRelease}[kind]
+        qt_event = QMouseEvent(qt_type, QPointF(x * scale[0], y * scale[1]), Qt.MouseButton(button),
+                               Qt.MouseButtons(buttons), Qt.NoModifier)
+        getattr(canvas, f'mouse{kind.capitalize()}Event')(qt_event)
+        if kind == 'press':
+            canvas.spray_timer.stop()  # its bursts are replayed from the recording
+    elif kind == 'wheel':
+        x, y, delta = event[2:]
+        pos = QPointF(x * scale[0], y * scale[1])
+        canvas.wheelEvent(QWheelEvent(pos, pos, QPoint(), QPoint(0, delta), Qt.NoButton,
+                                      Qt.NoModifier, Qt.NoScrollPhase, False))
+    elif kind == 'state':
+        apply_state(canvas, event[2])
+    elif kind == 'command':
+        name, args = event[2], event[3:]
+        if name == 'undo':
+            canvas.undo()
+        elif name == 'redo':
+            canvas.redo()
+        elif name == 'spray':
+            canvas.spray()
+        elif name == 'filter':
+            canvas.apply_filter(*args)
+            canvas.jobs.join()
+        else:
+            raise ValueError(f'Unknown session command: {name}')
+
+
+def replay(session, size=None, frame_ms=FRAME_MS, seed=0):
+    """
+    Replays `session` on a new, shown canvas of `size` (default: the recorded size).
+
+    Mouse positions are scaled to the new size.  Events are handled in
+    frames of `frame_ms` recorded milliseconds, each frame followed by
+    processing the queued events (coalesced strokes, repaint).  The latency
+    of an event runs from its dispatch to the end of its frame, and the
+    memory is the peak over what the process used before the replay.
+    Needs a QApplication; returns ReplayStats.
+    """
+    from PyQt5.QtWidgets import QApplication
+    from canvas import Canvas
+    app = QApplication.instance()
+    width, height = size or session.size
+    scale = (width / session.size[0], height / session.size[1])
+    spray_engine.seed(seed)
+    canvas = Canvas()
+    canvas.resize(width, height)
+    canvas.layers.resize(QSize(width, height))
+    canvas.show()
+    app.processEvents()
+    reset_peak_memory()
+    before, _ = memory_usage()
+    latencies = []
+    started = time.perf_counter()
+    index = 0
+    events = session.events
+    while index < len(events):
+        frame = events[index][0] // frame_ms
+        dispatched = []
+        while index < len(events) and events[index][0] // frame_ms == frame:
+            dispatched.append(time.perf_counter())
+            _dispatch(canvas, events[index], scale)
+            index += 1
+        app.processEvents()
+        end = time.perf_counter()
+        latencies += [end - start for start in dispatched]
+    total = time.perf_counter() - started
+    stats = ReplayStats(latencies, total, memory_usage()[1] - before)
+    canvas.jobs.shutdown()
+    canvas.saves.shutdown()
+    canvas.deleteLater()
+    app.sendPostedEvents(None, QEvent.DeferredDelete)
+    return stats
+
+
+def main(argv):
+    if not argv:
+        print(__doc__.strip().split('Usage:')[1].strip())
+        return 2
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication(sys.argv[:1])  # noqa: F841, kept alive while replaying
+    session = Session.load(argv[0])
+    sizes = [tuple(int(v) for v in arg.lower().split('x')) for arg in argv[1:]] or [session.size]
+    for size in sizes:
+        print(f'{size[0]}x{size[1]}: {replay(session, size).summary()}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,132 @@
+"""
+Selections: the region of the image that tools and filters are limited to.
+
+A selection is its bounding rectangle in image coordinates plus, unless it
+is a plain rectangle, a bitmask of that rectangle packed 8 pixels to a
+byte.  Everything that honours the selection only visits its bounding
+rectangle: painters are clipped to region() and NumPy code multiplies by
+mask(), so a small selection on a huge canvas costs what its area costs.
+"""
+import numpy as np
+from PyQt5.QtCore import Qt, QRect
+from PyQt5.QtGui import QBitmap, QImage, QPainter, QPainterPath, QPolygon, QRegion
+
+import fill_engine
+
+
+class Selection:
+    """A selected region: `rect` plus a packed bitmask of it (None for the whole rectangle)."""
+
+    def __init__(self, rect, mask=None):
+        self.rect = QRect(rect)
+        self.bits = None if mask is None else np.packbits(mask, axis=1)
+        self._region = None
+        self._outline = None
+
+    @classmethod
+    def from_rect(cls, rect, bounds):
+        """The rectangle `rect` clipped to `bounds` (the image), or None when nothing is left."""
+        rect = rect.normalized().intersected(bounds)
+        return cls(rect) if not rect.isEmpty() else None
+
+    @classmethod
+    def from_polygon(cls, points, bounds):
+        """The inside of the polygon through `points` (QPoints), clipped to `bounds`, or None."""
+        polygon = QPolygon(points)
+        rect = polygon.boundingRect().intersected(bounds)
+        if rect.isEmpty() or len(points) < 3:
+            return None
+        image = QImage(rect.size(), QImage.Format_Grayscale8)
+        image.fill(0)
+        painter = QPainter(image)
+        painter.translate(-rect.topLeft())
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(Qt.white)
+        painter.drawPolygon(polygon)
+        painter.end()
+        ptr = image.constBits()
+        ptr.setsize(image.byteCount())
+        rows = np.frombuffer(ptr, np.uint8).reshape(image.height(), image.bytesPerLine())
+        return cls._trimmed(rect, rows[:, :image.width()] > 127)
+
+    @classmethod
+    def from_fill(cls, store, x, y, tolerance=0, connectivity=4):
+        """Magic wand: the fill region of `store` around (x, y), or None outside the image."""
+        masks = fill_engine.tiled_region_masks(store, x, y, None, tolerance, connectivity)
+        if not masks:
+            return None
+        rect = fill_engine.tile_masks_bounds(store, masks)
+        mask = np.zeros((rect.height(), rect.width()), bool)
+        for key, tile_mask in masks.items():
+            tile_rect = store.tile_rect(key)
+            part = tile_rect.intersected(rect)
+            mask[part.top() - rect.top():part.bottom() + 1 - rect.top(),
+                 part.left() - rect.left():part.right() + 1 - rect.left()] = \
+                tile_mask[part.top() - tile_rect.top():part.bottom() + 1 - tile_rect.top(),
+                          part.left() - tile_rect.left():part.right() + 1 - tile_rect.left()]
+        return cls._trimmed(rect, mask)
+
+    @classmethod
+    def _trimmed(cls, rect, mask):
+        bounds = fill_engine.mask_bounds(mask)
+        if bounds.isEmpty():
+            return None
+        mask = mask[bounds.top():bounds.bottom() + 1, bounds.left():bounds.right() + 1]
+        return cls(bounds.translated(rect.topLeft()), None if mask.all() else mask)
+
+    def mask(self, rect=None):
+        """Boolean mask of `rect` (default: the bounding rectangle); True where selected."""
+        rect = self.rect if rect is None else rect
+        inside = rect.intersected(self.rect)
+        if self.bits is not None and not inside.isEmpty():
+            # Only the bytes under `inside` are unpacked
+            top, left = inside.top() - self.rect.top(), inside.left() - self.rect.left()
+            first, last = left >> 3, (left + inside.width() - 1) >> 3
+            block = np.unpackbits(self.bits[top:top + inside.height(), first:last + 1], axis=1)
+            block = block[:, left - first * 8:left - first * 8 + inside.width()].view(bool)
+            if inside == rect:
+                return block
+        else:
+            block = True
+        mask = np.zeros((rect.height(), rect.width()), bool)
+        if not inside.isEmpty():
+            mask[inside.top() - rect.top():inside.bottom() + 1 - rect.top(),
+                 inside.left() - rect.left():inside.right() + 1 - rect.left()] = block
+        return mask
+
+    def contains(self, points):
+        """Boolean (n,) array: which of the (n, 2) integer x, y `points` are selected."""
+        x = points[:, 0] - self.rect.left()
+        y = points[:, 1] - self.rect.top()
+        inside = (x >= 0) & (x < self.rect.width()) & (y >= 0) & (y < self.rect.height())
+        if self.bits is None:
+            return inside
+        result = np.zeros(len(points), bool)
+        x, y = x[inside], y[inside]
+        result[inside] = (self.bits[y, x >> 3] >> (7 - (x & 7))) & 1 == 1
+        return result
+
+    def region(self):
+        """The selection as a QRegion in image coordinates, for clipping painters."""
+        if self._region is None:
+            if self.bits is None:
+                self._region = QRegion(self.rect)
+            else:
+                # Format_Mono rows hold the packed bits most significant first, as packbits() does
+                width, height = self.rect.width(), self.rect.height()
+                image = QImage(width, height, QImage.Format_Mono)
+                ptr = image.bits()
+                ptr.setsize(image.byteCount())
+                rows = np.frombuffer(ptr, np.uint8).reshape(height, image.bytesPerLine())
+                rows[:, :self.bits.shape[1]] = self.bits
+                image.setColorTable([0xffffffff, 0xff000000])
+                self._region = QRegion(QBitmap.fromImage(image)).translated(self.rect.topLeft())
+        return self._region
+
+    def outline(self):
+        """QPainterPath around the selected pixels, for drawing the marquee."""
+        if self._outline is None:
+            path = QPainterPath()
+            path.addRegion(self.region())
+            self._outline = path.simplified()
+        return self._outline
@@ -0,0 +1,107 @@
+"""
+Spray (airbrush) tool: bursts of single-pixel particles around the nozzle.
+
+A burst draws `density` particles at once.  Their offsets come from one
+NumPy call, normally distributed around the nozzle and clamped to three
+sigma, and they are written straight into the tile pixels, one array
+assignment per tile.  There are no Python loops over particles, so the
+cost of a burst barely grows with the density.
+
+While the button is held, the canvas fires bursts `flow` times a second
+at the current mouse position; a flow of 0 sprays one burst per mouse move.
+"""
+import numpy as np
+from PyQt5.QtCore import QRect
+from PyQt5.QtGui import QColor
+
+from image_bridge import ALPHA_CHANNEL, RGB_CHANNELS, pixel_view
+
+SPRAY_DENSITY = 20  # particles per burst
+SPRAY_FLOW = 30  # bursts per second while the button is held; 0: one burst per mouse move
+MAX_SPRAY_DENSITY = 2000
+MAX_SPRAY_FLOW = 100
+
+_rng = np.random.default_rng()
+
+
+def seed(value):
+    """Restarts the particle generator from `value`, so the next bursts are reproducible."""
+    global _rng
+    _rng = np.random.default_rng(value)
+
+
+def spray_offsets(count, sigma, rng=None):
+    """(count, 2) integer particle offsets, normally distributed with `sigma`, within 3 sigma."""
+    radius = 3 * sigma
+    offsets = (rng or _rng).normal(0.0, sigma, (count, 2))
+    return np.clip(np.rint(offsets), -radius, radius).astype(np.intp)
+
+
+def spray_burst(store, x, y, density, sigma, color, rng=None, selection=None):
+    """
+    Sprays `density` particles of `color` around (x, y) into `store`.
+
+    Particles outside `selection` (a selection.Selection) are dropped.
+    Returns the QRect of the touched pixels (empty when every particle
+    fell outside the image).  The caller records the area for undo first:
+    touched_rect() gives it before anything is drawn.
+    """
+    points = spray_offsets(density, sigma, rng) + (int(x), int(y))
+    inside = ((points[:, 0] >= 0) & (points[:, 0] < store.width()) &
+              (points[:, 1] >= 0) & (points[:, 1] < store.height()))
+    if selection is not None:
+        inside &= selection.contains(points)
+    return spray_points(store, points[inside], color)
+
+
+def touched_rect(x, y, sigma):
+    """Area a burst around (x, y) can reach."""
+    radius = int(3 * sigma)
+    return QRect(int(x) - radius, int(y) - radius, 2 * radius + 1, 2 * radius + 1)
+
+
+def spray_points(store, points, color):
+    """Blends `color` over the pixels at `points` ((n, 2) x, y inside the image); returns their bounds."""
+    if not len(points):
+        return QRect()
+    value = premultiplied_pixel(color)
+    size = store.tile_size
+    left, top = points.min(axis=0).tolist()
+    right, bottom = points.max(axis=0).tolist()
+    if left // size == right // size and top // size == bottom // size:
+        # Usually the whole burst lands on one tile
+        groups = [((left // size, top // size), points)]
+    else:
+        keys = points // size
+        # Particles grouped by tile, so every tile gets one slice
+        order = np.lexsort((keys[:, 0], keys[:, 1]))
+        points, keys = points[order], keys[order]
+        starts = np.flatnonzero(np.any(np.diff(keys, axis=0), axis=1)) + 1
+        groups = [(tuple(keys[chunk[0]].tolist()), points[chunk])
+                  for chunk in np.split(np.arange(len(points)), starts)]
+    for (tx, ty), group in groups:
+        pixels = pixel_view(store.ensure_tile((tx, ty)))
+        local = group - (tx * size, ty * size)
+        _blend(pixels, local[:, 1], local[:, 0], value)
+    return QRect(left, top, right - left + 1, bottom - top + 1)
+
+
+def premultiplied_pixel(color):
+    """The 4 bytes of `color` as a premultiplied 32-bit pixel, in memory order."""
+    color = QColor(color)
+    alpha = color.alpha()
+    value = np.empty(4, np.uint8)
+    value[RGB_CHANNELS] = [(channel * alpha + 127) // 255
+                           for channel in (color.red(), color.green(), color.blue())]
+    value[ALPHA_CHANNEL] = alpha
+    return value
+
+
+def _blend(pixels, ys, xs, value):
+    # Source-over of a premultiplied pixel; on RGB32 tiles the alpha byte stays 255
+    alpha = int(value[ALPHA_CHANNEL])
+    if alpha == 255:
+        pixels[ys, xs] = value
+    elif alpha:
+        under = pixels[ys, xs].astype(np.uint16)
+        pixels[ys, xs] = value + (under * (255 - alpha) + 127) // 255
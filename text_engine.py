@@ -0,0 +1,268 @@
+"""
+Text tool: cached text rendering and re-editable text objects.
+
+Every font and colour gets a GlyphAtlas: each character is rasterised
+once into a shared image and text is composed by copying glyphs out of
+it, so typing only renders the characters not seen before.  Composed
+lines and blocks are cached by their text as well: editing a block
+re-composes only the line that changed, and moving a block around during
+a drag, or repainting its live preview, is a single image blit.  Lines of
+scripts that need shaping (right-to-left, Indic, combining marks, emoji
+sequences) are drawn by Qt whole instead of glyph by glyph, and cached
+the same way.
+
+A TextObject remembers where text was placed and the pixels that were
+under it, as a copy-on-write tile snapshot.  It can be moved or edited as
+long as nothing else has painted on its tiles since.
+"""
+import math
+import unicodedata
+from collections import OrderedDict, namedtuple
+
+from PyQt5.QtCore import Qt, QPoint, QPointF, QRect, pyqtSignal
+from PyQt5.QtGui import QColor, QFont, QFontMetricsF, QImage, QPainter
+from PyQt5.QtWidgets import (QDialog, QDialogButtonBox, QFontDialog, QHBoxLayout, QLabel, QPlainTextEdit,
+                             QPushButton, QVBoxLayout)
+
+from tile_store import TiledImage
+
+ATLAS_WIDTH = 512
+GLYPH_PADDING = 2  # transparent pixels around every glyph, for antialiasing and italic overhang
+MAX_ATLASES = 16  # fonts x colours kept
+MAX_BLOCKS = 32  # composed texts kept per atlas
+MAX_LINES = 512  # composed lines kept per atlas
+# Code points whose glyphs change with their neighbours
+SHAPED_RANGES = ((0x0590, 0x109F), (0x1780, 0x18AF), (0x200C, 0x200F), (0xFB1D, 0xFEFF))
+
+Glyph = namedtuple('Glyph', 'source offset advance')  # atlas QRect (None: blank), QPoint from the pen, float
+
+
+def needs_shaping(line):
+    """True when `line` cannot be drawn one glyph at a time."""
+    for char in line:
+        code = ord(char)
+        if code > 0xFFFF or unicodedata.combining(char) or \
+                any(first <= code <= last for first, last in SHAPED_RANGES):
+            return True
+    return False
+
+
+def font_key(font):
+    return font.toString()
+
+
+class GlyphAtlas:
+    """The glyphs of one font in one colour, rendered on first use into one image."""
+
+    def __init__(self, font, color):
+        self.font = QFont(font)
+        self.font.setKerning(False)  # glyphs are placed by their own advances
+        self.color = QColor(color)
+        self.metrics = QFontMetricsF(self.font)
+        self.line_spacing = self.metrics.lineSpacing()
+        self.image = QImage(ATLAS_WIDTH, 128, QImage.Format_ARGB32_Premultiplied)
+        self.image.fill(Qt.transparent)
+        self.glyphs = {}
+        self.shelf = QRect(0, 0, 0, 0)  # row being filled: its top and height, x of the next free pixel
+        self.lines = OrderedDict()  # line -> (QImage, offset from the pen position) or None
+        self.blocks = OrderedDict()  # text -> (QImage, offset from the pen position) or None
+
+    def glyph(self, char):
+        glyph = self.glyphs.get(char)
+        if glyph is None:
+            glyph = self.glyphs[char] = self._render(char)
+        return glyph
+
+    def _render(self, char):
+        advance = self.metrics.horizontalAdvance(char)
+        bounds = self.metrics.boundingRect(char)
+        if bounds.isEmpty() or char.isspace():
+            return Glyph(None, QPoint(), advance)
+        left = math.floor(bounds.left()) - GLYPH_PADDING
+        top = math.floor(bounds.top()) - GLYPH_PADDING
+        width = math.ceil(bounds.right()) + GLYPH_PADDING - left
+        height = math.ceil(bounds.bottom()) + GLYPH_PADDING - top
+        source = self._allocate(width, height)
+        painter = QPainter(self.image)
+        painter.setFont(self.font)
+        painter.setPen(self.color)
+        painter.drawText(QPointF(source.left() - left, source.top() - top), char)
+        painter.end()
+        return Glyph(source, QPoint(left, top), advance)
+
+    def _allocate(self, width, height):
+        # Shelf packing: glyphs fill a row left to right, a new row starts below the tallest one
+        shelf = self.shelf
+        if shelf.left() + width > ATLAS_WIDTH:
+            shelf = QRect(0, shelf.top() + shelf.height(), 0, 0)
+        if shelf.top() + max(height, shelf.height()) > self.image.height():
+            # Areas outside the old image come out transparent
+            self.image = self.image.copy(0, 0, ATLAS_WIDTH, max(2 * self.image.height(), shelf.top() + height))
+        source = QRect(shelf.left(), shelf.top(), width, height)
+        self.shelf = QRect(shelf.left() + width, shelf.top(), 0, max(height, shelf.height()))
+        return source
+
+    def line(self, line):
+        """(QImage, QPoint offset from the pen position) of one line of text, or None when it is blank."""
+        if line in self.lines:
+            self.lines.move_to_end(line)
+            return self.lines[line]
+        pieces = []
+        rect = QRect()
+        if needs_shaping(line):
+            rect = self.metrics.boundingRect(line).toAlignedRect().adjusted(
+                -GLYPH_PADDING, -GLYPH_PADDING, GLYPH_PADDING, GLYPH_PADDING)
+        else:
+            x = 0.0
+            for char in line:
+                glyph = self.glyph(char)
+                if glyph.source is not None:
+                    target = QRect(QPoint(round(x), 0) + glyph.offset, glyph.source.size())
+                    pieces.append((target.topLeft(), glyph.source))
+                    rect = rect.united(target)
+                x += glyph.advance
+        entry = None
+        if not rect.isEmpty():
+            image = QImage(rect.size(), QImage.Format_ARGB32_Premultiplied)
+            image.fill(Qt.transparent)
+            painter = QPainter(image)
+            painter.translate(-rect.topLeft())
+            if pieces:
+                for point, source in pieces:
+                    painter.drawImage(point, self.image, source)
+            else:
+                painter.setFont(self.font)
+                painter.setPen(self.color)
+                painter.drawText(QPointF(0, 0), line)
+            painter.end()
+            entry = (image, rect.topLeft())
+        self.lines[line] = entry
+        if len(self.lines) > MAX_LINES:
+            self.lines.popitem(last=False)
+        return entry
+
+    def block(self, text):
+        """(QImage, QPoint offset from the pen position) of `text` rendered, or None when it is blank."""
+        if text in self.blocks:
+            self.blocks.move_to_end(text)
+            return self.blocks[text]
+        lines = []
+        rect = QRect()
+        for index, line in enumerate(text.split('\n')):
+            entry = self.line(line)
+            if entry is not None:
+                point = entry[1] + QPoint(0, round(index * self.line_spacing))
+                lines.append((point, entry[0]))
+                rect = rect.united(QRect(point, entry[0].size()))
+        if len(lines) == 1:
+            block = (lines[0][1], lines[0][0])
+        elif lines:
+            # Editing a block re-renders only the lines that changed
+            image = QImage(rect.size(), QImage.Format_ARGB32_Premultiplied)
+            image.fill(Qt.transparent)
+            painter = QPainter(image)
+            painter.translate(-rect.topLeft())
+            for point, line_image in lines:
+                painter.drawImage(point, line_image)
+            painter.end()
+            block = (image, rect.topLeft())
+        else:
+            block = None
+        self.blocks[text] = block
+        if len(self.blocks) > MAX_BLOCKS:
+            self.blocks.popitem(last=False)
+        return block
+
+    def bounds(self, pos, text):
+        """Image area `text` covers with its first baseline starting at `pos`."""
+        block = self.block(text)
+        return QRect() if block is None else QRect(pos + block[1], block[0].size())
+
+    def draw(self, painter, pos, text):
+        block = self.block(text)
+        if block is not None:
+            painter.drawImage(pos + block[1], block[0])
+
+
+_atlases = OrderedDict()
+
+
+def atlas(font, color):
+    """The GlyphAtlas of `font` in `color`, shared by every text drawn with them."""
+    key = (font_key(font), QColor(color).rgba())
+    entry = _atlases.get(key)
+    if entry is None:
+        entry = _atlases[key] = GlyphAtlas(font, color)
+        if len(_atlases) > MAX_ATLASES:
+            _atlases.popitem(last=False)
+    else:
+        _atlases.move_to_end(key)
+    return entry
+
+
+def _tile_keys(store, rect):
+    return {key: store.tiles[key].cacheKey() for key in store.tile_keys(rect) if key in store.tiles}
+
+
+class TextObject:
+    """Text placed on a layer, with a snapshot of the pixels it was drawn over."""
+
+    def __init__(self, store, text, font, color, pos, rect, under):
+        self.store = store
+        self.text = text
+        self.font = QFont(font)
+        self.color = QColor(color)
+        self.pos = QPoint(pos)
+        self.rect = QRect(rect)
+        self.under = under  # TiledImage.snapshot() of `rect` before the text was drawn
+        self.keys = _tile_keys(store, rect)  # cache keys of the tiles right after it was drawn
+        self._under_image = None
+
+    def is_editable(self):
+        """True while nothing else has painted on the tiles under the text."""
+        return _tile_keys(self.store, self.rect) == self.keys
+
+    def under_image(self):
+        """The pixels under `rect` without the text, as a QImage."""
+        if self._under_image is None:
+            self._under_image = TiledImage.from_snapshot(self.under, self.store.tile_size).copy(self.rect)
+        return self._under_image
+
+
+class TextDialog(QDialog):
+    """Multi-line text and font for the text tool, reporting every change for the live preview."""
+    changed = pyqtSignal()
+
+    def __init__(self, parent, text='', font=None):
+        super().__init__(parent)
+        self.setWindowTitle('Text Tool')
+        self.font = QFont(font) if font is not None else QFont('Arial', 12)
+        self.editor = QPlainTextEdit(text)
+        self.editor.textChanged.connect(self.changed)
+        self.font_button = QPushButton()
+        self.font_button.clicked.connect(self.choose_font)
+        self._update_font_button()
+        row = QHBoxLayout()
+        row.addWidget(QLabel('Font:'))
+        row.addWidget(self.font_button, 1)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout = QVBoxLayout(self)
+        layout.addWidget(QLabel('Enter text:'))
+        layout.addWidget(self.editor)
+        layout.addLayout(row)
+        layout.addWidget(buttons)
+
+    def text(self):
+        return self.editor.toPlainText()
+
+    def choose_font(self):
+        font, ok = QFontDialog.getFont(self.font, self, 'Text Font')
+        if ok:
+            self.font = font
+            self._update_font_button()
+            self.changed.emit()
+
+    def _update_font_button(self):
+        self.font_button.setText(f'{self.font.family()}, {self.font.pointSize()} pt')
@@ -0,0 +1,220 @@
+"""
+Tiled backing store for the canvas.
+
+The image is split into TILE_SIZE x TILE_SIZE QImages that are allocated on
+the first write.  A tile that was never drawn on is simply missing from the
+dictionary and reads as the background colour, so a 20k x 20k canvas costs
+nothing until it is painted on.
+"""
+import numpy as np
+from PyQt5.QtCore import Qt, QPoint, QRect, QSize
+from PyQt5.QtGui import QColor, QImage, QPainter
+
+import fill_engine
+import image_bridge
+from image_bridge import pixel_view
+
+TILE_SIZE = 256
+
+
+class TiledImage:
+    """A QImage-like surface made of lazily allocated tiles."""
+
+    def __init__(self, width, height, background=Qt.white,
+                 image_format=QImage.Format_RGB32, tile_size=TILE_SIZE):
+        self._width = width
+        self._height = height
+        self.background = QColor(background)
+        self.format = image_format
+        self.tile_size = tile_size
+        self.tiles = {}
+
+    @classmethod
+    def from_qimage(cls, image, background=Qt.white, tile_size=TILE_SIZE):
+        store = cls(image.width(), image.height(), background, tile_size=tile_size)
+        store.write(image)
+        return store
+
+    @classmethod
+    def from_snapshot(cls, snapshot, tile_size=TILE_SIZE):
+        """A separate store sharing the pixels of a snapshot() until either side is painted on."""
+        store = cls(0, 0, tile_size=tile_size)
+        store.restore(snapshot)
+        return store
+
+    # Geometry
+
+    def width(self):
+        return self._width
+
+    def height(self):
+        return self._height
+
+    def size(self):
+        return QSize(self._width, self._height)
+
+    def rect(self):
+        return QRect(0, 0, self._width, self._height)
+
+    def tile_rect(self, key):
+        return QRect(key[0] * self.tile_size, key[1] * self.tile_size,
+                     self.tile_size, self.tile_size)
+
+    def tile_keys(self, rect):
+        """Yields the keys of every tile intersecting `rect` inside the image."""
+        rect = rect.intersected(self.rect())
+        if rect.isEmpty():
+            return
+        size = self.tile_size
+        for ty in range(rect.top() // size, rect.bottom() // size + 1):
+            for tx in range(rect.left() // size, rect.right() // size + 1):
+                yield tx, ty
+
+    def resize(self, size):
+        """Changes the extents; tiles that end up fully outside are released."""
+        self._width, self._height = size.width(), size.height()
+        bounds = self.rect()
+        for key in [k for k in self.tiles if not self.tile_rect(k).intersects(bounds)]:
+            del self.tiles[key]
+
+    # Tile access
+
+    def tile(self, key):
+        """The allocated tile for `key`, or None while it is still background."""
+        return self.tiles.get(key)
+
+    def ensure_tile(self, key):
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = QImage(self.tile_size, self.tile_size, self.format)
+            tile.fill(self.background)
+            self.tiles[key] = tile
+        return tile
+
+    def set_tile(self, key, tile):
+        self.tiles[key] = tile
+
+    def drop_tile(self, key):
+        self.tiles.pop(key, None)
+
+    def memory_bytes(self):
+        return sum(tile.byteCount() for tile in self.tiles.values())
+
+    # Drawing
+
+    def fill(self, color):
+        """Fills the whole image by releasing every tile and changing the background."""
+        self.tiles = {}
+        self.background = QColor(color)
+
+    def paint(self, rect, draw):
+        """
+        Calls draw(painter) once for every tile under `rect`.
+
+        The painter is translated so `draw` can use image coordinates and is
+        clipped to its tile, so the same drawing code works on any tile.
+        """
+        for key in self.tile_keys(rect):
+            origin = self.tile_rect(key).topLeft()
+            painter = QPainter(self.ensure_tile(key))
+            painter.translate(-origin)
+            draw(painter)
+            painter.end()
+
+    def write(self, image, pos=QPoint(0, 0)):
+        """Copies `image` into the store with its top-left corner at `pos`."""
+        target = QRect(pos, image.size())
+        background = fill_engine.color_value(self.background, self.format)
+        for key in self.tile_keys(target):
+            tile_rect = self.tile_rect(key)
+            part = tile_rect.intersected(target)
+            source = part.translated(-pos)
+            if key not in self.tiles:
+                # Writing plain background into an untouched tile changes nothing
+                block = image.copy(source).convertToFormat(self.format)
+                if np.all(pixel_view(block).view(np.uint32) == background):
+                    continue
+            painter = QPainter(self.ensure_tile(key))
+            painter.setCompositionMode(QPainter.CompositionMode_Source)
+            painter.drawImage(part.topLeft() - tile_rect.topLeft(), image, source)
+            painter.end()
+
+    def write_array(self, rgb, pos=(0, 0)):
+        """
+        Copies an (h, w, 3) RGB array (or any array-like, such as a memmap) into the store.
+
+        Only the block of each tile is read from `rgb` at a time.
+        """
+        x, y = pos
+        target = QRect(x, y, rgb.shape[1], rgb.shape[0])
+        background = np.array(self.background.getRgb()[:3], np.uint8)
+        for key in self.tile_keys(target):
+            tile_rect = self.tile_rect(key)
+            part = tile_rect.intersected(target)
+            block = np.asarray(rgb[part.top() - y:part.bottom() + 1 - y,
+                                   part.left() - x:part.right() + 1 - x])
+            # Writing plain background into an untouched tile changes nothing
+            if (key not in self.tiles and self.background.alpha() == 255 and
+                    np.all(block[0, 0] == background) and np.all(block == background)):
+                continue
+            image_bridge.write_rgb(self.ensure_tile(key), block,
+                                   (part.left() - tile_rect.left(), part.top() - tile_rect.top()))
+
+    def copy(self, rect=None):
+        """Composes the pixels under `rect` (default: the whole image) into one QImage."""
+        rect = self.rect() if rect is None else rect
+        image = QImage(rect.size(), self.format)
+        image.fill(self.background)
+        painter = QPainter(image)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        for key in self.tile_keys(rect):
+            tile = self.tiles.get(key)
+            if tile is not None:
+                painter.drawImage(self.tile_rect(key).topLeft() - rect.topLeft(), tile)
+        painter.end()
+        return image
+
+    def to_qimage(self):
+        return self.copy(self.rect())
+
+    def pixel(self, x, y):
+        """The 32-bit value stored at (x, y)."""
+        key = (x // self.tile_size, y // self.tile_size)
+        tile = self.tiles.get(key)
+        if tile is None:
+            return fill_engine.color_value(self.background, self.format)
+        return np.uint32(tile.pixel(x % self.tile_size, y % self.tile_size))
+
+    def draw(self, painter, rect):
+        """Draws the part of the image under `rect` at the same position on `painter`."""
+        rect = rect.intersected(self.rect())
+        for key in self.tile_keys(rect):
+            tile_rect = self.tile_rect(key)
+            part = tile_rect.intersected(rect)
+            tile = self.tiles.get(key)
+            if tile is None:
+                painter.fillRect(part, self.background)
+            else:
+                painter.drawImage(part.topLeft(), tile, part.translated(-tile_rect.topLeft()))
+
+    # Snapshots
+
+    def snapshot(self, rect=None):
+        """
+        Cheap copy of the current tiles (only those under `rect`, when given).
+
+        QImage is implicitly shared, so this only copies handles; a tile's
+        pixels are duplicated by Qt when one of the sides is painted on.
+        """
+        if rect is None:
+            tiles = {k: QImage(t) for k, t in self.tiles.items()}
+        else:
+            tiles = {k: QImage(self.tiles[k]) for k in self.tile_keys(rect) if k in self.tiles}
+        return (self.size(), QColor(self.background), self.format, tiles)
+
+    def restore(self, snapshot):
+        size, background, image_format, tiles = snapshot
+        self._width, self._height = size.width(), size.height()
+        self.background = QColor(background)
+        self.format = image_format
+        self.tiles = {k: QImage(t) for k, t in tiles.items()}
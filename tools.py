@@ -1,7 +1,11 @@
-from PyQt5.QtWidgets import QToolBar, QAction, QSpinBox, QVBoxLayout, QLabel, QWidget, QPushButton
+from PyQt5.QtWidgets import (QToolBar, QAction, QSpinBox, QVBoxLayout, QLabel, QWidget, QPushButton, QCheckBox,
+                             QComboBox)
 from PyQt5.QtGui import QIcon
 from PyQt5.QtCore import Qt
 
+from gradient_engine import KINDS as GRADIENT_KINDS, RAMPS as GRADIENT_RAMPS
+from spray_engine import MAX_SPRAY_DENSITY, MAX_SPRAY_FLOW
+
 class ToolBar(QWidget):
     def __init__(self, canvas):
         super().__init__()
@@ -25,7 +29,10 @@ class ToolBar(QWidget):
             ("Text", "text"),
             ("Gradient", "gradient"),
             ("Polygon", "polygon"),
-            ("Selection", "selection")
+            ("Selection", "selection"),
+            ("Lasso", "lasso"),
+            ("Wand", "wand"),
+            ("Shape", "shape")
         ]
 
         tool_group = QWidget()
@@ -71,6 +78,71 @@ class ToolBar(QWidget):
         self.brush_size.valueChanged.connect(self.canvas.set_brush_size)
         layout.addWidget(self.brush_size)
 
+        density_label = QLabel("Spray Density:")
+        density_label.setStyleSheet("color: white; padding-top: 5px;")
+        layout.addWidget(density_label)
+
+        self.spray_density = QSpinBox()
+        self.spray_density.setMinimum(1)
+        self.spray_density.setMaximum(MAX_SPRAY_DENSITY)
+        self.spray_density.setValue(self.canvas.spray_density)
+        self.spray_density.setToolTip("Particles per spray burst")
+        self.spray_density.valueChanged.connect(self.canvas.set_spray_density)
+        layout.addWidget(self.spray_density)
+
+        flow_label = QLabel("Spray Flow (/s):")
+        flow_label.setStyleSheet("color: white; padding-top: 5px;")
+        layout.addWidget(flow_label)
+
+        self.spray_flow = QSpinBox()
+        self.spray_flow.setMinimum(0)
+        self.spray_flow.setMaximum(MAX_SPRAY_FLOW)
+        self.spray_flow.setValue(self.canvas.spray_flow)
+        self.spray_flow.setToolTip("Spray bursts per second while the button is held (0: one per mouse move)")
+        self.spray_flow.valueChanged.connect(self.canvas.set_spray_flow)
+        layout.addWidget(self.spray_flow)
+
+        tolerance_label = QLabel("Fill Tolerance:")
+        tolerance_label.setStyleSheet("color: white; padding-top: 5px;")
+        layout.addWidget(tolerance_label)
+
+        self.fill_tolerance = QSpinBox()
+        self.fill_tolerance.setMinimum(0)
+        self.fill_tolerance.setMaximum(255)
+        self.fill_tolerance.setValue(0)
+        self.fill_tolerance.valueChanged.connect(self.canvas.set_fill_tolerance)
+        layout.addWidget(self.fill_tolerance)
+
+        self.fill_diagonal = QCheckBox("8-way fill")
+        self.fill_diagonal.setStyleSheet("color: white;")
+        self.fill_diagonal.toggled.connect(
+            lambda checked: self.canvas.set_fill_connectivity(8 if checked else 4))
+        layout.addWidget(self.fill_diagonal)
+
+        gradient_label = QLabel("Gradient:")
+        gradient_label.setStyleSheet("color: white; padding-top: 5px;")
+        layout.addWidget(gradient_label)
+
+        self.gradient_kind = QComboBox()
+        self.gradient_kind.addItems([kind.capitalize() for kind in GRADIENT_KINDS])
+        self.gradient_kind.currentIndexChanged.connect(
+            lambda index: self.canvas.set_gradient_kind(GRADIENT_KINDS[index]))
+        layout.addWidget(self.gradient_kind)
+
+        self.gradient_ramp = QComboBox()
+        self.gradient_ramp.addItems([ramp.capitalize() for ramp in GRADIENT_RAMPS])
+        self.gradient_ramp.setToolTip("Colours of the gradient (the colour of the mouse button first)")
+        self.gradient_ramp.currentIndexChanged.connect(
+            lambda index: self.canvas.set_gradient_ramp(GRADIENT_RAMPS[index]))
+        layout.addWidget(self.gradient_ramp)
+
+        self.gradient_dither = QCheckBox("Dither gradient")
+        self.gradient_dither.setStyleSheet("color: white;")
+        self.gradient_dither.setToolTip("Ordered dithering against colour banding")
+        self.gradient_dither.setChecked(self.canvas.gradient_dither)
+        self.gradient_dither.toggled.connect(self.canvas.set_gradient_dither)
+        layout.addWidget(self.gradient_dither)
+
         layout.addStretch()
         self.setLayout(layout)
 
@@ -0,0 +1,190 @@
+"""
+Vector layers: lines, rectangles, ellipses and polygons kept as objects.
+
+A vector layer is an ordinary layer whose pixels are a cache of its shapes,
+so compositing, the pyramid and saving see nothing special.  The shapes sit
+in a uniform grid of CELL_SIZE pixel cells: a shape is listed in every cell
+its bounds touch.  Hit-testing a point looks only at the shapes of its cell,
+and after a shape is added, moved or removed only the shapes in the area
+it covered are drawn again; both cost what the shapes near that spot cost,
+however many shapes the layer holds.
+
+Shapes may reach past the image: only the part inside is drawn, and the
+rest once the image grows over it.
+
+Shapes are never changed in place: an edit puts a new Shape under the same
+id, which keeps its place in the drawing order (the id order).
+"""
+import math
+
+from PyQt5.QtCore import Qt, QPoint, QPointF, QRect, QRectF
+from PyQt5.QtGui import QPainter, QPainterPath, QPainterPathStroker, QPen, QPolygon, QPolygonF
+
+CELL_SIZE = 64  # pixels per side of a grid cell
+KINDS = ('line', 'rectangle', 'circle', 'polygon')
+
+
+class Shape:
+    """One shape: its kind, the points it was drawn through, pen colour and width."""
+    __slots__ = ('kind', 'points', 'color', 'width', 'rect', '_outline')
+
+    def __init__(self, kind, points, color, width):
+        if kind not in KINDS:
+            raise ValueError(f'Unknown shape: {kind}')
+        self.kind = kind
+        self.points = tuple(QPoint(point) for point in points)
+        self.color = color
+        self.width = width
+        # Same margin as the canvas gives the raster shape tools
+        margin = width // 2 + 2
+        self.rect = QPolygon(list(self.points)).boundingRect().adjusted(-margin, -margin, margin, margin)
+        self._outline = None
+
+    def draw(self, painter):
+        painter.setPen(QPen(self.color, self.width))
+        painter.setBrush(Qt.NoBrush)
+        if self.kind == 'line':
+            painter.drawLine(*self.points)
+        elif self.kind == 'rectangle':
+            painter.drawRect(QRect(*self.points).normalized())
+        elif self.kind == 'circle':
+            painter.drawEllipse(QRect(*self.points).normalized())
+        else:
+            painter.drawPolygon(QPolygon(list(self.points)))
+
+    def outline(self):
+        """The centre line of the pen as a QPainterPath."""
+        if self._outline is None:
+            path = QPainterPath()
+            if self.kind == 'line':
+                path.moveTo(QPointF(self.points[0]))
+                path.lineTo(QPointF(self.points[1]))
+            elif self.kind == 'rectangle':
+                path.addRect(QRectF(*map(QPointF, self.points)).normalized())
+            elif self.kind == 'circle':
+                path.addEllipse(QRectF(*map(QPointF, self.points)).normalized())
+            else:
+                path.addPolygon(QPolygonF([QPointF(point) for point in self.points]))
+                path.closeSubpath()
+            self._outline = path
+        return self._outline
+
+    def hit(self, pos, tolerance=0):
+        """True when image position `pos` lies on the pen's stroke, or within `tolerance` pixels of it."""
+        stroker = QPainterPathStroker()
+        stroker.setWidth(self.width + 2 * tolerance)
+        return stroker.createStroke(self.outline()).contains(QPointF(pos) + QPointF(0.5, 0.5))
+
+    def translated(self, offset):
+        return Shape(self.kind, [point + offset for point in self.points], self.color, self.width)
+
+
+class ShapeIndex:
+    """Uniform grid over the image: which shape ids have bounds touching each cell."""
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}  # (cx, cy) -> set of shape ids
+
+    def _keys(self, rect):
+        size = self.cell_size
+        for cy in range(math.floor(rect.top() / size), math.floor(rect.bottom() / size) + 1):
+            for cx in range(math.floor(rect.left() / size), math.floor(rect.right() / size) + 1):
+                yield cx, cy
+
+    def insert(self, shape_id, rect):
+        for key in self._keys(rect):
+            self.cells.setdefault(key, set()).add(shape_id)
+
+    def remove(self, shape_id, rect):
+        for key in self._keys(rect):
+            cell = self.cells.get(key)
+            if cell is not None:
+                cell.discard(shape_id)
+                if not cell:
+                    del self.cells[key]
+
+    def query(self, rect):
+        """Ids of the shapes listed in the cells under `rect` (a superset of those touching it)."""
+        found = set()
+        for key in self._keys(rect):
+            cell = self.cells.get(key)
+            if cell:
+                found |= cell
+        return found
+
+
+class VectorLayer:
+    """The shapes of one layer, by id, with their spatial index."""
+
+    def __init__(self):
+        self.shapes = {}  # id -> Shape
+        self.index = ShapeIndex()
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def get(self, shape_id):
+        return self.shapes.get(shape_id)
+
+    def put(self, shape_id, shape):
+        """Stores `shape` under `shape_id`, replacing what was there (None removes it)."""
+        old = self.shapes.pop(shape_id, None)
+        if old is not None:
+            self.index.remove(shape_id, old.rect)
+        if shape is not None:
+            self.shapes[shape_id] = shape
+            self.index.insert(shape_id, shape.rect)
+            self.next_id = max(self.next_id, shape_id + 1)
+
+    def add(self, shape):
+        """Adds `shape` on top of the others; returns its id."""
+        shape_id = self.next_id
+        self.put(shape_id, shape)
+        return shape_id
+
+    def ids_in(self, rect):
+        """Ids of the shapes whose bounds touch `rect`, bottom first."""
+        shapes = self.shapes
+        return sorted(shape_id for shape_id in self.index.query(rect) if shapes[shape_id].rect.intersects(rect))
+
+    def shape_at(self, pos, tolerance=0):
+        """Id of the topmost shape whose stroke passes within `tolerance` pixels of `pos`, or None."""
+        area = QRect(pos, pos).adjusted(-tolerance, -tolerance, tolerance, tolerance)
+        for shape_id in reversed(self.ids_in(area)):
+            if self.shapes[shape_id].hit(pos, tolerance):
+                return shape_id
+        return None
+
+    def render(self, painter, rect):
+        """Replaces the pixels under `rect` on `painter` with the shapes drawn there."""
+        painter.save()
+        painter.setClipRect(rect)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.fillRect(rect, Qt.transparent)
+        painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+        for shape_id in self.ids_in(rect):
+            self.shapes[shape_id].draw(painter)
+        painter.restore()
+
+    def rasterize(self, store, rect):
+        """Renders the shapes under `rect` into the tiles of `store` (a TiledImage), each tile only its own."""
+        for key in store.tile_keys(rect):
+            tile_rect = store.tile_rect(key)
+            painter = QPainter(store.ensure_tile(key))
+            painter.translate(-tile_rect.topLeft())
+            self.render(painter, tile_rect.intersected(rect))
+            painter.end()
+
+    def uncover(self, store, area):
+        """
+        Draws the shapes into `area` of `store`, a part that was outside the image until it grew.
+
+        Only the tiles it already has (on the old edges) and the shapes
+        reaching into `area` are drawn, so empty space stays unallocated.
+        """
+        rects = [store.tile_rect(key) for key in store.tile_keys(area) if store.tile(key) is not None]
+        rects += [self.shapes[shape_id].rect for shape_id in self.ids_in(area)]
+        for rect in rects:
+            self.rasterize(store, rect.intersected(area))